@@ -15,6 +15,24 @@ class APIValueError(APIError):
         super().__init__('value:invalid', field, message)
 
 
+class APIResourceNotFoundError(APIError):
+    '''
+    Indicate the resource was not found.
+    '''
+
+    def __init__(self, field, message=''):
+        super().__init__('value:notfound', field, message)
+
+
+class APIBusyError(APIError):
+    '''
+    Indicate the server is overloaded and the request should be retried later.
+    '''
+
+    def __init__(self, field, message=''):
+        super().__init__('server:busy', field, message)
+
+
 class APIPermissionError(APIError):
     '''
     Indicate the api has no permission.
@@ -2,18 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import asyncio
 import orm
+import comments
+import feed
+import search
+import syndication
+import profiling
 import os
 import time
+import server
 from datetime import datetime
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
-from middlewares import logger_factory, auth_factory, response_factory
+from middlewares import logger_factory, timing_factory, auth_factory, \
+    response_factory, current_user
 from web_frame import add_routes, add_static
+import config
+from config import configs
 
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=getattr(logging, configs.logging.level))
+config.add_reload_listener(lambda old, new: logging.getLogger().setLevel(
+    getattr(logging, new.logging.level)))
 
 
 def init_jinja2(app, **kw):
@@ -27,7 +37,8 @@ def init_jinja2(app, **kw):
         block_end_string=kw.get('block_end_string', '%}'),
         variable_start_string=kw.get('variable_start_string', '{{'),
         variable_end_string=kw.get('variable_end_string', '}}'),
-        auto_reload=kw.get('auto_reload', True))
+        auto_reload=kw.get('auto_reload', True),
+        cache_size=kw.get('cache_size', 400))
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(
@@ -55,25 +66,30 @@ def datetime_filter(t):
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 
-async def init(loop):
-    await orm.create_pool(
-        loop=loop,
-        host='127.0.0.1',
-        port=3306,
-        user='iamswf',
-        password='iamswf',
-        db='pure_blog')
-    app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
-    ])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+async def init_app():
+    middlewares = [logger_factory, timing_factory, auth_factory,
+                   response_factory]
+    p = configs.profiling
+    if p.enabled:
+        # 放在auth外面，剖析里包含auth阶段
+        middlewares.insert(middlewares.index(auth_factory),
+                           profiling.profile_middleware(
+                               p.sample_every, p.header, p.interval,
+                               p.output_dir, get_user=current_user))
+    app = web.Application(middlewares=middlewares)
+    orm.setup_pool(app, **configs.db)
+    orm.setup_cache(**configs.entity_cache)
+    comments.setup(app, **configs.comments)
+    feed.setup(app, **configs.feed)
+    search.setup(app, **configs.search)
+    syndication.setup(app, **configs.syndication)
+    init_jinja2(app, filters=dict(datetime=datetime_filter),
+                auto_reload=configs.template.auto_reload,
+                cache_size=configs.template.cache_size)
     add_routes(app, 'handlers')
     add_static(app)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('server started at http://127.0.0.1:9000...')
-    return srv
+    return app
 
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    server.main(init_app)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    基准测试
+
+    在www目录下运行:
+        python3 -m benchmarks                      # 全部suite
+        python3 -m benchmarks orm markdown         # 指定suite
+        python3 -m benchmarks --quick --json out.json
+        python3 -m benchmarks e2e --db-latency 0.002
+
+    每个suite是一个suite_<name>.py模块，提供run(report, scale)，
+    scale按比例缩放迭代次数(--quick时为0.1)。数据由fixtures按固定种子生成，
+    每项取repeat次里最快的一次，计时期间关闭gc。
+    --json把结果连同commit、Python版本一起写出，用来对比不同commit的回归。
+
+    bench_*.py是针对单个优化的独立脚本，直接运行。
+'''
+
+import gc
+import sys
+import json
+import time
+import platform
+import subprocess
+
+
+SUITES = ['orm', 'routing', 'markdown', 'templates', 'e2e']
+
+
+def measure(fn, number, repeat=5):
+    '''
+        调用fn number次为一轮，返回最快一轮里每次调用的秒数
+    '''
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            t = time.perf_counter() - start
+            best = t if best is None else min(best, t)
+    finally:
+        if enabled:
+            gc.enable()
+    return best / number
+
+
+def scaled(n, scale):
+    return max(1, int(n * scale))
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+class Report(object):
+
+    def __init__(self, **options):
+        self.results = []
+        # 命令行传给suite的参数，如db_latency
+        self.options = options
+
+    def add(self, suite, name, seconds, unit='op', **extra):
+        '''
+            seconds是每个unit的耗时
+        '''
+        r = dict(suite=suite, name=name, unit=unit,
+                 us_per_op=seconds * 1e6, ops_per_sec=1 / seconds)
+        r.update(extra)
+        self.results.append(r)
+        print('{:<10} {:<44} {:>12.0f} {}/s {:>12.2f} us'.format(
+            suite, name, r['ops_per_sec'], unit, r['us_per_op']))
+        return r
+
+    def to_json(self):
+        return dict(
+            commit=_commit(),
+            python=platform.python_implementation() + ' ' +
+            platform.python_version(),
+            platform=platform.platform(),
+            time=time.time(),
+            options=self.options,
+            results=self.results)
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_json(), f, ensure_ascii=False, indent=2)
+
+
+def run(suites=None, scale=1.0, **options):
+    import importlib
+    report = Report(**options)
+    for name in suites or SUITES:
+        if name not in SUITES:
+            print('unknown suite: {}'.format(name), file=sys.stderr)
+            continue
+        importlib.import_module('benchmarks.suite_' + name).run(report, scale)
+    return report
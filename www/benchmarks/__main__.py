@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import argparse
+from benchmarks import SUITES, run
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks')
+    parser.add_argument('suites', nargs='*', help=', '.join(SUITES))
+    parser.add_argument('--quick', action='store_true',
+                        help='iterations x0.1')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--db-latency', type=float, default=0,
+                        help='seconds added to every query (e2e)')
+    opts = parser.parse_args()
+    # 每个请求/查询的INFO日志会淹没结果，先配置好root logger，
+    # 之后app.py里的basicConfig不再生效
+    logging.basicConfig(level=logging.WARNING)
+    report = run(opts.suites, 0.1 if opts.quick else 1.0,
+                 db_latency=opts.db_latency)
+    if opts.json:
+        report.write(opts.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    markdown2小文档吞吐量: 每次新建Markdown vs 复用MarkdownPool
+    长文修改一段后重新渲染: 全量 vs markdown_incremental
+
+    usage: python3 benchmarks/bench_markdown.py [-n 20000]
+'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown2
+
+
+SNIPPETS = [
+    '沙发！',
+    '写得不错，*赞*一个',
+    '请问 `asyncio.get_event_loop()` 在3.10之后还能用吗？',
+    '参考 [aiohttp文档](https://docs.aiohttp.org/) 里的 **AppRunner** 一节。',
+    '> 引用楼上\n\n同意 & 补充一点: a < b',
+]
+
+
+def bench(name, fn, n, repeat=3):
+    elapsed = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(n):
+            fn(SNIPPETS[i % len(SNIPPETS)])
+        t = time.perf_counter() - start
+        elapsed = t if elapsed is None else min(elapsed, t)
+    print('{:<24} {:>10.0f} docs/s  {:>8.1f} us/doc'.format(
+        name, n / elapsed, elapsed / n * 1e6))
+
+
+def bench_edit(n):
+    '''
+        把corpus/post_zh.md放大成长文，每次修改其中一段后重新渲染
+    '''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'corpus', 'post_zh.md')
+    with open(path, encoding='utf-8') as f:
+        paras = (f.read() + '\n') * 20
+    paras = paras.split('\n\n')
+    cache = markdown2.BlockCache()
+
+    def edited(i):
+        L = list(paras)
+        L[i % len(L)] += ' 修改%d' % i
+        return '\n\n'.join(L)
+
+    for name, fn in [
+            ('full render', markdown2.markdown),
+            ('incremental render',
+             lambda text: markdown2.markdown_incremental(text, cache))]:
+        start = time.perf_counter()
+        for i in range(n):
+            fn(edited(i))
+        elapsed = time.perf_counter() - start
+        print('{:<24} {:>8.2f} ms/edit'.format(name, elapsed / n * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000)
+    opts = parser.parse_args()
+    pool = markdown2.MarkdownPool()
+    bench('new Markdown per call',
+          lambda text: markdown2.Markdown().convert(text), opts.n)
+    bench('MarkdownPool.convert', pool.convert, opts.n)
+    bench('markdown2.markdown', markdown2.markdown, opts.n)
+    bench_edit(max(opts.n // 200, 10))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    文章页的数据库耗时: memory vs sqlite vs mysql
+
+    一次页面访问按handlers.get_blog的查询来算: Blog.find、第一页评论、
+    评论数。先顺序访问取延迟的p50/p99，再用c个并发访问看吞吐量，
+    sqlite的读连接池在并发时才体现出来。
+
+    memory和sqlite写入fixtures的数据(sqlite用临时文件)；mysql只在
+    指定--mysql时测，用config.db里的库和已有数据，不写入。
+
+    usage: python3 benchmarks/bench_pageview.py [-n 2000] [-c 10] [--mysql]
+'''
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+import config
+from models import User, Blog, Comment
+from benchmarks import fixtures
+
+
+PAGE_SIZE = 20
+
+
+async def page_view(blog_id):
+    blog = await Blog.find(blog_id)
+    rs = await Comment.findAll('`blog_id`=?', [blog_id],
+                               columns=['user_id', 'user_name', 'user_image',
+                                        'html_content', 'created_at'],
+                               orderBy='`created_at` desc, `id` desc',
+                               limit=PAGE_SIZE + 1)
+    n = await Comment.find_number('count(*)', '`blog_id`=?', [blog_id])
+    return blog, rs, n
+
+
+async def load_fixtures():
+    blogs = fixtures.blog_rows(200)
+    for model, rows in ((User, fixtures.user_rows()), (Blog, blogs),
+                        (Comment, fixtures.comment_rows(blogs, 30))):
+        # 一条insert的参数个数受SQLite的变量上限限制，分批写
+        for i in range(0, len(rows), 50):
+            await model.save_all([model(**r) for r in rows[i:i + 50]])
+    return [b['id'] for b in blogs]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def bench(name, ids, n, concurrency):
+    for blog_id in ids[:10]:
+        await page_view(blog_id)
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        await page_view(ids[i % len(ids)])
+        latencies.append(time.perf_counter() - start)
+    print('{:<8} p50 {:>8.3f} ms   p99 {:>8.3f} ms'.format(
+        name, percentile(latencies, 0.5) * 1e3,
+        percentile(latencies, 0.99) * 1e3))
+
+    async def client(k):
+        for i in range(k, n, concurrency):
+            await page_view(ids[i % len(ids)])
+    start = time.perf_counter()
+    await asyncio.gather(*(client(k) for k in range(concurrency)))
+    print('{:<8} c={:<3} {:>10.0f} views/s'.format(
+        name, concurrency, n / (time.perf_counter() - start)))
+
+
+async def run(backend, n, concurrency, **kw):
+    await orm.create_pool(backend=backend, **kw)
+    try:
+        if backend == 'mysql':
+            ids = [b.id for b in await Blog.findAll(
+                columns=['created_at'], orderBy='`created_at` desc',
+                limit=200)]
+            if not ids:
+                print('mysql    no blogs in {}, skipped'.format(kw['db']))
+                return
+        else:
+            ids = await load_fixtures()
+        await bench(backend, ids, n, concurrency)
+    finally:
+        await orm.close_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=2000)
+    parser.add_argument('-c', type=int, default=10)
+    parser.add_argument('--mysql', action='store_true',
+                        help='also run against config.db (read only)')
+    opts = parser.parse_args()
+    # 每条SQL的INFO日志会淹没结果
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run('memory', opts.n, opts.c))
+        with tempfile.TemporaryDirectory() as tmp:
+            loop.run_until_complete(run(
+                'sqlite', opts.n, opts.c,
+                sqlite_path=os.path.join(tmp, 'bench.db'),
+                sqlite_readers=config.configs.db.sqlite_readers))
+        if opts.mysql:
+            kw = dict(config.configs.db.items(), latency=0, keepalive=0)
+            kw.pop('backend')
+            loop.run_until_complete(run('mysql', opts.n, opts.c, **kw))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    markdown2占位符(HTML块/行内HTML/代码片段/转义字符)的回归检查与基准
+
+    corpus/下每个NAME.md都有对应的期望输出:
+        NAME.html         默认参数
+        NAME.escape.html  safe_mode='escape'
+
+    usage:
+        python3 benchmarks/bench_placeholders.py            # 检查 + 基准
+        python3 benchmarks/bench_placeholders.py --update   # 重新生成期望输出
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown2
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+MODES = [('.html', None), ('.escape.html', 'escape')]
+
+
+def corpus():
+    for path in sorted(glob.glob(os.path.join(CORPUS, '*.md'))):
+        with open(path, encoding='utf-8') as f:
+            yield path[:-len('.md')], f.read()
+
+
+def check(update=False):
+    failed = 0
+    for base, text in corpus():
+        for suffix, safe_mode in MODES:
+            html = markdown2.markdown(text, safe_mode=safe_mode)
+            path = base + suffix
+            if update:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(html)
+                continue
+            with open(path, encoding='utf-8') as f:
+                expected = f.read()
+            if html != expected:
+                failed += 1
+                print('FAIL {}'.format(os.path.basename(path)))
+    if not update:
+        print('regression: {} failed'.format(failed))
+    return failed
+
+
+def bench(repeat=5):
+    '''
+        把spans.md放大k倍，耗时应随文档大小线性增长
+    '''
+    with open(os.path.join(CORPUS, 'spans.md'), encoding='utf-8') as f:
+        text = f.read()
+    for k in (1, 4, 16, 64):
+        doc = (text + '\n') * k
+        for safe_mode in (None, 'escape'):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                markdown2.markdown(doc, safe_mode=safe_mode)
+                t = time.perf_counter() - start
+                best = t if best is None else min(best, t)
+            print('x{:<3} {:>7.0f}KB safe_mode={:<7} {:>9.2f} ms {:>8.3f} ms/KB'
+                  .format(k, len(doc) / 1024, str(safe_mode), best * 1e3,
+                          best * 1e3 / (len(doc) / 1024)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--update', action='store_true',
+                        help='regenerate the expected html')
+    opts = parser.parse_args()
+    if opts.update:
+        check(update=True)
+        return 0
+    failed = check()
+    bench()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
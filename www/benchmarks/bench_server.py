@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    服务启动时间和请求吞吐量: asyncio默认事件循环 vs uvloop(已安装时)
+
+    用server.start按config.server的参数启动，只挂不查库的路由依赖
+    (中间件、模板、handlers)，不连数据库。客户端和服务端跑在同一个
+    事件循环里，数字只用来比较两种实现，不代表线上的绝对吞吐量。
+
+    usage: python3 benchmarks/bench_server.py [-n 2000] [-c 20]
+'''
+
+import os
+import sys
+import time
+import types
+import socket
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+from aiohttp import web
+import app as blog_app
+import config
+import server
+from middlewares import logger_factory, auth_factory, response_factory
+from web_frame import add_routes
+
+
+PATHS = ['/', '/signin', '/api/search?q=%E5%BC%82%E6%AD%A5']
+
+
+def make_app():
+    app = web.Application(middlewares=[
+        logger_factory, auth_factory, response_factory
+    ])
+    blog_app.init_jinja2(app, filters=dict(datetime=blog_app.datetime_filter),
+                         auto_reload=False)
+    add_routes(app, 'handlers')
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def client(session, url, n):
+    for _ in range(n):
+        async with session.get(url) as resp:
+            await resp.read()
+            assert resp.status == 200, (url, resp.status)
+
+
+async def bench(impl, n, concurrency):
+    options = dict(config.configs.server.to_dict(), host='127.0.0.1',
+                   port=free_port(), workers=1)
+    options = types.SimpleNamespace(**options)
+    start = time.perf_counter()
+    runner = await server.start(make_app(), options)
+    print('{:<8} {:<36} {:>8.2f} ms'.format(
+        impl, 'startup', (time.perf_counter() - start) * 1e3))
+    base = 'http://127.0.0.1:{}'.format(options.port)
+    try:
+        async with aiohttp.ClientSession() as session:
+            for path in PATHS:
+                await client(session, base + path, 10)
+                start = time.perf_counter()
+                await asyncio.gather(*(
+                    client(session, base + path, n // concurrency)
+                    for _ in range(concurrency)))
+                elapsed = time.perf_counter() - start
+                print('{:<8} {:<36} {:>8.0f} req/s'.format(
+                    impl, path, n // concurrency * concurrency / elapsed))
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=2000)
+    parser.add_argument('-c', type=int, default=20)
+    opts = parser.parse_args()
+    # 每个请求的INFO日志会淹没结果
+    logging.getLogger().setLevel(logging.WARNING)
+    for use_uvloop in (False, True):
+        loop, impl = server.new_event_loop(use_uvloop)
+        if use_uvloop and impl != 'uvloop':
+            print('uvloop not installed, skipped')
+            loop.close()
+            continue
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(bench(impl, opts.n, opts.c))
+        finally:
+            loop.close()
+
+
+if __name__ == '__main__':
+    main()
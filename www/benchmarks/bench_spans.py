@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    span gamut吞吐量: 逐个regex pass vs 单遍扫描(fast_spans=True)
+    含强调/链接的段落会退回regex pass，单独统计这部分的额外开销。
+
+    usage: python3 benchmarks/bench_spans.py [-n 20000]
+'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown2
+
+
+# 单遍扫描能处理的段落: 纯文本、行内代码、转义、实体、尖括号、强制换行
+PLAIN = [
+    '这篇文章记录一下把博客从同步框架迁移到aiohttp的过程，顺便整理踩过的坑。',
+    '调用 `loop.run_until_complete(init(loop))` 之后再 `run_forever()`，'
+    '注意 `init` 里不能阻塞。',
+    '条件写成 a < b && b > c 时，markdown会把 < 和 > 转成实体，'
+    '而 &amp; 和 &#123; 原样保留。',
+    '路径里的反斜杠要转义: \\\\server\\\\share，\\*不是强调\\*。  \n'
+    '这里是强制换行之后的一行。',
+    'Python 3.5 introduced `async def` and `await`; the old '
+    '`@asyncio.coroutine` decorator still works for now.',
+]
+
+# 会退回regex pass的段落
+FALLBACK = [
+    '这里有*强调*和**加粗**。',
+    '参考 [aiohttp文档](https://docs.aiohttp.org/) 里的 AppRunner 一节。',
+    '自动链接 <https://github.com/> 和 <b>行内HTML</b>。',
+]
+
+
+def bench(name, paras, fast, n, repeat=3):
+    md = markdown2.Markdown(fast_spans=fast)
+    elapsed = None
+    for _ in range(repeat):
+        md.reset()
+        start = time.perf_counter()
+        for i in range(n):
+            md._run_span_gamut(paras[i % len(paras)])
+        t = time.perf_counter() - start
+        elapsed = t if elapsed is None else min(elapsed, t)
+    print('{:<32} {:>10.0f} spans/s  {:>8.2f} us/span'.format(
+        name, n / elapsed, elapsed / n * 1e6))
+    return elapsed
+
+
+def bench_post(n):
+    '''
+        整篇corpus/post_zh.md的渲染时间
+    '''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'corpus', 'post_zh.md')
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    for fast in (False, True):
+        md = markdown2.Markdown(fast_spans=fast)
+        start = time.perf_counter()
+        for _ in range(n):
+            md.convert(text)
+        elapsed = time.perf_counter() - start
+        print('{:<32} {:>8.2f} ms/doc'.format(
+            'post_zh.md fast_spans={}'.format(fast), elapsed / n * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000)
+    opts = parser.parse_args()
+    for para in PLAIN + FALLBACK:
+        assert markdown2.Markdown(fast_spans=True).convert(para) == \
+            markdown2.Markdown().convert(para)
+    slow = bench('plain, regex passes', PLAIN, False, opts.n)
+    fast = bench('plain, single pass', PLAIN, True, opts.n)
+    print('{:<32} {:>10.2f}x'.format('speedup', slow / fast))
+    bench('fallback, regex passes', FALLBACK, False, opts.n)
+    bench('fallback, scan then regex', FALLBACK, True, opts.n)
+    bench_post(max(opts.n // 100, 10))
+
+
+if __name__ == '__main__':
+    main()
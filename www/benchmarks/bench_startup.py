@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    worker启动开销
+
+    1. 在子进程里用python -X importtime导入app，按累计时间列出最慢的模块，
+       并单独测markdown2的导入时间(延迟导入后启动时不再付这部分)
+    2. 注册路由: 扫描handlers + inspect.signature vs 读取缓存的路由清单
+
+    usage: python3 benchmarks/bench_startup.py [-t 15] [-n 200]
+'''
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+WWW = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WWW)
+
+
+def importtime(stmt):
+    '''
+        返回[(cumulative_us, self_us, module)]，按累计时间倒序
+    '''
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', stmt],
+                       cwd=WWW, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                       universal_newlines=True, check=True)
+    rows = []
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        rows.append((cumulative_us, self_us, fields[2].rstrip()))
+    return sorted(rows, reverse=True)
+
+
+def report_imports(top):
+    rows = importtime('import app')
+    print('import app: {:.1f} ms total'.format(rows[0][0] / 1e3))
+    print('{:>12} {:>12}  {}'.format('cumulative', 'self', 'module'))
+    for cumulative_us, self_us, name in rows[:top]:
+        print('{:>9.1f} ms {:>9.1f} ms  {}'.format(
+            cumulative_us / 1e3, self_us / 1e3, name))
+    loaded = [r for r in rows if r[2].strip() == 'markdown2']
+    md = importtime('import markdown2')
+    md = [r for r in md if r[2].strip() == 'markdown2'][0][0]
+    print('markdown2 import: {:.1f} ms ({} at startup)'.format(
+        md / 1e3, 'still loaded' if loaded else 'deferred'))
+
+
+def bench_routes(n):
+    import handlers
+    import web_frame
+    for name, fn in [
+            ('scan + inspect.signature',
+             lambda: web_frame.scan_routes(handlers)),
+            ('cached manifest',
+             lambda: web_frame.load_manifest(handlers))]:
+        web_frame.save_manifest(handlers, web_frame.scan_routes(handlers))
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        elapsed = time.perf_counter() - start
+        print('{:<32} {:>8.3f} ms'.format(name, elapsed / n * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', type=int, default=15)
+    parser.add_argument('-n', type=int, default=200)
+    opts = parser.parse_args()
+    report_imports(opts.t)
+    bench_routes(opts.n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    基准测试用的固定数据: 按种子生成用户、文章、评论的数据库行(dict)，
+    以及small/medium/huge三档markdown文档
+'''
+
+import os
+import random
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+_WORDS = ['异步', '协程', '数据库', '连接池', '模板', '渲染', '缓存', '索引',
+          'aiohttp', 'asyncio', 'jinja2', 'markdown', 'mysql', 'python']
+
+
+def corpus(name):
+    with open(os.path.join(CORPUS, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def documents():
+    '''
+        [(name, markdown文本)]: 一条评论大小、一篇普通文章、放大的长文
+    '''
+    post = corpus('post_zh.md')
+    return [
+        ('small', '写得不错，*赞*一个。请问 `asyncio.get_event_loop()` '
+                  '在3.10之后还能用吗？'),
+        ('medium', post + '\n\n' + corpus('spans.md')),
+        ('huge', (post + '\n\n') * 100),
+    ]
+
+
+def _sentence(rnd, n):
+    return ''.join(rnd.choice(_WORDS) for _ in range(n))
+
+
+def user_rows(n=10, seed=1):
+    return [dict(id='u{:04d}'.format(i), email='u{}@example.com'.format(i),
+                 passwd='0' * 40, admin=(i == 0), name='user{}'.format(i),
+                 image='about:blank', created_at=1.5e9 + i)
+            for i in range(n)]
+
+
+def blog_rows(n=200, seed=2):
+    '''
+        派生字段用derive.derive_blog真实计算一次
+    '''
+    from models import Blog
+    from derive import derive_blog
+    rnd = random.Random(seed)
+    post = corpus('post_zh.md')
+    rows = []
+    for i in range(n):
+        blog = Blog(id='b{:06d}'.format(i), user_id='u0000',
+                    user_name='user0', user_image='about:blank',
+                    name=_sentence(rnd, 3), summary=_sentence(rnd, 12),
+                    content=post + '\n\n' + _sentence(rnd, 40),
+                    created_at=1.5e9 + i * 3600)
+        derive_blog(blog)
+        rows.append(dict(blog))
+    return rows
+
+
+def comment_rows(blogs, per_blog=30, seed=3):
+    from comments import text2html
+    rnd = random.Random(seed)
+    rows = []
+    for b in blogs:
+        for j in range(per_blog):
+            content = _sentence(rnd, 10)
+            rows.append(dict(
+                id='{}c{:04d}'.format(b['id'], j), blog_id=b['id'],
+                user_id='u{:04d}'.format(j % 10),
+                user_name='user{}'.format(j % 10), user_image='about:blank',
+                content=content, html_content=text2html(content),
+                created_at=b['created_at'] + j * 60))
+    return rows
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    端到端吞吐: 完整的中间件、handlers、后台组件(feed/comments/search/
+    syndication)跑在真实的aiohttp服务上，数据库用内存后端(memdb)，
+    --db-latency给每次查询加上延迟。
+    客户端和服务端在同一个事件循环里，数字用于前后对比。
+'''
+
+import os
+import types
+import socket
+import asyncio
+import tempfile
+import aiohttp
+from aiohttp import web
+import orm
+import app as blog_app
+import comments
+import feed
+import search
+import server
+import syndication
+from config import configs
+from middlewares import logger_factory, timing_factory, auth_factory, \
+    response_factory
+from web_frame import add_routes
+from benchmarks import scaled
+from benchmarks import fixtures
+
+
+CONCURRENCY = 10
+
+
+def paths(blog_id):
+    return ['/', '/blog/' + blog_id, '/api/blogs?page=1',
+            '/api/blogs/{}/comments'.format(blog_id),
+            '/api/search?q=%E5%BC%82%E6%AD%A5%E7%BC%96%E7%A8%8B', '/rss.xml']
+
+
+def make_app(tmp):
+    app = web.Application(middlewares=[
+        logger_factory, timing_factory, auth_factory, response_factory])
+    comments.setup(app, **configs.comments)
+    feed.setup(app, **configs.feed)
+    search.setup(app, path=os.path.join(tmp, 'search.idx'),
+                 refresh_interval=0, rebuild_interval=0)
+    syndication.setup(app, **dict(configs.syndication.items(),
+                                  refresh_interval=0))
+    blog_app.init_jinja2(app, filters=dict(datetime=blog_app.datetime_filter),
+                         auto_reload=False)
+    add_routes(app, 'handlers', use_manifest=False)
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def client(session, url, n):
+    for _ in range(n):
+        async with session.get(url) as resp:
+            await resp.read()
+            if resp.status != 200:
+                raise RuntimeError('{} -> {}'.format(url, resp.status))
+
+
+async def bench(report, scale, db, blog_id):
+    options = types.SimpleNamespace(**dict(
+        configs.server.items(), host='127.0.0.1', port=free_port(),
+        workers=1, access_log=False))
+    with tempfile.TemporaryDirectory() as tmp:
+        runner = await server.start(make_app(tmp), options)
+        base = 'http://127.0.0.1:{}'.format(options.port)
+        n = scaled(1000, scale) // CONCURRENCY
+        try:
+            async with aiohttp.ClientSession() as session:
+                for path in paths(blog_id):
+                    await client(session, base + path, 5)
+                    queries = db.queries
+                    loop = asyncio.get_event_loop()
+                    start = loop.time()
+                    await asyncio.gather(*(client(session, base + path, n)
+                                           for _ in range(CONCURRENCY)))
+                    elapsed = loop.time() - start
+                    total = n * CONCURRENCY
+                    report.add('e2e', 'GET ' + path, elapsed / total,
+                               unit='req', queries_per_req=(
+                                   db.queries - queries) / total)
+        finally:
+            await runner.cleanup()
+
+
+def run(report, scale):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        db = loop.run_until_complete(orm.create_pool(
+            backend='memory', latency=report.options.get('db_latency', 0)))
+        blogs = fixtures.blog_rows(200)
+        db.load('users', fixtures.user_rows())
+        db.load('blogs', blogs)
+        db.load('comments', fixtures.comment_rows(blogs, 10))
+        loop.run_until_complete(bench(report, scale, db, blogs[0]['id']))
+    finally:
+        loop.run_until_complete(orm.close_pool())
+        loop.close()
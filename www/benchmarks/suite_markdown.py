@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    markdown2.markdown在small/medium/huge三档文档上的耗时:
+    默认参数，以及文章页实际用的参数(toc + fast_spans，不设渲染预算，
+    否则huge会被预算截断)
+'''
+
+import markdown2
+import derive
+from benchmarks import measure, scaled
+from benchmarks import fixtures
+
+
+ITERATIONS = {'small': 5000, 'medium': 200, 'huge': 5}
+
+
+def run(report, scale):
+    options = derive.markdown_options(max_time=None, max_size=None)
+    for name, text in fixtures.documents():
+        n = scaled(ITERATIONS[name], scale)
+        for label, kw in [('default', {}), ('blog options', options)]:
+            report.add('markdown', '{} ({} chars), {}'.format(
+                name, len(text), label),
+                measure(lambda: markdown2.markdown(text, **kw), n,
+                        repeat=3), unit='doc')
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    orm: Model构造、字段读取、SQL生成(类定义时和每次查询时)、多行insert拼参数
+
+    select/execute换成不等待的桩函数，协程send一次就结束，
+    测到的只有orm自身的开销。除了专门测命中的一项，实体缓存关闭
+'''
+
+import orm
+from orm import Model, StringField, FloatField, TextField, BooleanField
+from models import Blog, Comment
+from benchmarks import measure, scaled
+from benchmarks import fixtures
+
+
+def drive(coro):
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError('coroutine suspended, stub awaited something')
+
+
+def define_model():
+    return type('Bench', (Model,), dict(
+        __table__='bench',
+        id=StringField(primary_key=True, column_type='varchar(50)'),
+        name=StringField(), flag=BooleanField(), body=TextField(),
+        created_at=FloatField()))
+
+
+def run(report, scale):
+    blog_rows = fixtures.blog_rows(100)
+    comment_rows = fixtures.comment_rows(blog_rows[:1], per_blog=200)
+    row = blog_rows[0]
+    blog = Blog(**row)
+    comments = [Comment(**r) for r in comment_rows]
+    rows = {'select': blog_rows}
+
+    async def select(sql, args, size=None):
+        return rows['select'][:size] if size else rows['select']
+
+    async def execute(sql, args):
+        # 多行insert每行一个(?, ...)
+        return sql.count('(?') or 1
+
+    saved = orm.select, orm.execute
+    orm.select, orm.execute = select, execute
+    orm_listeners = orm._listeners
+    orm._listeners = {}
+    cache_enabled = orm.entity_cache.enabled
+    orm.entity_cache.enabled = False
+    try:
+        for name, fn, n in [
+                ('Blog(**row)', lambda: Blog(**row), 50000),
+                ('attribute access x10',
+                 lambda: [blog.name for _ in range(10)], 50000),
+                ('getValueOrDefault all fields',
+                 lambda: list(map(blog.getValueOrDefault,
+                                  Blog.__fields__)), 50000),
+                ('define Model class (SQL generation)', define_model, 2000),
+                ('findAll SQL build, 1 row',
+                 lambda: drive(Blog.findAll(
+                     '`user_id`=?', ['u0000'], orderBy='created_at desc',
+                     limit=(0, 1))), 20000),
+                ('find by primary key', lambda: drive(Blog.find('b0')),
+                 20000),
+                ('save_all 200 comments (SQL + args)',
+                 lambda: drive(Comment.save_all(comments)), 500)]:
+            if name.startswith('find'):
+                rows['select'] = blog_rows[:1]
+            report.add('orm', name, measure(fn, scaled(n, scale)))
+        orm.entity_cache.enabled = True
+        orm.entity_cache.clear()
+        report.add('orm', 'find by primary key (entity cache hit)', measure(
+            lambda: drive(Blog.find('b0')), scaled(20000, scale)))
+        rows['select'] = blog_rows
+        report.add('orm', 'findAll 100 rows -> models', measure(
+            lambda: drive(Blog.findAll()), scaled(2000, scale)))
+    finally:
+        orm.select, orm.execute = saved
+        orm._listeners = orm_listeners
+        orm.entity_cache.enabled = cache_enabled
+        orm.entity_cache.clear()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    web_frame: RequestHandler构造(参数分析)和每次请求的参数绑定
+    (query string解析、match_info合并、必填参数检查)
+'''
+
+from web_frame import RequestHandler, get, analyze_args, scan_routes
+import handlers
+from benchmarks import measure, scaled
+from benchmarks.suite_orm import drive
+
+
+class FakeRequest(object):
+
+    def __init__(self, method='GET', query_string='', match_info=None):
+        self.method = method
+        self.query_string = query_string
+        self.match_info = match_info or {}
+        self.content_type = ''
+
+
+@get('/api/blogs/{id}/comments')
+async def endpoint(request, *, id, cursor='', limit=''):
+    return id
+
+
+def run(report, scale):
+    handler = RequestHandler(None, endpoint)
+    with_query = FakeRequest(query_string='cursor=1500000000.0_b1&limit=20',
+                             match_info={'id': 'b000001'})
+    no_query = FakeRequest(match_info={'id': 'b000001'})
+    for name, f, n in [
+            ('analyze_args', lambda: analyze_args(endpoint), 20000),
+            ('RequestHandler()', lambda: RequestHandler(None, endpoint), 20000),
+            ('scan handlers module', lambda: scan_routes(handlers), 200),
+            ('bind match_info only', lambda: drive(handler(no_query)),
+             50000),
+            ('bind query string + match_info',
+             lambda: drive(handler(with_query)), 50000)]:
+        report.add('routing', name, measure(f, scaled(n, scale)))
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Jinja2页面渲染: 首页(10篇摘要)和文章页(正文 + 20条评论)，
+    模板环境和线上一样由app.init_jinja2创建
+'''
+
+import app as blog_app
+from models import Blog, Comment
+from benchmarks import measure, scaled
+from benchmarks import fixtures
+
+
+def run(report, scale):
+    env = {}
+    blog_app.init_jinja2(env, filters=dict(datetime=blog_app.datetime_filter),
+                         auto_reload=False)
+    env = env['__templating__']
+    rows = fixtures.blog_rows(10)
+    blogs = [Blog(**r) for r in rows]
+    blog = Blog(**rows[0])
+    blog.html_content = blog.summary_html * 20
+    comments = [Comment(**r) for r in fixtures.comment_rows(rows[:1], 20)]
+    pages = [
+        ('blogs.html', dict(blogs=blogs)),
+        ('blog.html', dict(blog=blog, comments=comments, comment_count=20,
+                           next_cursor='1500000000.0_b1')),
+    ]
+    for template, kw in pages:
+        t = env.get_template(template)
+        report.add('templates', template, measure(
+            lambda: t.render(**kw).encode('utf-8'), scaled(2000, scale)),
+            unit='page')
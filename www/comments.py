@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    评论的write-behind写入
+
+    评论的HTML在发表时渲染一次存进html_content，查看时不再转换。
+
+    发表评论只是放进队列就返回，后台任务每隔flush_interval秒把队列里的评论
+    合并成一条多行insert写库。队列满时put最多等put_timeout秒，
+    仍然放不进去就返回server:busy，让客户端稍后重试。
+
+    每篇文章在内存里保留最近的tail_size条评论(含还没写库的)，
+    读评论时合并进查询结果，发评论的人刷新后立刻能看到自己的评论。
+    tail是进程内的，多worker时其他进程要等写库后才能读到。
+
+    评论按(created_at, id)倒序分页: 文章页内联第一页，之后的页通过
+    /api/blogs/{id}/comments?cursor=...按游标读取。游标是上一页最后一条的
+    created_at和id，翻页走(blog_id, created_at)索引，不用offset；
+    列表查询不读原始的content列。
+'''
+
+import html
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from orm import create_args_string, is_duplicate_key
+from apis import APIBusyError, APIValueError
+from models import Comment
+
+
+# 列表展示需要的列，不含原始的content
+LIST_COLUMNS = [f for f in Comment.__fields__ if f != 'content']
+
+
+def text2html(text):
+    '''
+        评论纯文本转HTML: 整段escape一次，每个非空行一个<p>
+    '''
+    lines = [s for s in html.escape(text, quote=False).split('\n')
+             if s.strip()]
+    if not lines:
+        return ''
+    return '<p>' + '</p><p>'.join(lines) + '</p>'
+
+
+class CommentWriter(object):
+
+    def __init__(self, flush_interval=0.005, max_batch=200,
+                 max_pending=10000, put_timeout=1.0, tail_size=50,
+                 max_tails=1000, retries=3):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.tail_size = tail_size
+        self.max_tails = max_tails
+        self.retries = retries
+        self._queue = None
+        self._task = None
+        self._tails = OrderedDict()
+        # blog_id -> 已入队还没写库的评论数
+        self._unflushed = {}
+        # 统计
+        self.batches = 0
+        self.flushed = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    @property
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.ensure_future(self._run(self._queue))
+
+    async def stop(self):
+        '''
+            放入结束标记，等后台任务把它之前的评论全部写完。
+            shutdown之后aiohttp还会跑完进行中的请求: 先摘下队列，之后的put
+            直接写库；已经在等队列空位的put可能排到结束标记后面，
+            任务结束后再把队列里剩下的写掉
+        '''
+        if self._task is None:
+            return
+        queue, self._queue = self._queue, None
+        await queue.put(None)
+        await self._task
+        self._task = None
+        while not queue.empty():
+            batch = []
+            while not queue.empty() and len(batch) < self.max_batch:
+                batch.append(queue.get_nowait())
+            await self._flush(batch)
+
+    async def put(self, comment):
+        '''
+            渲染好html_content、填好id和created_at等默认值后入队，
+            并追加到文章的tail
+        '''
+        comment.html_content = text2html(comment.content)
+        for key in [comment.__primary_key__] + comment.__fields__:
+            comment.getValueOrDefault(key)
+        queue = self._queue
+        if queue is None:
+            await comment.save()
+        else:
+            try:
+                queue.put_nowait(comment)
+            except asyncio.QueueFull:
+                try:
+                    await asyncio.wait_for(queue.put(comment),
+                                           self.put_timeout)
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    raise APIBusyError('content',
+                                       'Too many comments, retry later.')
+            self._unflushed[comment.blog_id] = \
+                self._unflushed.get(comment.blog_id, 0) + 1
+        self._append_tail(comment)
+        return comment
+
+    def unflushed(self, blog_id):
+        return self._unflushed.get(blog_id, 0)
+
+    def _flushed(self, comments):
+        for c in comments:
+            n = self._unflushed.get(c.blog_id, 0) - 1
+            if n > 0:
+                self._unflushed[c.blog_id] = n
+            else:
+                self._unflushed.pop(c.blog_id, None)
+
+    def _append_tail(self, comment):
+        tail = self._tails.get(comment.blog_id)
+        if tail is None:
+            tail = self._tails[comment.blog_id] = deque(maxlen=self.tail_size)
+            if len(self._tails) > self.max_tails:
+                self._tails.popitem(last=False)
+        else:
+            self._tails.move_to_end(comment.blog_id)
+        tail.append(comment)
+
+    def merge_tail(self, blog_id, comments):
+        '''
+            把tail里查询结果中没有的评论合并进去，按created_at倒序
+        '''
+        tail = self._tails.get(blog_id)
+        if not tail:
+            return comments
+        ids = set(c.id for c in comments)
+        extra = [c for c in tail if c.id not in ids]
+        if not extra:
+            return comments
+        return sorted(extra + list(comments), key=_order_key, reverse=True)
+
+    async def _run(self, queue):
+        while True:
+            batch = [await queue.get()]
+            if batch[0] is not None and self.flush_interval:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            comments = [c for c in batch if c is not None]
+            if comments:
+                await self._flush(comments)
+            if len(comments) < len(batch):
+                return
+
+    async def _flush(self, comments):
+        '''
+            整批写入，重试后仍失败时逐条写一遍(整批已经按退避重试过，
+            逐条不再重试)，只丢弃单独写也失败的评论。
+            主键冲突说明这条已经写进去了(比如上次提交成功但没收到结果)，算成功
+        '''
+        if await self._write(comments, self.retries):
+            self.batches += 1
+            self._done(comments)
+            return
+        failed = []
+        for c in comments:
+            if await self._write([c], 0):
+                self._done([c])
+            else:
+                failed.append(c)
+        if not failed:
+            return
+        logging.error('dropped {} comments: {}'.format(
+            len(failed), [c.id for c in failed]))
+        self.dropped += len(failed)
+        self._flushed(failed)
+        for c in failed:
+            tail = self._tails.get(c.blog_id)
+            if tail is not None and c in tail:
+                tail.remove(c)
+
+    async def _write(self, comments, retries):
+        '''
+            写入成功返回True。多行insert遇到主键冲突直接返回False，
+            交给逐条写入区分哪些已经存在
+        '''
+        delay = 0.1
+        for attempt in range(retries + 1):
+            try:
+                await Comment.save_all(comments)
+                return True
+            except Exception as e:
+                if is_duplicate_key(e):
+                    if len(comments) == 1:
+                        logging.info('comment {} already written'
+                                     .format(comments[0].id))
+                        return True
+                    logging.warning('write {} comments: duplicate key: {}'
+                                    .format(len(comments), e))
+                    return False
+                logging.warning('write {} comments failed: {}'
+                                .format(len(comments), e))
+                if attempt < retries:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+        return False
+
+    def _done(self, comments):
+        self.flushed += len(comments)
+        self._flushed(comments)
+
+
+writer = CommentWriter()
+
+
+def _order_key(c):
+    return (c.created_at, c.id)
+
+
+def encode_cursor(comment):
+    return '{!r}_{}'.format(comment.created_at, comment.id)
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, id = cursor.split('_', 1)
+        return float(created_at), id
+    except ValueError:
+        raise APIValueError('cursor', 'invalid cursor.')
+
+
+async def count(blog_id):
+    '''
+        评论总数: 只扫(blog_id, created_at)索引，加上还没写库的
+    '''
+    n = await Comment.find_number('count(*)', '`blog_id`=?', [blog_id])
+    return (n or 0) + writer.unflushed(blog_id)
+
+
+async def page(blog_id, cursor=None, limit=20):
+    '''
+        读一页评论，返回(comments, next_cursor)，没有下一页时next_cursor为None。
+        第一页会合并tail，刚发表的评论立刻可见。
+    '''
+    where, args = '`blog_id`=?', [blog_id]
+    if cursor:
+        created_at, id = decode_cursor(cursor)
+        where += ' and (`created_at`<? or (`created_at`=? and `id`<?))'
+        args += [created_at, created_at, id]
+    rs = await Comment.findAll(where, args, columns=LIST_COLUMNS,
+                               orderBy='`created_at` desc, `id` desc',
+                               limit=limit + 1)
+    if not cursor:
+        rs = writer.merge_tail(blog_id, rs)
+    comments = rs[:limit]
+    next_cursor = encode_cursor(comments[-1]) if len(rs) > limit else None
+    await _render_legacy(comments)
+    return comments, next_cursor
+
+
+async def _render_legacy(comments):
+    '''
+        加html_content列之前写入的评论没有HTML，只为本页的这些评论读content
+    '''
+    legacy = [c for c in comments if not c.html_content]
+    if not legacy:
+        return
+    rs = await Comment.findAll('`id` in ({})'.format(
+        create_args_string(len(legacy))), [c.id for c in legacy],
+        columns=['content'])
+    contents = dict((r.id, r.content) for r in rs)
+    for c in legacy:
+        c.html_content = text2html(contents.get(c.id, ''))
+
+
+def setup(app, page_size=None, **kw):
+    '''
+        startup时启动写入任务；shutdown时(在cleanup关闭连接池之前)把队列写完。
+        page_size由handlers每次请求时从config读取。
+    '''
+    global writer
+    writer = CommentWriter(**kw)
+
+    async def on_startup(app):
+        writer.start()
+
+    async def on_shutdown(app):
+        await writer.stop()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
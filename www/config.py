@@ -3,50 +3,254 @@
 
 '''
     config
+
+    加载顺序: config_default -> config_override -> 环境变量。
+    环境变量以BLOG_开头，层级用双下划线分隔，例如:
+        BLOG_DB__MAXSIZE=40 BLOG_SERVER__WORKERS=4 python3 app.py
+    值会按config_default中同名项的类型转换，合并后做校验，
+    最终编译成只读的Frozen对象树，收到SIGHUP时整体替换(见reload)。
+    workers > 1时向父进程发SIGHUP即可，父进程会转发给各worker。
 '''
 
+import os
+import signal
+import logging
+import importlib
 import config_default
 
 
-class Dict(dict):
+ENV_PREFIX = 'BLOG_'
+MAX_PAGE_SIZE = 100
+
+
+class Frozen(object):
     '''
-        dict support x.y style
+        编译后的只读配置节点。每个节点是按key动态生成的带__slots__的类，
+        取值就是普通的属性访问；同时支持 **node 和 node['key']。
     '''
+    __slots__ = ()
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+    def __setattr__(self, key, value):
+        raise TypeError('configs is read only')
+
+    __delattr__ = __setattr__
 
-    def __getattr__(self, key):
+    def __getitem__(self, key):
         try:
-            return self[key]
-        except KeyError:
-            raise AttributeError('Dict object has no attribute {}'.format(key))
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
 
-    def __setattr__(self, key, value):
-        self[key] = value
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def keys(self):
+        return self.__slots__
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__slots__]
+
+    def to_dict(self):
+        return {k: v.to_dict() if isinstance(v, Frozen) else v
+                for k, v in self.items()}
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(k, v) for k, v in self.items()))
 
 
 def merge(target, source):
     res = dict(**target)
     for k, v in source.items():
         if isinstance(v, dict):
-            res[k] = merge(res[k], v)
+            res[k] = merge(res.get(k, {}), v)
         else:
             res[k] = v
     return res
 
 
-def toDict(d):
-    D = Dict()
+def _parse_env_value(key, raw, default):
+    if isinstance(default, bool):
+        if raw.lower() in ('1', 'true', 'yes', 'on'):
+            return True
+        if raw.lower() in ('0', 'false', 'no', 'off'):
+            return False
+        raise ValueError('{}: invalid boolean {!r}'.format(key, raw))
+    if isinstance(default, (int, float)):
+        try:
+            return type(default)(raw)
+        except ValueError:
+            raise ValueError('{}: invalid {} {!r}'.format(
+                key, type(default).__name__, raw))
+    return raw
+
+
+def from_env(defaults, environ=None, prefix=ENV_PREFIX):
+    '''
+        从环境变量中读取覆盖项，只接受config_default中已有的key
+    '''
+    environ = os.environ if environ is None else environ
+    res = {}
+    for name, raw in environ.items():
+        if not name.startswith(prefix):
+            continue
+        path = name[len(prefix):].lower().split('__')
+        node, target = defaults, res
+        for k in path[:-1]:
+            node = node.get(k) if isinstance(node, dict) else None
+            target = target.setdefault(k, {})
+        if not isinstance(node, dict) or path[-1] not in node \
+                or isinstance(node[path[-1]], dict):
+            raise ValueError('unknown config from environment: {}'.format(name))
+        target[path[-1]] = _parse_env_value(name, raw, node[path[-1]])
+    return res
+
+
+def validate(configs, defaults, path=''):
+    '''
+        校验类型与config_default一致，并检查各项取值范围
+    '''
+    for k in configs:
+        # key会成为Frozen节点的属性，不能覆盖keys/items/to_dict等方法
+        if not k.isidentifier() or hasattr(Frozen, k):
+            raise ValueError('invalid config name: {}{}'.format(path, k))
+    for k, default in defaults.items():
+        key = path + k
+        if k not in configs:
+            raise ValueError('missing config: {}'.format(key))
+        v = configs[k]
+        if isinstance(default, dict):
+            validate(v, default, key + '.')
+        elif isinstance(default, bool):
+            if not isinstance(v, bool):
+                raise ValueError('{} must be bool'.format(key))
+        elif isinstance(default, float):
+            if not isinstance(v, (int, float)) or isinstance(v, bool):
+                raise ValueError('{} must be number'.format(key))
+        elif default is not None and not isinstance(v, type(default)):
+            raise ValueError('{} must be {}'.format(
+                key, type(default).__name__))
+    if path:
+        return
+    db = configs['db']
+    if not 0 <= db['minsize'] <= db['maxsize'] or db['maxsize'] < 1:
+        raise ValueError('db pool size must satisfy 0 <= minsize <= maxsize')
+    if db['backend'] not in ('mysql', 'memory', 'sqlite') or \
+            db['latency'] < 0:
+        raise ValueError('db.backend must be mysql, memory or sqlite, '
+                         'latency >= 0')
+    if db['sqlite_readers'] < 1:
+        raise ValueError('db.sqlite_readers must be >= 1')
+    if configs['entity_cache']['max_bytes'] < 0:
+        raise ValueError('entity_cache.max_bytes must be >= 0')
+    server = configs['server']
+    if server['workers'] < 1:
+        raise ValueError('server.workers must be >= 1')
+    if server['backlog'] < 1 or server['keepalive_timeout'] < 0 or \
+            server['shutdown_timeout'] < 0 or \
+            server['max_line_size'] < 1 or server['max_field_size'] < 1:
+        raise ValueError('invalid server settings')
+    if configs['template']['cache_size'] < -1:
+        raise ValueError('template.cache_size must be >= -1')
+    if configs['markdown']['max_time'] <= 0 or \
+            configs['markdown']['max_size'] < 1:
+        raise ValueError('markdown render budget must be positive')
+    c = configs['comments']
+    if c['flush_interval'] < 0 or c['put_timeout'] < 0 or \
+            c['max_batch'] < 1 or c['max_pending'] < 1 or \
+            c['tail_size'] < 0 or not 1 <= c['page_size'] <= MAX_PAGE_SIZE:
+        raise ValueError('invalid comments write-behind settings')
+    f = configs['feed']
+    if not 1 <= f['page_size'] <= f['size'] or f['refresh_interval'] < 0:
+        raise ValueError('feed must satisfy 1 <= page_size <= size')
+    s = configs['search']
+    if not s['path'] or s['refresh_interval'] < 0 or \
+            s['rebuild_interval'] < 0 or \
+            not 1 <= s['max_results'] <= MAX_PAGE_SIZE:
+        raise ValueError('invalid search index settings')
+    s = configs['syndication']
+    if not s['base_url'] or s['feed_items'] < 1 or \
+            s['refresh_interval'] < 0 or s['debounce'] < 0 or \
+            s['chunk_size'] < 1:
+        raise ValueError('invalid syndication settings')
+    p = configs['profiling']
+    if p['sample_every'] < 0 or p['interval'] <= 0 or not p['output_dir']:
+        raise ValueError('invalid profiling settings')
+    if not isinstance(logging.getLevelName(configs['logging']['level']), int):
+        raise ValueError('logging.level is not a valid level name')
+
+
+def freeze(d, name='configs'):
+    '''
+        把合并后的dict编译成Frozen对象树
+    '''
+    cls = type(name, (Frozen,), {'__slots__': tuple(d.keys())})
+    node = cls()
     for k, v in d.items():
-        D[k] = toDict(v) if isinstance(v, dict) else v
-    return D
+        if isinstance(v, dict):
+            v = freeze(v, '{}_{}'.format(name, k))
+        object.__setattr__(node, k, v)
+    return node
+
+
+def load(environ=None):
+    configs = config_default.configs
+    try:
+        import config_override
+        configs = merge(configs, importlib.reload(config_override).configs)
+    except ImportError:
+        pass
+    configs = merge(configs, from_env(config_default.configs, environ))
+    validate(configs, config_default.configs)
+    return freeze(configs)
+
+
+_listeners = []
+
+
+def add_reload_listener(fn):
+    '''
+        注册reload回调: fn(old_configs, new_configs)
+    '''
+    _listeners.append(fn)
+
+
+def reload(environ=None):
+    '''
+        重新加载config_override和环境变量，校验通过后整体替换configs。
+        替换只是一次模块属性赋值，读取方应通过config.configs访问以拿到新值。
+        校验失败时保留旧配置。
+    '''
+    global configs
+    try:
+        new = load(environ)
+    except Exception as e:
+        logging.error('reload configs failed, keep current: {}'.format(e))
+        return configs
+    old, configs = configs, new
+    logging.info('configs reloaded')
+    for fn in _listeners:
+        fn(old, new)
+    return new
+
+
+def install_sighup_handler(loop, children=()):
+    '''
+        收到SIGHUP时reload配置，无需重启worker。
+        多worker时只需向父进程发SIGHUP，父进程转发给children
+    '''
+    def on_sighup():
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+        reload()
+
+    loop.add_signal_handler(signal.SIGHUP, on_sighup)
 
 
-configs = config_default.configs
-try:
-    import config_override
-    configs = merge(configs, config_override.configs)
-except ImportError:
-    pass
-configs = toDict(configs)
+configs = load()
@@ -7,14 +7,88 @@
 
 configs = {
     'debug': True,
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        'workers': 1,
+        'uvloop': True,
+        'backlog': 1024,
+        'keepalive_timeout': 75.0,
+        'shutdown_timeout': 10.0,
+        'max_line_size': 8190,
+        'max_field_size': 8190,
+        'access_log': False,
+        'access_log_format': '%a %t "%r" %s %b %Tf'
+    },
     'db': {
+        'backend': 'mysql',
+        'latency': 0.0,
+        'seed': '',
+        'sqlite_path': 'pure_blog.db',
+        'sqlite_readers': 4,
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'iamswf',
         'password': 'iamswf',
-        'db': 'pure_blog'
+        'db': 'pure_blog',
+        'minsize': 5,
+        'maxsize': 20,
+        'pool_recycle': 3600,
+        'keepalive': 60,
+        'connect_retries': 5
+    },
+    'template': {
+        'auto_reload': True,
+        'cache_size': 400
+    },
+    'logging': {
+        'level': 'INFO'
     },
     'session': {
         'secret': 'iamswf'
+    },
+    'markdown': {
+        'max_time': 0.5,
+        'max_size': 200000
+    },
+    'comments': {
+        'flush_interval': 0.005,
+        'max_batch': 200,
+        'max_pending': 10000,
+        'put_timeout': 1.0,
+        'tail_size': 50,
+        'page_size': 20
+    },
+    'feed': {
+        'size': 100,
+        'page_size': 10,
+        'refresh_interval': 60
+    },
+    'search': {
+        'path': 'search.idx',
+        'refresh_interval': 10,
+        'rebuild_interval': 600,
+        'max_results': 50
+    },
+    'syndication': {
+        'base_url': 'http://127.0.0.1:9000',
+        'title': "iamswf's blog",
+        'description': '',
+        'feed_items': 20,
+        'refresh_interval': 300,
+        'debounce': 1.0,
+        'chunk_size': 65536
+    },
+    'profiling': {
+        'server_timing': False,
+        'enabled': False,
+        'sample_every': 1000,
+        'header': 'X-Profile',
+        'interval': 0.001,
+        'output_dir': 'profiles'
+    },
+    'entity_cache': {
+        'enabled': True,
+        'max_bytes': 16777216
     }
 }
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    写入时派生字段
+
+    Blog保存/更新时根据summary和content生成:
+        summary_html    渲染后的摘要
+        excerpt         正文纯文本摘录
+        word_count      字数(中文按字、其他按词)
+        reading_time    预计阅读分钟数
+        toc_html        目录(markdown2的toc extra)
+    和正文存在同一行里，列表页直接读取，不需要再渲染正文。
+    写入时的渲染在线程池里执行，不受markdown.max_time限制(只限max_size)。
+
+    已有文章补齐派生字段: python3 derive.py
+'''
+
+import re
+import math
+import html
+import asyncio
+import logging
+import config
+from lazy import lazy_import
+from profiling import phase
+
+# 第一次渲染时才导入，worker启动时不付这部分开销
+markdown2 = lazy_import('markdown2')
+
+
+EXCERPT_LENGTH = 120
+CJK_PER_MINUTE = 400
+WORDS_PER_MINUTE = 200
+
+# 正文渲染参数，文章页(handlers.get_blog)也用这一组，
+# 这样toc_html里的锚点才能对上正文标题的id
+EXTRAS = ['toc']
+
+_RE_TAG = re.compile(r'<[^>]*>')
+_RE_SPACES = re.compile(r'\s+')
+_CJK = r'\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_RE_CJK = re.compile('[{}]'.format(_CJK))
+_RE_WORD = re.compile(r"[^\W{0}]+(?:'[^\W{0}]+)?".format(_CJK))
+
+
+def markdown_options(**kw):
+    budget = config.configs.markdown
+    options = dict(extras=EXTRAS, fast_spans=True,
+                   max_time=budget.max_time, max_size=budget.max_size)
+    options.update(kw)
+    return options
+
+
+def write_options(**kw):
+    '''
+        写入时的渲染参数: 不限时间，只限大小。
+        机器繁忙导致的超时不能让纯文本的降级结果被永久存下来
+    '''
+    return markdown_options(max_time=None, **kw)
+
+
+def html2text(s):
+    return _RE_SPACES.sub(' ', html.unescape(_RE_TAG.sub(' ', s))).strip()
+
+
+def excerpt(text, length=EXCERPT_LENGTH):
+    if len(text) <= length:
+        return text
+    return text[:length].rstrip() + '…'
+
+
+def count_words(text):
+    '''
+        中文每个字算一个，其他语言按词计
+    '''
+    return len(_RE_CJK.findall(text)), len(_RE_WORD.findall(text))
+
+
+def reading_time(cjk, words):
+    '''
+        预计阅读分钟数，至少1分钟
+    '''
+    return max(1, math.ceil(cjk / CJK_PER_MINUTE + words / WORDS_PER_MINUTE))
+
+
+# 派生步骤: fn(blog, content_html, text)，依次在保存前执行
+_derivers = []
+
+
+def deriver(fn):
+    _derivers.append(fn)
+    return fn
+
+
+@deriver
+def derive_summary(blog, content_html, text):
+    blog.summary_html = markdown2.markdown(
+        blog.summary or '', **write_options(extras=None))
+    blog.excerpt = excerpt(text)
+
+
+@deriver
+def derive_counts(blog, content_html, text):
+    cjk, words = count_words(text)
+    blog.word_count = cjk + words
+    blog.reading_time = reading_time(cjk, words)
+
+
+@deriver
+def derive_toc(blog, content_html, text):
+    blog.toc_html = getattr(content_html, 'toc_html', None) or ''
+
+
+def derive_blog(blog):
+    '''
+        渲染一次正文，依次执行所有派生步骤，把结果写回blog
+    '''
+    with phase('markdown'):
+        content_html = markdown2.markdown(blog.content or '',
+                                          **write_options())
+        text = html2text(content_html)
+        for fn in _derivers:
+            fn(blog, content_html, text)
+    return blog
+
+
+async def derive_blog_async(blog):
+    '''
+        在线程池里执行derive_blog，长文渲染不阻塞事件循环。
+        线程里拿不到请求的计时，markdown阶段在这里记
+    '''
+    with phase('markdown'):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, derive_blog, blog)
+
+
+async def rebuild(batch_size=100):
+    '''
+        为已有文章补齐派生字段
+    '''
+    from models import Blog
+    offset, done = 0, 0
+    while True:
+        blogs = await Blog.findAll(orderBy='created_at',
+                                   limit=(offset, batch_size))
+        if not blogs:
+            break
+        for blog in blogs:
+            await blog.update()
+        offset += len(blogs)
+        done += len(blogs)
+        logging.info('derived fields rebuilt for {} blogs'.format(done))
+
+
+async def main_async(loop):
+    import orm
+    await orm.create_pool(loop=loop,
+                          **dict(config.configs.db.items(), keepalive=0))
+    try:
+        await rebuild()
+    finally:
+        await orm.close_pool()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main_async(loop))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    首页feed: 内存里按created_at倒序保存最新的size篇文章的摘要投影
+    (不含content)，首页直接从这里取，不查库。
+
+    启动时从库里加载；本进程里Blog的save/update/remove通过orm的listener
+    原地更新。多worker时别的进程写入的文章靠每refresh_interval秒一次的
+    后台重新加载同步过来。
+'''
+
+import bisect
+import asyncio
+import logging
+import orm
+from models import Blog
+
+
+# 首页需要的列
+SUMMARY_COLUMNS = ['user_id', 'user_name', 'user_image', 'name', 'summary',
+                   'summary_html', 'excerpt', 'word_count', 'reading_time',
+                   'created_at']
+
+
+def _key(blog):
+    return (blog.created_at, blog.id)
+
+
+def project(blog):
+    '''
+        只保留首页用到的字段
+    '''
+    p = Blog(id=blog.id)
+    for k in SUMMARY_COLUMNS:
+        p[k] = blog.get(k)
+    return p
+
+
+class Feed(object):
+    '''
+        有界的有序队列，_keys/_items按(created_at, id)升序，最新的在最后
+    '''
+
+    def __init__(self, size=100):
+        self.size = size
+        self._keys = []
+        self._items = []
+        # 曾经装满过，删除后需要从库里补
+        self._truncated = False
+        # 进行中的每个load各有一个列表，记录查询期间的修改:
+        # [(event, 投影或id)]，load用查询结果替换后再重放一遍
+        self._recording = []
+        # 删除后补齐的后台加载，同时只有一个；进行中又要补齐时结束后再来一次
+        self._reloading = None
+        self._reload_again = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def latest(self, n):
+        return self._items[:-n - 1:-1] if n > 0 else []
+
+    def replace(self, blogs):
+        blogs = sorted((project(b) for b in blogs), key=_key)[-self.size:]
+        self._keys = [_key(b) for b in blogs]
+        self._items = blogs
+        self._truncated = len(blogs) >= self.size
+
+    def _index(self, id):
+        for i, b in enumerate(self._items):
+            if b.id == id:
+                return i
+        return -1
+
+    def upsert(self, blog):
+        i = self._index(blog.id)
+        if i >= 0:
+            del self._keys[i], self._items[i]
+        key = _key(blog)
+        if len(self._items) >= self.size and key < self._keys[0]:
+            return
+        i = bisect.bisect(self._keys, key)
+        self._keys.insert(i, key)
+        self._items.insert(i, project(blog))
+        if len(self._items) > self.size:
+            del self._keys[0], self._items[0]
+            self._truncated = True
+
+    def remove(self, id):
+        i = self._index(id)
+        if i < 0:
+            return False
+        del self._keys[i], self._items[i]
+        return True
+
+    async def load(self):
+        '''
+            从库里重新加载。查询期间本进程的修改可能不在结果里，
+            替换后重放，不被旧的快照覆盖
+        '''
+        changes = []
+        self._recording.append(changes)
+        try:
+            blogs = await Blog.findAll(columns=SUMMARY_COLUMNS,
+                                       orderBy='created_at desc',
+                                       limit=self.size)
+        finally:
+            self._recording.remove(changes)
+        self.replace(blogs)
+        for event, v in changes:
+            if event == 'remove':
+                self.remove(v)
+            else:
+                self.upsert(v)
+        logging.info('feed loaded: {} blogs'.format(len(self)))
+
+    def on_change(self, blog, event):
+        for changes in self._recording:
+            changes.append((event, blog.id if event == 'remove'
+                            else project(blog)))
+        if event == 'remove':
+            if self.remove(blog.id) and self._truncated:
+                # 窗口外可能还有更早的文章，重新加载补齐
+                self.reload()
+        else:
+            self.upsert(blog)
+
+    def reload(self):
+        if self._reloading is not None:
+            self._reload_again = True
+            return
+        self._reloading = asyncio.ensure_future(self.load())
+        self._reloading.add_done_callback(self._reloaded)
+
+    def _reloaded(self, task):
+        self._reloading = None
+        again, self._reload_again = self._reload_again, False
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logging.warning('reload feed failed: {}'.format(task.exception()))
+        if again:
+            self.reload()
+
+
+feed = Feed()
+
+
+def latest(n):
+    return feed.latest(n)
+
+
+def setup(app, size=100, refresh_interval=60, page_size=None):
+    '''
+        startup时加载并注册listener；refresh_interval秒重新加载一次，0表示不刷新。
+        page_size由handlers每次请求时从config读取。
+    '''
+    global feed
+    feed = Feed(size)
+    task = None
+
+    async def refresh():
+        while True:
+            await asyncio.sleep(refresh_interval)
+            try:
+                await feed.load()
+            except Exception as e:
+                logging.warning('reload feed failed: {}'.format(e))
+
+    async def on_startup(app):
+        nonlocal task
+        await feed.load()
+        orm.add_listener(Blog, feed.on_change)
+        if refresh_interval:
+            task = asyncio.ensure_future(refresh())
+
+    async def on_shutdown(app):
+        orm.remove_listener(Blog, feed.on_change)
+        if task is not None:
+            task.cancel()
+        if feed._reloading is not None:
+            feed._reloading.cancel()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
@@ -5,36 +5,69 @@ import time
 import re
 import hashlib
 import json
-import markdown2
 import logging
+import derive
+import comments
+import feed
+import search
+import syndication
 from web_frame import get, post
+import orm
+from orm import create_args_string
 from models import User, Blog, Comment, next_id
-from apis import APIError, APIValueError, APIPermissionError, Page
+from apis import APIError, APIValueError, APIPermissionError, \
+    APIResourceNotFoundError, Page
 from aiohttp import web
-from config import configs
+import config
+from lazy import lazy_import
+from profiling import phase
+
+
+markdown2 = lazy_import('markdown2')
 
 
 COOKIE_NAME = 'iamswfsession'
-_COOKIE_KEY = configs.session.secret
+
+# 各篇文章共享的块级渲染缓存，文章修改后只重新渲染变动的块，
+# 第一次打开文章时才创建(创建会触发markdown2的导入)
+_block_cache = None
+
+
+def block_cache():
+    global _block_cache
+    if _block_cache is None:
+        _block_cache = markdown2.BlockCache()
+    return _block_cache
 
 
 @get('/')
 async def index(request):
-    summary = 'this is a summary'
-    blogs = [
-        Blog(id='1', name='js入门', summary=summary,
-                created_at=time.time() - 120),
-        Blog(id='2', name='js函数式编程', summary=summary,
-                created_at=time.time() - 3600),
-        Blog(id='3', name='精通python', summary=summary,
-                created_at=time.time() - 7200),
-    ]
     return {
         '__template__': 'blogs.html',
-        'blogs': blogs
+        'blogs': feed.latest(config.configs.feed.page_size)
     }
 
 
+@get('/rss.xml')
+async def rss(request):
+    return await syndication.serve(request, 'rss.xml')
+
+
+@get('/atom.xml')
+async def atom(request):
+    return await syndication.serve(request, 'atom.xml')
+
+
+@get('/sitemap.xml')
+async def sitemap(request):
+    return await syndication.serve(request, 'sitemap.xml')
+
+
+@get('/sitemap-{n}.xml')
+async def sitemap_page(request, *, n):
+    return await syndication.serve(request, 'sitemap-{}.xml'.format(n))
+
+
 @get('/register')
 def register():
     return {
@@ -67,25 +100,21 @@ def manage_create_blog():
     }
 
 
-def text2html(text):
-    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;')
-                .replace('<', '&lt;').replace('>', '&gt;'),
-                filter(lambda s: s.strip() != '', text.split('\n')))
-    return ''.join(lines)
-
-
 @get('/blog/{id}')
 async def get_blog(id):
     blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id],
-                                     orderBy='created_at desc')
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    blog_comments, next_cursor = await comments.page(
+        id, limit=config.configs.comments.page_size)
+    comment_count = await comments.count(id)
+    with phase('markdown'):
+        blog.html_content = markdown2.markdown_incremental(
+            blog.content, block_cache(), **derive.markdown_options())
     return {
         '__template__': 'blog.html',
         'blog': blog,
-        'comments': comments
+        'comments': blog_comments,
+        'comment_count': comment_count,
+        'next_cursor': next_cursor
     }
 
 
@@ -94,7 +123,8 @@ def user2cookie(user, max_age):
         make cookie str by user
     '''
     expires = str(int(time.time()) + max_age)
-    s = '{}-{}-{}-{}'.format(user.id, user.passwd, expires, _COOKIE_KEY)
+    s = '{}-{}-{}-{}'.format(user.id, user.passwd, expires,
+                             config.configs.session.secret)
     L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
     return '-'.join(L)
 
@@ -120,7 +150,8 @@ async def cookie2user(cookie_str):
         user = await User.find(uid)
         if user is None:
             return None
-        s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
+        s = '%s-%s-%s-%s' % (uid, user.passwd, expires,
+                             config.configs.session.secret)
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
@@ -184,8 +215,8 @@ async def authenticate(*, email, passwd):
 
 
 @get('/api/blogs/{id}')
-def api_get_blog(*, id):
-    blog = yield from Blog.find(id)
+async def api_get_blog(*, id):
+    blog = await Blog.find(id)
     return blog
 
 
@@ -194,6 +225,15 @@ def check_admin(request):
         raise APIPermissionError()
 
 
+@get('/api/cache/stats')
+def api_cache_stats(request):
+    '''
+        实体缓存的命中率和内存占用，仅管理员可见
+    '''
+    check_admin(request)
+    return orm.entity_cache.stats()
+
+
 @post('/api/blogs')
 async def api_create_blog(request, *, name, summary, content):
     check_admin(request)
@@ -239,3 +279,80 @@ async def api_blogs(*, page='1'):
     blogs = await Blog.findAll(orderBy='created_at desc',
                                limit=(p.offset, p.limit))
     return dict(page=page_index, blogs=blogs)
+
+
+@get('/api/blogs/{id}/comments')
+async def api_comments(*, id, cursor='', limit=''):
+    '''
+        游标分页: 不带cursor时返回第一页和评论总数，
+        之后用返回的next_cursor取下一页，next_cursor为null表示没有更多了
+    '''
+    page_size = config.configs.comments.page_size
+    try:
+        limit = min(int(limit), config.MAX_PAGE_SIZE) if limit else page_size
+    except ValueError:
+        raise APIValueError('limit')
+    if limit < 1:
+        raise APIValueError('limit')
+    blog_comments, next_cursor = await comments.page(id, cursor, limit)
+    r = dict(comments=blog_comments, next_cursor=next_cursor)
+    if not cursor:
+        r['total'] = await comments.count(id)
+    return r
+
+
+@post('/api/blogs/{id}/comments')
+async def api_create_comment(id, request, *, content):
+    user = request.__user__
+    if user is None:
+        raise APIPermissionError('Please signin first.')
+    if not content or not content.strip():
+        raise APIValueError('content', 'content cannot be empty.')
+    blog = await Blog.find(id)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name,
+                      user_image=user.image, content=content.strip())
+    return await comments.writer.put(comment)
+
+
+# 搜索结果里各类文档展示用的列
+SEARCH_COLUMNS = {
+    'blog': (Blog, ['user_name', 'name', 'excerpt', 'created_at']),
+    'comment': (Comment, ['blog_id', 'user_name', 'html_content',
+                          'created_at'])
+}
+
+
+@get('/api/search')
+async def api_search(*, q, kind='', limit=''):
+    '''
+        全文搜索文章和评论，kind为blog或comment时只搜一类，
+        结果按相关度排序，每类文档一次in查询取展示字段
+    '''
+    if not q or not q.strip():
+        raise APIValueError('q', 'query cannot be empty.')
+    if kind and kind not in SEARCH_COLUMNS:
+        raise APIValueError('kind')
+    max_results = config.configs.search.max_results
+    try:
+        limit = min(int(limit), max_results) if limit else max_results
+    except ValueError:
+        raise APIValueError('limit')
+    if limit < 1:
+        raise APIValueError('limit')
+    hits = await search.search(q, kind or None, limit)
+    found = {}
+    for k, (model, columns) in SEARCH_COLUMNS.items():
+        ids = [id for hit_kind, id, _ in hits if hit_kind == k]
+        if ids:
+            rs = await model.findAll('`id` in ({})'.format(
+                create_args_string(len(ids))), ids, columns=columns)
+            found.update(((k, r.id), r) for r in rs)
+    results = []
+    for hit_kind, id, score in hits:
+        doc = found.get((hit_kind, id))
+        # 索引比库稍旧时可能查不到，跳过
+        if doc is not None:
+            results.append(dict(kind=hit_kind, score=score, doc=doc))
+    return dict(results=results)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    延迟导入: 模块在第一次访问属性时才执行，
+    用于markdown2这类导入开销大、又不是每个请求都用到的模块
+'''
+
+import sys
+import importlib.util
+
+
+def lazy_import(name):
+    '''
+        返回模块对象，真正的执行推迟到第一次访问属性时；已导入过的直接返回
+    '''
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named {!r}'.format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -94,13 +94,13 @@ import sys
 from pprint import pprint, pformat
 import re
 import logging
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
 import optparse
-from random import random, randint
+from random import random, randint, getrandbits
 import codecs
+import threading
+import itertools
+import time
+from collections import OrderedDict
 
 
 #---- Python version compat
@@ -139,13 +139,134 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
-def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+# Placeholders for hashed HTML blocks/spans, code and escaped characters
+# are a per-process random salt plus a counter. They keep the shape of the
+# old "md5-<32 hex digits>" keys so the block and span regexes treat them
+# exactly as before, but cost a counter increment instead of an MD5 digest,
+# and can all be swapped back in one regex pass (see `_unhash`).
+SECRET_SALT = '%016x' % getrandbits(64)
+_placeholder_counter = itertools.count()
+_placeholder_re = re.compile('md5-%s[0-9a-f]{16}' % SECRET_SALT)
+def _new_placeholder():
+    return 'md5-%s%016x' % (SECRET_SALT, next(_placeholder_counter))
+
+def _unhash(text, table):
+    """Replace every placeholder in `text` found in `table` in one pass."""
+    if not table:
+        return text
+    return _placeholder_re.sub(
+        lambda m: table.get(m.group(0), m.group(0)), text)
 
-# Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
+# Table of placeholders for escaped characters:
+g_escape_table = dict([(ch, _new_placeholder())
     for ch in '\\`*_{}[]()>#+-.!'])
+# ... and with the quote characters used by the "smarty-pants" extra.
+g_smarty_escape_table = dict(g_escape_table)
+g_smarty_escape_table['"'] = _new_placeholder()
+g_smarty_escape_table["'"] = _new_placeholder()
+
+
+
+#---- syntax highlighting
+
+# Pygments is imported lazily, once per process, when the first code block
+# asks for coloring. Lexers and formatters are cached, and the colored HTML
+# is memoized by (lexer, formatter options, code block).
+_pygments = None
+_highlight_lock = threading.Lock()
+_lexer_cache = {}
+_formatter_cache = {}
+_highlight_cache = OrderedDict()
+MAX_CACHED_LEXERS = 256
+HIGHLIGHT_CACHE_SIZE = 512
+
+def _import_pygments():
+    global _pygments
+    if _pygments is None:
+        with _highlight_lock:
+            if _pygments is None:
+                try:
+                    import pygments
+                    import pygments.lexers
+                    import pygments.formatters
+                    import pygments.util
+                except ImportError:
+                    _pygments = False
+                else:
+                    _pygments = pygments
+    return _pygments or None
+
+def _get_pygments_lexer(lexer_name):
+    try:
+        return _lexer_cache[lexer_name]
+    except KeyError:
+        pass
+    pygments = _import_pygments()
+    lexer = None
+    if pygments:
+        try:
+            lexer = pygments.lexers.get_lexer_by_name(lexer_name)
+        except pygments.util.ClassNotFound:
+            pass
+    # Fence languages come from user content; don't let them grow the cache.
+    if len(_lexer_cache) < MAX_CACHED_LEXERS:
+        _lexer_cache[lexer_name] = lexer
+    return lexer
+
+_HtmlCodeFormatter = None
+def _html_code_formatter_class():
+    global _HtmlCodeFormatter
+    if _HtmlCodeFormatter is None:
+        pygments = _import_pygments()
+
+        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+            def _wrap_code(self, inner):
+                """A function for use in a Pygments Formatter which
+                wraps in <code> tags.
+                """
+                yield 0, "<code>"
+                for tup in inner:
+                    yield tup
+                yield 0, "</code>"
+
+            def wrap(self, source, outfile=None):
+                """Return the source with a code, pre, and div."""
+                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
+
+        _HtmlCodeFormatter = HtmlCodeFormatter
+    return _HtmlCodeFormatter
+
+def _color_with_pygments(codeblock, lexer, formatter_opts):
+    formatter_opts = dict(formatter_opts)
+    formatter_opts.setdefault("cssclass", "codehilite")
+    try:
+        opts_key = tuple(sorted(formatter_opts.items()))
+        hash(opts_key)
+    except TypeError:
+        opts_key = None
+    if opts_key is None:
+        formatter = _html_code_formatter_class()(**formatter_opts)
+        return _import_pygments().highlight(codeblock, lexer, formatter)
+
+    key = (lexer, opts_key, codeblock)
+    with _highlight_lock:
+        try:
+            colored = _highlight_cache.pop(key)
+        except KeyError:
+            pass
+        else:
+            _highlight_cache[key] = colored
+            return colored
+    formatter = _formatter_cache.get(opts_key)
+    if formatter is None:
+        formatter = _formatter_cache[opts_key] = \
+            _html_code_formatter_class()(**formatter_opts)
+    colored = _import_pygments().highlight(codeblock, lexer, formatter)
+    with _highlight_lock:
+        _highlight_cache[key] = colored
+        while len(_highlight_cache) > HIGHLIGHT_CACHE_SIZE:
+            _highlight_cache.popitem(last=False)
+    return colored
 
 
 
@@ -154,6 +275,24 @@ g_escape_table = dict([(ch, _hash_text(ch))
 class MarkdownError(Exception):
     pass
 
+class RenderBudgetExceeded(MarkdownError):
+    """Raised inside a conversion that ran out of its render budget (see
+    `Markdown.max_time` and `Markdown.max_size`); `stage` names the gamut
+    step it was in.
+    """
+    def __init__(self, stage):
+        MarkdownError.__init__(self, "render budget exceeded in %s" % stage)
+        self.stage = stage
+
+
+# Stage -> number of conversions that ran out of their render budget there.
+budget_exceeded = {}
+_budget_lock = threading.Lock()
+
+def _count_budget_exceeded(stage):
+    with _budget_lock:
+        budget_exceeded[stage] = budget_exceeded.get(stage, 0) + 1
+
 
 
 #---- public api
@@ -172,11 +311,168 @@ def markdown_path(path, encoding="utf-8",
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
-             use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
+             use_file_vars=False, fast_spans=False, max_time=None,
+             max_size=None):
+    pool = get_pool(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars, fast_spans=fast_spans,
+                    max_time=max_time, max_size=max_size)
+    if pool is None:
+        return Markdown(html4tags=html4tags, tab_width=tab_width,
+                        safe_mode=safe_mode, extras=extras,
+                        link_patterns=link_patterns,
+                        use_file_vars=use_file_vars,
+                        fast_spans=fast_spans, max_time=max_time,
+                        max_size=max_size).convert(text)
+    return pool.convert(text)
+
+
+class MarkdownPool(object):
+    """A thread-safe pool of `Markdown` instances sharing one configuration.
+
+    Building a `Markdown` instance (massaging the extras, copying the escape
+    table) costs about as much as converting a short snippet, so callers
+    that render many small documents (comments, summaries, previews) should
+    reuse instances. A `Markdown` instance holds per-document state while
+    converting, so each concurrent `convert` call checks out its own
+    instance; at most `maxsize` idle instances are kept.
+
+        >>> pool = MarkdownPool(extras=["footnotes"])
+        >>> pool.convert("*boo!*")
+        u'<p><em>boo!</em></p>\n'
+    """
+    def __init__(self, maxsize=8, **kwargs):
+        self.maxsize = maxsize
+        self._kwargs = kwargs
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return Markdown(**self._kwargs)
+
+    def release(self, markdowner):
+        with self._lock:
+            if len(self._free) < self.maxsize:
+                self._free.append(markdowner)
+
+    def convert(self, text):
+        markdowner = self.acquire()
+        try:
+            return markdowner.convert(text)
+        finally:
+            self.release(markdowner)
+
+
+class BlockCache(object):
+    """A thread-safe LRU cache of rendered top-level blocks, shared by
+    `Markdown.convert_incremental` calls. Entries are keyed by block source
+    and rendering context, so one cache can serve many documents.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = entry
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def markdown_incremental(text, cache, html4tags=False,
+                         tab_width=DEFAULT_TAB_WIDTH, safe_mode=None,
+                         extras=None, link_patterns=None,
+                         use_file_vars=False, fast_spans=False,
+                         max_time=None, max_size=None):
+    """Like `markdown`, but re-renders only the top-level blocks not
+    already in `cache` (a `BlockCache`). See `Markdown.convert_incremental`.
+    """
+    kwargs = dict(html4tags=html4tags, tab_width=tab_width,
+                  safe_mode=safe_mode, extras=extras,
+                  link_patterns=link_patterns, use_file_vars=use_file_vars,
+                  fast_spans=fast_spans, max_time=max_time,
+                  max_size=max_size)
+    pool = get_pool(**kwargs)
+    if pool is None:
+        return Markdown(**kwargs).convert_incremental(text, cache)
+    markdowner = pool.acquire()
+    try:
+        return markdowner.convert_incremental(text, cache)
+    finally:
+        pool.release(markdowner)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+MAX_POOLS = 32
+
+def _config_key(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _config_key(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_config_key(v) for v in value)
+    hash(value)
+    return value
+
+def get_pool(html4tags=False, tab_width=DEFAULT_TAB_WIDTH, safe_mode=None,
+             extras=None, link_patterns=None, use_file_vars=False,
+             fast_spans=False, max_time=None, max_size=None):
+    """Return the shared `MarkdownPool` for the given configuration.
+
+    Returns None if the configuration can't be used as a cache key (e.g.
+    unhashable extra arguments) or if too many distinct configurations are
+    already pooled.
+    """
+    try:
+        if extras is None and link_patterns is None:
+            key = (html4tags, tab_width, safe_mode, use_file_vars,
+                   fast_spans, max_time, max_size)
+        else:
+            key = (html4tags, tab_width, safe_mode, use_file_vars,
+                   fast_spans, max_time, max_size, _config_key(extras),
+                   _config_key(link_patterns))
+    except TypeError:
+        return None
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                if len(_pools) >= MAX_POOLS:
+                    return None
+                pool = _pools[key] = MarkdownPool(
+                    html4tags=html4tags, tab_width=tab_width,
+                    safe_mode=safe_mode, extras=extras,
+                    link_patterns=link_patterns,
+                    use_file_vars=use_file_vars, fast_spans=fast_spans,
+                    max_time=max_time, max_size=max_size)
+    return pool
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -200,7 +496,8 @@ class Markdown(object):
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 fast_spans=False, max_time=None, max_size=None):
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -231,12 +528,32 @@ class Markdown(object):
 
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
-        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
-
-        self._escape_table = g_escape_table.copy()
+        # Try the single-pass span scanner (`_scan_spans`) before the
+        # regex-based span gamut. The output is the same either way.
+        self.fast_spans = fast_spans
+        # Render budget: a conversion that takes longer than `max_time`
+        # seconds, or whose input is longer than `max_size` characters,
+        # gives up and returns the text escaped as plain paragraphs. Time is
+        # checked between gamut stages (and between links), so a single
+        # regex pass can still overrun it. `budget_exceeded_stage` is the
+        # stage the last conversion gave up in, or None.
+        self.max_time = max_time
+        self.max_size = max_size
+        self.budget_exceeded_stage = None
+        self._deadline = None
+        self._outdent_re = _outdent_re_from_tab_width(tab_width)
+
+        # `_encode_code` adds entries to the escape table while converting,
+        # so `reset` starts every conversion from this shared base table.
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            self._base_escape_table = g_smarty_escape_table
+        else:
+            self._base_escape_table = g_escape_table
+        self._escape_table = self._base_escape_table.copy()
+        self._base_unescape_table = dict(
+            [(key, ch) for ch, key in self._base_escape_table.items()])
+        self._unescape_table = self._base_unescape_table.copy()
+        self._placeholder_from_text = self._base_escape_table.copy()
 
     def reset(self):
         self.urls = {}
@@ -245,6 +562,11 @@ class Markdown(object):
         self.html_spans = {}
         self.list_level = 0
         self.extras = self._instance_extras.copy()
+        self._escape_table = self._base_escape_table.copy()
+        self._unescape_table = self._base_unescape_table.copy()
+        self._placeholder_from_text = self._base_escape_table.copy()
+        self._toc = None
+        self._comment_scan_stopped = False
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
@@ -259,11 +581,118 @@ class Markdown(object):
 
     def convert(self, text):
         """Convert the given text."""
+        if self.max_time is None and self.max_size is None:
+            return self._convert(text)
+        return self._convert_within_budget(self._convert, text)
+
+    def _convert(self, text):
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
         # and <img> tags get encoded.
+        text = self._prepare(text)
 
+        text = self._run_block_gamut(text)
+
+        if "footnotes" in self.extras:
+            self._check_budget("add_footnotes")
+            text = self._add_footnotes(text)
+
+        return self._finish(text)
+
+    def _convert_within_budget(self, convert, text, *args):
+        self.budget_exceeded_stage = None
+        try:
+            if self.max_size is not None and len(text) > self.max_size:
+                raise RenderBudgetExceeded("size")
+            if self.max_time is not None:
+                self._deadline = time.perf_counter() + self.max_time
+            return convert(text, *args)
+        except RenderBudgetExceeded as ex:
+            self.budget_exceeded_stage = ex.stage
+            _count_budget_exceeded(ex.stage)
+            log.warning("%s (%d chars), rendering as plain text",
+                        ex, len(text))
+            return self._plain_text_html(text)
+        finally:
+            self._deadline = None
+
+    def _check_budget(self, stage):
+        if self._deadline is not None and time.perf_counter() > self._deadline:
+            raise RenderBudgetExceeded(stage)
+
+    def _plain_text_html(self, text):
+        # The fallback for a conversion over budget: no markdown at all,
+        # just escaped paragraphs.
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8')
+        text = re.sub("\r\n|\r", "\n", text)
+        text = text.replace('&', '&amp;').replace('<', '&lt;') \
+                   .replace('>', '&gt;')
+        paras = [p.strip() for p in re.split(r"\n[ \t]*\n", text)]
+        rv = UnicodeWithAttrs("\n\n".join(
+            "<p>%s</p>" % p for p in paras if p) + "\n")
+        if "toc" in self._instance_extras:
+            rv._toc = None
+        if "metadata" in self._instance_extras:
+            rv.metadata = {}
+        return rv
+
+    def convert_incremental(self, text, cache):
+        """Convert the given text, reusing unchanged top-level blocks.
+
+        The document is prepared as a whole (link and footnote definitions,
+        HTML blocks, metadata), then split at top-level block boundaries.
+        Each block's HTML is looked up in `cache` (a `BlockCache`) by its
+        source, the document-wide definitions and the numbering state
+        (footnote count, header ids) it starts with, so only changed blocks
+        run through the block gamut. The result is identical to `convert`,
+        except that `postprocess` sees the final, unescaped HTML.
+
+        A full conversion numbers footnotes and header ids stage by stage
+        over the whole document (all top-level headers before any list
+        contents, ...). If blocks rendered one at a time would number them
+        in a different order, this falls back to `convert`. So it does when
+        an HTML comment that doesn't start a block stops the standalone
+        comment scan for the rest of the document.
+        """
+        if self.max_time is None and self.max_size is None:
+            return self._convert_incremental(text, cache)
+        return self._convert_within_budget(self._convert_incremental,
+                                           text, cache)
+
+    def _convert_incremental(self, text, cache):
+        source = text
+        text = self._prepare(text)
+        if self._comment_scan_stopped:
+            return self._convert(source)
+
+        context = self._block_context()
+        parts = []
+        last_stage = {}
+        for block in self._split_blocks(text):
+            key = (context, self._block_state(), self._block_source(block))
+            entry = cache.get(key)
+            if entry is None:
+                entry = self._render_block(block)
+                cache.put(key, entry)
+            else:
+                self._replay_block(entry)
+            for stage, kind in entry[4]:
+                if stage < last_stage.get(kind, stage):
+                    return self._convert(source)
+                last_stage[kind] = stage
+            if entry[0]:
+                parts.append(entry[0])
+        text = "\n\n".join(parts)
+
+        if "footnotes" in self.extras:
+            self._check_budget("add_footnotes")
+            text = self._add_footnotes(text)
+
+        return self._finish(text)
+
+    def _prepare(self, text):
         # Clear the global hashes. If we don't clear these, you get conflicts
         # from other articles when generating a page which contains more than
         # one article (e.g. an index page that shows the N most recent
@@ -318,7 +747,9 @@ class Markdown(object):
             text = self._hash_html_spans(text)
 
         # Turn block-level HTML blocks into hash entries
+        self._check_budget("prepare")
         text = self._hash_html_blocks(text, raw=True)
+        self._check_budget("hash_html_blocks")
 
         if "fenced-code-blocks" in self.extras and self.safe_mode:
             text = self._do_fenced_code_blocks(text)
@@ -330,12 +761,9 @@ class Markdown(object):
             #   [^4]: this "looks like a link defn"
             text = self._strip_footnote_definitions(text)
         text = self._strip_link_definitions(text)
+        return text
 
-        text = self._run_block_gamut(text)
-
-        if "footnotes" in self.extras:
-            text = self._add_footnotes(text)
-
+    def _finish(self, text):
         text = self.postprocess(text)
 
         text = self._unescape_special_chars(text)
@@ -355,6 +783,106 @@ class Markdown(object):
             rv.metadata = self.metadata
         return rv
 
+    # Top-level block boundaries: a blank line followed by an unindented
+    # line that can't continue the previous block (a blockquote or a list
+    # item would).
+    _block_split_re = re.compile(r"\n{2,}(?=\S)(?!>|[*+-][ \t]|\d+\.[ \t])")
+    _fence_line_re = re.compile(r"^```", re.M)
+
+    def _split_blocks(self, text):
+        # Whitespace-only pieces (e.g. the newlines left in front of a hashed
+        # HTML block) would render as an empty paragraph, so they are
+        # dropped, unless the whole document is blank. A fence that
+        # `_prepare` didn't convert (one right after another fenced block)
+        # is only matched later by the block gamut; don't split inside it.
+        if not text.strip():
+            yield text
+            return
+        fenced = "fenced-code-blocks" in self.extras
+        start = 0
+        for match in self._block_split_re.finditer(text):
+            end = match.end()
+            if fenced and len(self._fence_line_re.findall(
+                    text, start, end)) % 2:
+                continue
+            if text[start:end].strip():
+                yield text[start:end]
+            start = end
+        if text[start:].strip():
+            yield text[start:]
+
+    def _block_source(self, text):
+        # Placeholders differ between conversions; key on what they stand for.
+        return _unhash(_unhash(text, self.html_blocks), self._unescape_table)
+
+    def _block_context(self):
+        footnotes = getattr(self, "footnotes", None) or {}
+        return (self.__class__, self.empty_element_suffix, self.tab_width,
+                self.safe_mode, repr(sorted(self.extras.items())),
+                repr(self.link_patterns),
+                frozenset(self.urls.items()), frozenset(self.titles.items()),
+                frozenset((k, self._block_source(v))
+                          for k, v in footnotes.items()))
+
+    def _block_state(self):
+        return (len(self.footnote_ids) if "footnotes" in self.extras else None,
+                tuple(sorted(self._count_from_header_id.items()))
+                    if "header-ids" in self.extras else None)
+
+    def _numbering_counts(self):
+        return (len(self.footnote_ids) if "footnotes" in self.extras else 0,
+                sum(self._count_from_header_id.values())
+                    if "header-ids" in self.extras else 0)
+
+    def _render_block(self, text):
+        """Run the block gamut over one top-level block and return a cache
+        entry: (html, footnote ids, header id counts, toc entries, stages)
+        with the state changes the block made, for `_replay_block`. `stages`
+        lists the gamut steps that numbered footnotes or header ids.
+        """
+        footnotes_before = ("footnotes" in self.extras
+                            and len(self.footnote_ids))
+        header_counts_before = ("header-ids" in self.extras
+                                and self._count_from_header_id.copy())
+        toc_before = len(self._toc or ())
+
+        stages = []
+        counts = self._numbering_counts()
+        for i, step in enumerate(self._block_gamut_steps()):
+            text = step(text)
+            self._check_budget(step.__name__.lstrip("_"))
+            new_counts = self._numbering_counts()
+            if new_counts[0] != counts[0]:
+                stages.append((i, "footnotes"))
+            if new_counts[1] != counts[1]:
+                stages.append((i, "header-ids"))
+            counts = new_counts
+        html = self._unescape_special_chars(text)
+        if self.safe_mode:
+            html = self._unhash_html_spans(html)
+
+        footnote_ids = ()
+        if "footnotes" in self.extras:
+            footnote_ids = tuple(self.footnote_ids[footnotes_before:])
+        header_counts = ()
+        if "header-ids" in self.extras:
+            header_counts = tuple(
+                (k, v) for k, v in self._count_from_header_id.items()
+                if header_counts_before.get(k) != v)
+        toc = tuple((self._toc or ())[toc_before:])
+        return (html, footnote_ids, header_counts, toc, tuple(stages))
+
+    def _replay_block(self, entry):
+        html, footnote_ids, header_counts, toc, stages = entry
+        if footnote_ids:
+            self.footnote_ids.extend(footnote_ids)
+        if header_counts:
+            self._count_from_header_id.update(header_counts)
+        if toc:
+            if self._toc is None:
+                self._toc = []
+            self._toc.extend(toc)
+
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
         desired. This is called before unescaping of special chars and
@@ -586,14 +1114,14 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -672,6 +1200,11 @@ class Markdown(object):
                     elif text[start_idx-2:start_idx] == '\n\n':
                         pass
                     else:
+                        # Comments after this one are never hashed.
+                        # `convert_incremental` scans block by block and
+                        # can't reproduce that, so it checks this flag.
+                        if "<!--" in text[start:]:
+                            self._comment_scan_stopped = True
                         break
 
                 # Validate whitespace after comment.
@@ -688,7 +1221,7 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
                 text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
 
@@ -785,44 +1318,52 @@ class Markdown(object):
     _hr_re = re.compile(r'^[ ]{0,3}([-_*][ ]{0,2}){3,}$', re.M)
 
     def _run_block_gamut(self, text):
+        for step in self._block_gamut_steps():
+            text = step(text)
+            self._check_budget(step.__name__.lstrip("_"))
+        return text
+
+    def _block_gamut_steps(self):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
-
+        steps = []
         if "fenced-code-blocks" in self.extras:
-            text = self._do_fenced_code_blocks(text)
+            steps.append(self._do_fenced_code_blocks)
 
-        text = self._do_headers(text)
+        steps.append(self._do_headers)
 
-        # Do Horizontal Rules:
-        # On the number of spaces in horizontal rules: The spec is fuzzy: "If
-        # you wish, you may use spaces between the hyphens or asterisks."
-        # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
-        # hr chars to one or two. We'll reproduce that limit here.
-        hr = "\n<hr"+self.empty_element_suffix+"\n"
-        text = re.sub(self._hr_re, hr, text)
+        steps.append(self._do_horizontal_rules)
 
-        text = self._do_lists(text)
+        steps.append(self._do_lists)
 
         if "pyshell" in self.extras:
-            text = self._prepare_pyshell_blocks(text)
+            steps.append(self._prepare_pyshell_blocks)
         if "wiki-tables" in self.extras:
-            text = self._do_wiki_tables(text)
+            steps.append(self._do_wiki_tables)
         if "tables" in self.extras:
-            text = self._do_tables(text)
+            steps.append(self._do_tables)
 
-        text = self._do_code_blocks(text)
+        steps.append(self._do_code_blocks)
 
-        text = self._do_block_quotes(text)
+        steps.append(self._do_block_quotes)
 
         # We already ran _HashHTMLBlocks() before, in Markdown(), but that
         # was to escape raw HTML in the original Markdown source. This time,
         # we're escaping the markup we've just created, so that we don't wrap
         # <p> tags around block-level tags.
-        text = self._hash_html_blocks(text)
+        steps.append(self._hash_html_blocks)
 
-        text = self._form_paragraphs(text)
+        steps.append(self._form_paragraphs)
 
-        return text
+        return steps
+
+    def _do_horizontal_rules(self, text):
+        # On the number of spaces in horizontal rules: The spec is fuzzy: "If
+        # you wish, you may use spaces between the hyphens or asterisks."
+        # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
+        # hr chars to one or two. We'll reproduce that limit here.
+        hr = "\n<hr"+self.empty_element_suffix+"\n"
+        return re.sub(self._hr_re, hr, text)
 
     def _pyshell_block_sub(self, match):
         lines = match.group(0).splitlines(0)
@@ -957,12 +1498,21 @@ class Markdown(object):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
 
+        if self.fast_spans and not ("link-patterns" in self.extras
+                                    or "smarty-pants" in self.extras
+                                    or "break-on-newline" in self.extras):
+            scanned = self._scan_spans(text)
+            if scanned is not None:
+                return scanned
+
         text = self._do_code_spans(text)
 
         text = self._escape_special_chars(text)
+        self._check_budget("escape_special_chars")
 
         # Process anchor and image tags.
         text = self._do_links(text)
+        self._check_budget("do_links")
 
         # Make links out of things like `<http://example.com/>`
         # Must come after _do_links(), because you can use < and >
@@ -975,6 +1525,7 @@ class Markdown(object):
         text = self._encode_amps_and_angles(text)
 
         text = self._do_italics_and_bold(text)
+        self._check_budget("do_italics_and_bold")
 
         if "smarty-pants" in self.extras:
             text = self._do_smart_punctuation(text)
@@ -987,6 +1538,103 @@ class Markdown(object):
 
         return text
 
+    # Everything the span gamut may act on: backslash escapes, code spans,
+    # entities and angle brackets, links, emphasis and hard breaks.
+    _span_token_re = re.compile(r"[\\`&<>\[*_]| {2,}\n")
+    _span_entity_re = re.compile(r'#?[xX]?(?:[0-9a-fA-F]+|\w+);')
+    # A '<' followed by one of these may start a tag or an auto-link, or
+    # (before an escape placeholder) not be a naked '<' after all.
+    _span_tag_start_re = re.compile(r'[\w/?$!\\]')
+    _span_gt_prev_re = re.compile(r'''[a-z0-9?!/'"-]''', re.I)
+    _backtick_run_re = re.compile(r'`+')
+
+    def _scan_spans(self, text):
+        """Single-pass equivalent of `_run_span_gamut` for plain spans.
+
+        Handles plain text, code spans, backslash escapes, entities, naked
+        angle brackets and hard breaks in one left-to-right scan, building
+        the output in a list. Returns None as soon as it meets anything
+        else (emphasis, links, HTML tags, auto-links), in which case the
+        caller runs the regular regex passes.
+        """
+        search = self._span_token_re.search
+        escape_table = self._escape_table
+        out = []
+        append = out.append
+        pos = 0
+        while True:
+            match = search(text, pos)
+            if match is None:
+                append(text[pos:])
+                return ''.join(out)
+            start = match.start()
+            if start > pos:
+                append(text[pos:start])
+            ch = text[start]
+            if ch == '`':
+                pos = self._scan_code_span(text, start, out)
+            elif ch == '\\':
+                # Only escapable characters; `_encode_backslash_escapes`
+                # also matches the text of earlier code spans.
+                escaped = text[start+1:start+2]
+                if not escaped or escaped not in self._base_escape_table:
+                    return None
+                append(escape_table[escaped])
+                pos = start + 2
+            elif ch == '&':
+                if self._span_entity_re.match(text, start + 1):
+                    append('&')
+                else:
+                    append('&amp;')
+                pos = start + 1
+            elif ch == '<':
+                if self._span_tag_start_re.match(text, start + 1):
+                    return None
+                append('&lt;')
+                pos = start + 1
+            elif ch == '>':
+                # `_naked_gt_re` looks behind at the already encoded text.
+                if out and self._span_gt_prev_re.match(out[-1][-1]):
+                    append('>')
+                else:
+                    append('&gt;')
+                pos = start + 1
+            elif ch == ' ':
+                append(" <br%s\n" % self.empty_element_suffix)
+                pos = match.end()
+            else:
+                return None
+
+    def _scan_code_span(self, text, start, out):
+        # Mirror `_code_span_re`: if the whole run of backticks finds no
+        # closer, the regex retries from inside the run with fewer ticks.
+        run = self._backtick_run_re.match(text, start).end() - start
+        for opener in range(start, start + run):
+            if opener == start and start and text[start-1] == '\\':
+                continue
+            n = start + run - opener
+            closer = self._find_code_span_closer(text, opener + n + 1, n)
+            if closer != -1:
+                if opener > start:
+                    out.append(text[start:opener])
+                c = text[opener+n:closer].strip(" \t")
+                out.append("<code>%s</code>" % self._encode_code(c))
+                return closer + n
+        out.append(text[start:start+run])
+        return start + run
+
+    def _find_code_span_closer(self, text, pos, n):
+        # The next run of exactly `n` backticks at or after `pos`.
+        ticks = '`' * n
+        while True:
+            closer = text.find(ticks, pos)
+            if closer == -1:
+                return -1
+            end = self._backtick_run_re.match(text, closer).end()
+            if end - closer == n and text[closer-1] != '`':
+                return closer
+            pos = end
+
     # "Sorta" because auto-links are identified as "tag" tokens.
     _sorta_html_tokenize_re = re.compile(r"""
         (
@@ -1044,7 +1692,7 @@ class Markdown(object):
         for token in self._sorta_html_tokenize_re.split(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._hash_text(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -1053,9 +1701,7 @@ class Markdown(object):
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        return _unhash(text, self.html_spans)
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
@@ -1174,6 +1820,7 @@ class Markdown(object):
                 start_idx = text.index('[', curr_pos)
             except ValueError:
                 break
+            self._check_budget("do_links")
             text_length = len(text)
 
             # Find the matching closing ']'.
@@ -1352,7 +1999,10 @@ class Markdown(object):
     def _toc_add_entry(self, level, id, name):
         if self._toc is None:
             self._toc = []
-        self._toc.append((level, id, self._unescape_special_chars(name)))
+        name = self._unescape_special_chars(name)
+        if self.safe_mode:
+            name = self._unhash_html_spans(name)
+        self._toc.append((level, id, name))
 
     _h_re_base = r'''
         (^(.+)[ \t]*\n(=+|-+)[ \t]*\n+)
@@ -1385,7 +2035,10 @@ class Markdown(object):
             n = min(n + demote_headers, 6)
         header_id_attr = ""
         if "header-ids" in self.extras:
-            header_id = self.header_id_from_text(header_group,
+            # Slug the sanitized HTML rather than the safe_mode placeholders
+            # standing in for it.
+            header_id = self.header_id_from_text(
+                self._unhash_html_spans(header_group),
                 self.extras["header-ids"], n)
             if header_id:
                 header_id_attr = ' id="%s"' % header_id
@@ -1537,36 +2190,10 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _get_pygments_lexer(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
-        import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-
-        formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        return _color_with_pygments(codeblock, lexer, formatter_opts)
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -1592,8 +2219,7 @@ class Markdown(object):
 
         if lexer_name:
             def unhash_code( codeblock ):
-                for key, sanitized in list(self.html_spans.items()):
-                    codeblock = codeblock.replace(key, sanitized)
+                codeblock = _unhash(codeblock, self.html_spans)
                 replacements = [
                     ("&amp;", "&"),
                     ("&lt;", "<"),
@@ -1725,8 +2351,9 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
+        hashed = self._hash_text(text)
         self._escape_table[text] = hashed
+        self._unescape_table[hashed] = text
         return hashed
 
     _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
@@ -1980,18 +2607,23 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
+                hash = self._hash_text(link)
                 link_from_hash[hash] = link
                 text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+        return _unhash(text, link_from_hash)
 
     def _unescape_special_chars(self, text):
         # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        return _unhash(text, self._unescape_table)
+
+    def _hash_text(self, s):
+        # Equal text gets an equal placeholder within one conversion, as
+        # with the old content hash: `_encode_code` relies on it.
+        try:
+            return self._placeholder_from_text[s]
+        except KeyError:
+            key = self._placeholder_from_text[s] = _new_placeholder()
+            return key
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -2223,6 +2855,10 @@ class _memoized(object):
       return self.func.__doc__
 
 
+def _outdent_re_from_tab_width(tab_width):
+    return re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+_outdent_re_from_tab_width = _memoized(_outdent_re_from_tab_width)
+
 def _xml_oneliner_re_from_tab_width(tab_width):
     """Standalone XML processing instruction regex."""
     return re.compile(r"""
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    内存数据库后端(db.backend = 'memory')
+
+    不需要MySQL就能跑起整个应用，用于压测、基准测试和CI，
+    配合db.latency模拟慢数据库。理解orm和各模块生成的SQL:
+        select `pk`, `a`, ... from `t` [where ...] [order by ...] [limit ?[, ?]]
+        select count(...) _num_ from `t` [where ...]
+        insert into `t` (`pk`, `a`, ...) values (?, ...)[, (?, ...)]
+        update `t` set `a`=?, ... where ...
+        delete from `t` where ...
+    where支持and/or/括号、= != <> < <= > >=、in (?, ...)和like ?，
+    列名可以不带反引号，值只能是?占位符。
+    不支持的写法抛UnsupportedSQL。
+    表在第一次insert时创建，insert的第一列是主键。where里用and连接的
+    `col`=?走索引：主键直接查dict，其他列在第一次这样查询时建索引，
+    之后随写入维护，只对索引取出的行求值，不扫全表。
+
+    db.seed可以指定一个JSON文件{表名: [行, ...]}，连接时载入。
+'''
+
+import re
+import json
+import logging
+from collections import OrderedDict
+from orm import Backend
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class UnsupportedSQL(ValueError):
+    '''
+        内存后端不理解的SQL或where写法
+    '''
+    pass
+
+
+_RE_SELECT = re.compile(
+    r'^select (?P<columns>.+?) from `(?P<table>\w+)`'
+    r'(?: where (?P<where>.+?))?(?: order by (?P<order>.+?))?'
+    r'(?: limit (?P<limit>\?(?:, ?\?)?))?$', re.S | re.I)
+_RE_INSERT = re.compile(
+    r'^insert into `(?P<table>\w+)` \((?P<columns>[^)]*)\) values (?P<rows>.+)$',
+    re.S | re.I)
+_RE_UPDATE = re.compile(
+    r'^update `(?P<table>\w+)` set (?P<sets>.+?)(?: where (?P<where>.+))?$',
+    re.S | re.I)
+_RE_DELETE = re.compile(
+    r'^delete from `(?P<table>\w+)`(?: where (?P<where>.+))?$', re.S | re.I)
+_RE_COUNT = re.compile(r'^count\((?:\*|`?\w+`?)\) _num_$', re.I)
+_RE_IDENT = re.compile(r'`?(\w+)`?$')
+_RE_TOKEN = re.compile(r'\s*(`\w+`|\w+|\?|<=|>=|<>|!=|[=<>(),])')
+
+
+def _ident(s):
+    m = _RE_IDENT.match(s.strip())
+    if m is None:
+        raise UnsupportedSQL('unsupported column: {}'.format(s))
+    return m.group(1)
+
+
+def _tokenize(s):
+    tokens, pos = [], 0
+    s = s.rstrip()
+    while pos < len(s):
+        m = _RE_TOKEN.match(s, pos)
+        if m is None:
+            raise UnsupportedSQL('unsupported where clause: {}'.format(s))
+        tokens.append(m.group(1))
+        pos = m.end()
+    return tokens
+
+
+def _like(pattern):
+    regex = ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c)
+                    for c in pattern)
+    return re.compile(regex + r'\Z', re.S | re.I)
+
+
+_COMPARE = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+class _Where(object):
+    '''
+        把where子句编译成predicate(row, args)，args按?出现的顺序取；
+        nargs是占用的参数个数；equals是顶层and里的(列名, 参数下标)，
+        即`col`=?，可以走索引
+    '''
+
+    def __init__(self, clause):
+        self.tokens = _tokenize(clause)
+        self.pos = 0
+        self.nargs = 0
+        self.predicate, self.equals = self._or()
+        if self.pos != len(self.tokens):
+            raise UnsupportedSQL('unsupported where clause: {}'.format(clause))
+
+    def _peek(self):
+        return self.tokens[self.pos].lower() if self.pos < len(self.tokens) \
+            else None
+
+    def _take(self, expected=None):
+        if self.pos >= len(self.tokens):
+            raise UnsupportedSQL('unexpected end of where clause')
+        tok = self.tokens[self.pos]
+        if expected is not None and tok.lower() != expected:
+            raise UnsupportedSQL('expected {!r}, got {!r}'
+                                 .format(expected, tok))
+        self.pos += 1
+        return tok
+
+    def _arg(self):
+        self._take('?')
+        i = self.nargs
+        self.nargs += 1
+        return i
+
+    # 以下各返回(predicate, equals)
+
+    def _or(self):
+        parts = [self._and()]
+        while self._peek() == 'or':
+            self._take()
+            parts.append(self._and())
+        if len(parts) == 1:
+            return parts[0]
+        predicates = [p for p, _ in parts]
+        return (lambda row, args: any(p(row, args) for p in predicates)), []
+
+    def _and(self):
+        parts = [self._atom()]
+        while self._peek() == 'and':
+            self._take()
+            parts.append(self._atom())
+        if len(parts) == 1:
+            return parts[0]
+        predicates = [p for p, _ in parts]
+        return (lambda row, args: all(p(row, args) for p in predicates)), \
+            [eq for _, equals in parts for eq in equals]
+
+    def _atom(self):
+        if self._peek() == '(':
+            self._take()
+            r = self._or()
+            self._take(')')
+            return r
+        col = _ident(self._take())
+        op = self._take().lower()
+        if op == 'in':
+            self._take('(')
+            idx = [self._arg()]
+            while self._peek() == ',':
+                self._take()
+                idx.append(self._arg())
+            self._take(')')
+            return (lambda row, args:
+                    row.get(col) in [args[i] for i in idx]), []
+        i = self._arg()
+        if op == 'like':
+            return (lambda row, args: row.get(col) is not None and
+                    _like(args[i]).match(str(row.get(col))) is not None), []
+        compare = _COMPARE.get(op)
+        if compare is None:
+            raise UnsupportedSQL('unsupported operator: {}'.format(op))
+
+        def predicate(row, args):
+            v = row.get(col)
+            return v is not None and args[i] is not None and \
+                compare(v, args[i])
+        return predicate, [(col, i)] if op == '=' else []
+
+
+class Table(object):
+
+    def __init__(self, name, primary_key):
+        self.name = name
+        self.primary_key = primary_key
+        # 主键 -> 行，保持插入顺序
+        self.rows = OrderedDict()
+        # 列名 -> {值: {主键: 行}}
+        self.indexes = {}
+
+    def add(self, row):
+        key = row[self.primary_key]
+        old = self.rows.get(key)
+        for col, index in self.indexes.items():
+            if old is not None:
+                self._unindex(index, old.get(col), key)
+            index.setdefault(row.get(col), {})[key] = row
+        self.rows[key] = row
+
+    def discard(self, row):
+        key = row[self.primary_key]
+        del self.rows[key]
+        for col, index in self.indexes.items():
+            self._unindex(index, row.get(col), key)
+
+    def update(self, row, values):
+        key = row[self.primary_key]
+        for col, index in self.indexes.items():
+            if col in values and values[col] != row.get(col):
+                self._unindex(index, row.get(col), key)
+                index.setdefault(values[col], {})[key] = row
+        row.update(values)
+
+    def _unindex(self, index, value, key):
+        bucket = index[value]
+        del bucket[key]
+        if not bucket:
+            del index[value]
+
+    def lookup(self, col, value):
+        '''
+            col等于value的行，没有索引时先建
+        '''
+        if value is None:
+            return []
+        if col == self.primary_key:
+            row = self.rows.get(value)
+            return [row] if row is not None else []
+        index = self.indexes.get(col)
+        if index is None:
+            index = self.indexes[col] = {}
+            for key, row in self.rows.items():
+                index.setdefault(row.get(col), {})[key] = row
+        return list(index.get(value, {}).values())
+
+
+class MemoryBackend(Backend):
+
+    def __init__(self):
+        self.tables = {}
+        # 编译好的where，按SQL文本缓存
+        self._wheres = {}
+        self.queries = 0
+
+    async def connect(self, seed='', **kw):
+        if seed:
+            with open(seed, encoding='utf-8') as f:
+                for table, rows in json.load(f).items():
+                    self.load(table, rows)
+        logging.info('memory database ready: {} tables'
+                     .format(len(self.tables)))
+
+    def load(self, table, rows, primary_key='id'):
+        '''
+            直接载入行，不经过SQL
+        '''
+        t = self._table(table, primary_key)
+        for row in rows:
+            t.add(dict(row))
+
+    def _table(self, name, primary_key=None):
+        t = self.tables.get(name)
+        if t is None and primary_key is not None:
+            t = self.tables[name] = Table(name, primary_key)
+        return t
+
+    def _where(self, clause):
+        w = self._wheres.get(clause)
+        if w is None:
+            w = self._wheres[clause] = _Where(clause)
+        return w
+
+    def _match(self, t, clause, args):
+        '''
+            返回满足where的行(原对象)和占用的参数个数。
+            有`col`=?时只检查索引取出的行，优先用主键和已有的索引
+        '''
+        if not clause:
+            return (list(t.rows.values()) if t else []), 0
+        w = self._where(clause)
+        if t is None:
+            return [], w.nargs
+        rows = t.rows.values()
+        if w.equals:
+            col, i = min(w.equals, key=lambda eq: (
+                eq[0] != t.primary_key, eq[0] not in t.indexes))
+            try:
+                rows = t.lookup(col, args[i])
+            except TypeError:
+                # 参数不可hash，退回扫表
+                pass
+        return [r for r in rows if w.predicate(r, args)], w.nargs
+
+    async def select(self, sql, args, size=None):
+        self.queries += 1
+        m = _RE_SELECT.match(sql.strip())
+        if m is None:
+            raise UnsupportedSQL('unsupported sql: {}'.format(sql))
+        args = list(args or ())
+        t = self._table(m.group('table'))
+        rows, used = self._match(t, m.group('where'), args)
+        columns = m.group('columns')
+        if _RE_COUNT.match(columns):
+            return [{'_num_': len(rows)}]
+        if m.group('order'):
+            for part in reversed(m.group('order').split(',')):
+                col, _, direction = part.strip().partition(' ')
+                col = _ident(col)
+                rows = sorted(rows, key=lambda r: (r.get(col) is not None,
+                                                   r.get(col)),
+                              reverse=direction.strip().lower() == 'desc')
+        if m.group('limit'):
+            limit = args[used:]
+            offset, n = (limit[0], limit[1]) if len(limit) == 2 \
+                else (0, limit[0])
+            rows = rows[offset:offset + n]
+        if size:
+            rows = rows[:size]
+        if columns.strip() == '*':
+            return [dict(r) for r in rows]
+        names = [_ident(c) for c in columns.split(',')]
+        return [dict((k, r.get(k)) for k in names) for r in rows]
+
+    def is_duplicate_key(self, e):
+        return isinstance(e, IntegrityError)
+
+    async def execute(self, sql, args):
+        self.queries += 1
+        sql = sql.strip()
+        args = list(args or ())
+        m = _RE_INSERT.match(sql)
+        if m is not None:
+            names = [_ident(c) for c in m.group('columns').split(',')]
+            t = self._table(m.group('table'), names[0])
+            n = len(args) // len(names)
+            new = [dict(zip(names, args[i * len(names):(i + 1) * len(names)]))
+                   for i in range(n)]
+            # 和已有的行以及同一条insert里的行都不能重复，整条失败
+            keys = set()
+            for row in new:
+                key = row[t.primary_key]
+                if key in t.rows or key in keys:
+                    raise IntegrityError('duplicate entry {!r} for {}'
+                                         .format(key, t.name))
+                keys.add(key)
+            for row in new:
+                t.add(row)
+            return n
+        m = _RE_UPDATE.match(sql)
+        if m is not None:
+            names = [_ident(s.split('=')[0]) for s in m.group('sets').split(',')]
+            t = self._table(m.group('table'))
+            if t is None:
+                return 0
+            values, where_args = args[:len(names)], args[len(names):]
+            rows, _ = self._match(t, m.group('where'), where_args)
+            for row in rows:
+                t.update(row, dict(zip(names, values)))
+            return len(rows)
+        m = _RE_DELETE.match(sql)
+        if m is not None:
+            t = self._table(m.group('table'))
+            if t is None:
+                return 0
+            rows, _ = self._match(t, m.group('where'), args)
+            for row in rows:
+                t.discard(row)
+            return len(rows)
+        raise UnsupportedSQL('unsupported sql: {}'.format(sql))
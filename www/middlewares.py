@@ -3,9 +3,12 @@
 
 
 import json
+import time
 import logging
 from aiohttp import web
 from handlers import cookie2user
+import config
+from profiling import phase, timings, start_timings, reset_timings
 
 
 COOKIE_NAME = 'iamswfsession'
@@ -18,16 +21,52 @@ async def logger_factory(app, handler):
     return logger
 
 
+async def timing_factory(app, handler):
+    """
+        config.profiling.server_timing打开时给响应加Server-Timing header，
+        列出auth/db/markdown/render/serialize等阶段的耗时。
+        放在剖析中间件和auth_factory外面；被剖析的请求结束后剖析的计时会并入这里
+    """
+    async def timing(request):
+        if not config.configs.profiling.server_timing:
+            return await handler(request)
+        token = start_timings(timings())
+        start = time.perf_counter()
+        try:
+            r = await handler(request)
+            if isinstance(r, web.StreamResponse) and not r.prepared:
+                r.headers['Server-Timing'] = timings().server_timing(
+                    time.perf_counter() - start)
+            return r
+        finally:
+            reset_timings(token)
+    return timing
+
+
+async def current_user(request):
+    '''
+        按cookie取当前用户，记在request.__user__上，一个请求只查一次。
+        剖析中间件在auth_factory外面，判断管理员时先调用这里
+    '''
+    try:
+        return request.__user__
+    except AttributeError:
+        pass
+    user = None
+    cookie_str = request.cookies.get(COOKIE_NAME)
+    if cookie_str:
+        with phase('auth'):
+            user = await cookie2user(cookie_str)
+        if user:
+            logging.info('set current user: %s' % user.email)
+    request.__user__ = user
+    return user
+
+
 async def auth_factory(app, handler):
     async def auth(request):
         logging.info('check user: %s %s' % (request.method, request.path))
-        request.__user__ = None
-        cookie_str = request.cookies.get(COOKIE_NAME)
-        if cookie_str:
-            user = await cookie2user(cookie_str)
-            if user:
-                logging.info('set current user: %s' % user.email)
-                request.__user__ = user
+        await current_user(request)
         if (request.path.startswith('/manage/') and
                 (request.__user__ is None or not request.__user__.admin)):
             return web.HTTPFound('/signin')
@@ -38,7 +77,8 @@ async def auth_factory(app, handler):
 async def response_factory(app, handler):
     async def response(request):
         logging.info('Response handler...')
-        r = await handler(request)
+        with phase('handler'):
+            r = await handler(request)
         if isinstance(r, web.StreamResponse):
             return r
         if isinstance(r, bytes):
@@ -54,14 +94,16 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                with phase('serialize'):
+                    body = json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')
+                resp = web.Response(body=body)
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
-                resp = web.Response(body=app['__templating__']
-                                    .get_template(template)
-                                    .render(**r)
-                                    .encode('utf-8'))
+                with phase('render'):
+                    body = app['__templating__'].get_template(template) \
+                        .render(**r).encode('utf-8')
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         # default:
@@ -4,7 +4,9 @@
 
 import time
 import uuid
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, \
+    IntegerField
+from derive import derive_blog_async
 
 
 def next_id():
@@ -13,6 +15,12 @@ def next_id():
 
 class User(Model):
     __table__ = 'users'
+    __indexes__ = [
+        ('idx_email', ['email'], True),
+        ('idx_created_at', ['created_at'], False),
+    ]
+    # 每个登录请求都按cookie里的id查一次
+    __cache__ = {'ttl': 60}
     id = StringField(
         primary_key=True, default=next_id, column_type='varchar(50)')
     email = StringField(column_type='varchar(50)')
@@ -25,6 +33,10 @@ class User(Model):
 
 class Blog(Model):
     __table__ = 'blogs'
+    __indexes__ = [
+        ('idx_created_at', ['created_at'], False),
+    ]
+    __cache__ = {'ttl': 300}
     id = StringField(
         primary_key=True, default=next_id, column_type='varchar(50)')
     user_id = StringField(column_type='varchar(50)')
@@ -32,17 +44,37 @@ class Blog(Model):
     user_image = StringField(column_type='varchar(500)')
     name = StringField(column_type='varchar(50)')
     summary = StringField(column_type='varchar(200)')
-    content = TextField()
+    content = TextField(column_type='mediumtext')
     created_at = FloatField(default=time.time)
+    # 以下由derive.derive_blog在保存/更新时生成
+    summary_html = TextField(default='')
+    excerpt = StringField(column_type='varchar(200)', default='')
+    word_count = IntegerField()
+    reading_time = IntegerField()
+    toc_html = TextField(default='')
+
+    async def save(self):
+        await derive_blog_async(self)
+        await super().save()
+
+    async def update(self):
+        await derive_blog_async(self)
+        await super().update()
 
 
 class Comment(Model):
     __table__ = 'comments'
+    __indexes__ = [
+        ('idx_created_at', ['created_at'], False),
+        ('idx_blog_id_created_at', ['blog_id', 'created_at'], False),
+    ]
     id = StringField(
         primary_key=True, default=next_id, column_type='varchar(50)')
     blog_id = StringField(column_type='varchar(50)')
     user_id = StringField(column_type='varchar(50)')
     user_name = StringField(column_type='varchar(50)')
     user_image = StringField(column_type='varchar(500)')
-    content = TextField()
+    content = TextField(column_type='mediumtext')
     created_at = FloatField(default=time.time)
+    # 发表时由comments.text2html生成
+    html_content = TextField(column_type='mediumtext', default='')
@@ -1,48 +1,237 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import sys
+import time
+import asyncio
 import logging
-import aiomysql
+from collections import OrderedDict
+from profiling import phase
 
 
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
 
 
-async def create_pool(loop, **kw):
+class Backend(object):
     """
-        创建全局连接池，以防频繁的打开和关闭数据库连接
+        数据库后端接口，select/execute的SQL用?作占位符。
+        latency秒的延迟加在每次查询前，用来模拟慢数据库
     """
-    logging.info('create database connection pool...')
-    global __pool
-    print(kw)
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
+
+    latency = 0
+
+    async def connect(self, **kw):
+        pass
+
+    async def close(self):
+        pass
+
+    async def select(self, sql, args, size=None):
+        raise NotImplementedError
+
+    async def execute(self, sql, args):
+        raise NotImplementedError
+
+    def is_duplicate_key(self, e):
+        """
+            e是否为主键/唯一索引冲突
+        """
+        return False
+
+
+class MySQLBackend(Backend):
+    """
+        aiomysql连接池
+
+        minsize: 启动时预热的连接数
+        pool_recycle: 连接存活超过该秒数后在下次取用时重建，-1表示不回收
+        keepalive: 空闲连接ping的间隔秒数，0表示不ping
+        connect_retries: 连接失败时按指数退避重试的次数
+    """
+
+    def __init__(self):
+        self._pool = None
+        self._keepalive_task = None
+        self._dict_cursor = None
+
+    async def connect(self, loop=None, **kw):
+        import aiomysql
+        retries = kw.get('connect_retries', 5)
+        delay = kw.get('connect_backoff', 0.5)
+        for attempt in range(retries + 1):
+            try:
+                self._pool = await aiomysql.create_pool(
+                    host=kw.get('host', 'localhost'),
+                    port=kw.get('port', 3306),
+                    user=kw['user'],
+                    password=kw['password'],
+                    db=kw['db'],
+                    charset=kw.get('charset', 'utf8'),
+                    autocommit=kw.get('autocommit', True),
+                    maxsize=kw.get('maxsize', 10),
+                    minsize=kw.get('minsize', 1),
+                    pool_recycle=kw.get('pool_recycle', 3600),
+                    loop=loop
+                )
+                break
+            except (OSError, aiomysql.OperationalError) as e:
+                if attempt == retries:
+                    raise
+                logging.warning('connect to database failed: {}, retry in {}s'
+                                .format(e, delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, kw.get('connect_backoff_max', 30))
+        self._dict_cursor = aiomysql.DictCursor
+        logging.info('database pool ready: {} connections warmed up'
+                     .format(self._pool.size))
+        keepalive = kw.get('keepalive', 60)
+        if keepalive:
+            self._keepalive_task = asyncio.ensure_future(
+                self._keepalive(keepalive))
+
+    async def _keepalive(self, interval):
+        """
+            定时ping空闲连接，断开的连接会被重连。
+            acquire从队头取、release放回队尾，循环freesize次即可覆盖所有空闲连接
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for _ in range(self._pool.freesize):
+                try:
+                    async with self._pool.acquire() as conn:
+                        await conn.ping(reconnect=True)
+                except Exception as e:
+                    logging.warning('keepalive ping failed: {}'.format(e))
+
+    async def close(self):
+        """
+            停止keepalive，等待正在执行的查询归还连接后再关闭
+        """
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    async def select(self, sql, args, size=None):
+        async with self._pool.acquire() as conn:
+            cur = await conn.cursor(self._dict_cursor)
+            await cur.execute(sql.replace('?', '%s'), args or ())
+            if size:
+                rs = await cur.fetchmany(size)
+            else:
+                rs = await cur.fetchall()
+            await cur.close()
+        return rs
+
+    async def execute(self, sql, args):
+        async with self._pool.acquire() as conn:
+            cur = await conn.cursor()
+            await cur.execute(sql.replace('?', '%s'), args)
+            affected = cur.rowcount
+            await cur.close()
+        return affected
+
+    def is_duplicate_key(self, e):
+        # ER_DUP_ENTRY
+        return type(e).__name__ == 'IntegrityError' and \
+            bool(e.args) and e.args[0] == 1062
+
+
+# 后端名 -> 类，或'模块:类'(第一次使用时才导入)
+_backends = {
+    'mysql': MySQLBackend,
+    'memory': 'memdb:MemoryBackend',
+    'sqlite': 'sqlitedb:SQLiteBackend',
+}
+
+
+def register_backend(name, cls):
+    _backends[name] = cls
+
+
+def _backend_class(name):
+    cls = _backends.get(name)
+    if cls is None:
+        raise ValueError('unknown database backend: {}'.format(name))
+    if isinstance(cls, str):
+        module, _, attr = cls.partition(':')
+        cls = _backends[name] = getattr(__import__(module), attr)
+    return cls
+
+
+__backend = None
+
+
+def get_backend():
+    return __backend
+
+
+def is_duplicate_key(e):
+    """
+        e是否为当前后端的主键/唯一索引冲突，用于判断重试的写入是否其实已经成功
+    """
+    return __backend is not None and __backend.is_duplicate_key(e)
+
+
+def set_latency(latency):
+    """
+        之后每次查询前等待latency秒，0表示不等待
+    """
+    __backend.latency = latency
+
+
+async def create_pool(loop=None, **kw):
+    """
+        按kw['backend']创建全局的数据库后端(默认mysql连接池)并连接，
+        kw['latency']为每次查询前注入的延迟秒数
+    """
+    global __backend
+    name = kw.get('backend', 'mysql')
+    logging.info('create database backend: {}...'.format(name))
+    backend = _backend_class(name)()
+    backend.latency = kw.get('latency', 0)
+    await backend.connect(loop=loop, **kw)
+    __backend = backend
+    return backend
+
+
+async def close_pool():
+    """
+        关闭数据库后端
+    """
+    global __backend
+    if __backend is not None:
+        logging.info('close database backend...')
+        await __backend.close()
+        __backend = None
+
+
+def setup_pool(app, **kw):
+    """
+        将连接池的创建和关闭挂到app的startup/cleanup上
+    """
+    async def on_startup(app):
+        await create_pool(**kw)
+
+    async def on_cleanup(app):
+        await close_pool()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
 
 
 async def select(sql, args, size=None):
     log(sql, args)
-    global __pool
-    with await __pool as conn:
-        cur = await conn.cursor(aiomysql.DictCursor)
-        await cur.execute(sql.replace('?', '%s'), args or ())
-        if size:
-            rs = await cur.fetchmany(size)
-        else:
-            rs = await cur.fetchall()
-        await cur.close()
-        logging.info('rows returned: %s', len(rs))
-        return rs
+    with phase('db'):
+        if __backend.latency:
+            await asyncio.sleep(__backend.latency)
+        rs = await __backend.select(sql, args, size)
+    logging.info('rows returned: %s', len(rs))
+    return rs
 
 
 async def execute(sql, args):
@@ -50,12 +239,10 @@ async def execute(sql, args):
         增，删，改
     """
     log(sql)
-    with await __pool as conn:
-        cur = await conn.cursor()
-        await cur.execute(sql.replace('?', '%s'), args)
-        affected = cur.rowcount
-        await cur.close()
-        return affected
+    with phase('db'):
+        if __backend.latency:
+            await asyncio.sleep(__backend.latency)
+        return await __backend.execute(sql, args)
 
 
 def create_args_string(num):
@@ -88,14 +275,148 @@ class BooleanField(Field):
         super().__init__(name, 'boolean', False, default)
 
 
+class IntegerField(Field):
+    def __init__(self, name=None, primary_key=False, default=0):
+        super().__init__(name, 'bigint', primary_key, default)
+
+
 class FloatField(Field):
     def __init__(self, name=None, primary_key=False, default=0.0):
         super().__init__(name, 'real', primary_key, default)
 
 
 class TextField(Field):
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, column_type='text', default=None):
+        super().__init__(name, column_type, False, default)
+
+
+# 写操作完成后的回调: {model: [fn(obj, event)]}，event为save/update/remove。
+# 用于维护首页feed、搜索索引等进程内的派生数据，回调应当很快且不抛异常。
+_listeners = {}
+
+
+def add_listener(model, fn):
+    _listeners.setdefault(model, []).append(fn)
+
+
+def remove_listener(model, fn):
+    _listeners.get(model, []).remove(fn)
+
+
+def _notify(obj, event):
+    for fn in _listeners.get(type(obj), ()):
+        try:
+            fn(obj, event)
+        except Exception as e:
+            logging.exception('{} listener failed: {}'.format(event, e))
+
+
+class EntityCache(object):
+    """
+        进程内的二级实体缓存: (model, 主键) -> Model.find读出的行。
+        只缓存声明了__cache__ = {'ttl': 秒}的model，find每次返回新的
+        对象，调用方修改对象不会影响缓存。
+        save/save_all/update/remove写库后删除对应的项；别的worker进程和
+        直接执行的SQL不会通知到这里，靠ttl兜底。
+        按估算的内存大小做LRU淘汰，总量不超过max_bytes。
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, enabled=True):
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.bytes = 0
+        # (model, 主键) -> (过期时间, 字节数, 行)，按最近使用排序
+        self._entries = OrderedDict()
+        # 每次失效加一，查询期间有写入时不把读到的旧行放进缓存
+        self.version = 0
+        # model名 -> {hits, misses, expired, evictions, invalidations}
+        self._stats = {}
+
+    def _count(self, model, event):
+        stats = self._stats.get(model.__name__)
+        if stats is None:
+            stats = self._stats[model.__name__] = dict(
+                hits=0, misses=0, expired=0, evictions=0, invalidations=0)
+        stats[event] += 1
+
+    def get(self, model, key):
+        entry = self._entries.get((model, key))
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end((model, key))
+                self._count(model, 'hits')
+                return entry[2]
+            self._remove((model, key))
+            self._count(model, 'expired')
+        self._count(model, 'misses')
+        return None
+
+    def put(self, model, key, row, version):
+        if version != self.version:
+            return
+        size = _sizeof(row)
+        if size > self.max_bytes:
+            return
+        self._remove((model, key))
+        while self._entries and self.bytes + size > self.max_bytes:
+            (evicted, _), (_, n, _) = self._entries.popitem(last=False)
+            self.bytes -= n
+            self._count(evicted, 'evictions')
+        self._entries[(model, key)] = (
+            time.monotonic() + model.__cache__.get('ttl', 60), size, row)
+        self.bytes += size
+
+    def invalidate(self, model, key):
+        self.version += 1
+        if self._remove((model, key)):
+            self._count(model, 'invalidations')
+
+    def _remove(self, k):
+        entry = self._entries.pop(k, None)
+        if entry is None:
+            return False
+        self.bytes -= entry[1]
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+        self.version += 1
+
+    def stats(self):
+        models = {}
+        for name, stats in self._stats.items():
+            lookups = stats['hits'] + stats['misses']
+            models[name] = dict(
+                stats, hit_rate=stats['hits'] / lookups if lookups else 0.0)
+        return dict(enabled=self.enabled, entries=len(self._entries),
+                    bytes=self.bytes, max_bytes=self.max_bytes,
+                    models=models)
+
+
+def _sizeof(row):
+    """
+        估算一行占用的内存: dict本身加上各个值，列名是共享的字符串不计
+    """
+    return sys.getsizeof(row) + sum(map(sys.getsizeof, row.values()))
+
+
+entity_cache = EntityCache()
+
+
+def setup_cache(enabled=True, max_bytes=16 * 1024 * 1024):
+    entity_cache.enabled = enabled
+    entity_cache.max_bytes = max_bytes
+    entity_cache.clear()
+
+
+def _cached(model):
+    return model.__cache__ is not None and entity_cache.enabled
+
+
+def _invalidate(obj):
+    if _cached(type(obj)):
+        entity_cache.invalidate(type(obj), obj.get(obj.__primary_key__))
 
 
 class ModelMetaclass(type):
@@ -124,11 +445,16 @@ class ModelMetaclass(type):
 
         escaped_fields = list(map(lambda field: '`{}`'.format(field), fields))
 
-        new_attrs = {}
+        # 保留方法等普通属性，去掉Field，让取值落到dict上
+        new_attrs = {k: v for k, v in attrs.items() if k not in mappings}
         new_attrs['__mappings__'] = mappings  # 属性到列的映射关系
         new_attrs['__table__'] = table_name
         new_attrs['__primary_key__'] = primary_key
         new_attrs['__fields__'] = fields  # 除主键外的属性名
+        # 二级索引声明: [(索引名, [列名, ...], 是否unique), ...]
+        new_attrs['__indexes__'] = attrs.get('__indexes__', [])
+        # 实体缓存声明: {'ttl': 秒}，None表示不缓存，见EntityCache
+        new_attrs['__cache__'] = attrs.get('__cache__')
         # default select, select all fields from table
         # select `id`, `name`, `age` from `user`
         new_attrs['__select__'] = 'select `{}`, {} from `{}`'\
@@ -184,18 +510,34 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     async def find(cls, primary_key):
         """
-            find object by primary key
+            find object by primary key，声明了__cache__的model先查实体缓存
         """
+        cached = _cached(cls)
+        if cached:
+            row = entity_cache.get(cls, primary_key)
+            if row is not None:
+                return cls(**row)
+            version = entity_cache.version
         res = await select('{} where `{}`=?'.format(
             cls.__select__, cls.__primary_key__), [primary_key], 1)
         if len(res) == 0:
             return None
+        if cached:
+            entity_cache.put(cls, primary_key, res[0], version)
         return cls(**res[0])
 
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause. '
-        sql = [cls.__select__]
+        columns = kw.get('columns', None)
+        if columns:
+            # 只取部分列，避免读出用不到的大字段
+            sql = ['select `{}`, {} from `{}`'.format(
+                cls.__primary_key__,
+                ', '.join('`{}`'.format(c) for c in columns),
+                cls.__table__)]
+        else:
+            sql = [cls.__select__]
         if where:
             sql.append('where')
             sql.append(where)
@@ -216,7 +558,6 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        print(sql, args)
         rs = await select(' '.join(sql), args)
         return [cls(**r) for r in rs]
 
@@ -229,7 +570,7 @@ class Model(dict, metaclass=ModelMetaclass):
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(', '.join(sql), args, 1)
+        rs = await select(' '.join(sql), args, 1)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
@@ -242,15 +583,46 @@ class Model(dict, metaclass=ModelMetaclass):
             logging.warn(
                 'failed to insert record: affected rows: {}'
                 .format(rows))
+        _invalidate(self)
+        _notify(self, 'save')
+
+    @classmethod
+    async def save_all(cls, objs):
+        """
+            一条多行insert写入多个对象:
+            insert into `user` (`id`, `name`) values (?, ?), (?, ?)
+        """
+        if not objs:
+            return 0
+        keys = [cls.__primary_key__] + cls.__fields__
+        row = '({})'.format(create_args_string(len(keys)))
+        sql = 'insert into `{}` ({}) values {}'.format(
+            cls.__table__, ', '.join('`{}`'.format(k) for k in keys),
+            ', '.join([row] * len(objs)))
+        args = []
+        for obj in objs:
+            args.extend(map(obj.getValueOrDefault, keys))
+        rows = await execute(sql, args)
+        if rows != len(objs):
+            logging.warn(
+                'failed to insert records: affected rows: {} of {}'
+                .format(rows, len(objs)))
+        for obj in objs:
+            _invalidate(obj)
+            _notify(obj, 'save')
+        return rows
 
     async def update(self):
-        args = [self.getValue(self.__primary_key__)]
-        args = args + list(map(self.getValue, self.__fields__))
+        # __update__的主键条件在最后
+        args = list(map(self.getValue, self.__fields__))
+        args.append(self.getValue(self.__primary_key__))
         rows = await execute(self.__update__, args)
         if rows != 1:
             logging.warn(
                 'faild to update by primary key: affected rows: {}'
                 .format(rows))
+        _invalidate(self)
+        _notify(self, 'update')
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
@@ -259,3 +631,5 @@ class Model(dict, metaclass=ModelMetaclass):
             logging.info(
                 'faild to remove by primary key: affected rows: {}'
                 .format(rows))
+        _invalidate(self)
+        _notify(self, 'remove')
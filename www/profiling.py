@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    请求级的性能剖析
+
+    profile_factory中间件每sample_every个请求抽一个，或者处理带header
+    (默认X-Profile)的管理员请求。中间件放在auth_factory外面，剖析里包含
+    auth阶段: 带header的请求先开始计时和采样，再用get_user取当前用户
+    (auth_factory复用结果)，不是管理员就停止，不写文件。
+    被抽中的请求:
+        分阶段计时  auth/handler/db/render/serialize，各阶段是包含关系，
+                    handler里包含db
+        栈采样      每interval秒CPU时间(SIGPROF)采一次当前执行的栈，
+                    只记属于这个请求的task的样本，栈底加上当时所处的阶段
+    结束后在output_dir里写一个collapsed-stack文件(flamegraph.pl/speedscope
+    可以直接读)，计时写进日志。
+
+    代码里用with profiling.phase('db'):标记阶段；没有在计时的请求
+    phase()只是一次ContextVar读取，返回共享的空对象。
+    没启用时中间件不挂到app上。
+
+    同一套计时也用于Server-Timing header(middlewares.timing_factory)，
+    剖析结束后把各阶段计时并入外层的Timings。
+'''
+
+import os
+import re
+import time
+import signal
+import asyncio
+import logging
+import contextvars
+from collections import Counter
+
+
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+class _NoPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+
+
+class _Phase(object):
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.timings.stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+        self.timings.stack.pop()
+        return False
+
+
+class Timings(object):
+    '''
+        一个请求里各阶段的累计时间(秒)和次数
+    '''
+
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+        self.stack = []
+
+    def add(self, name, elapsed):
+        self.totals[name] = self.totals.get(name, 0.0) + elapsed
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def merge(self, other):
+        for k, v in other.totals.items():
+            self.totals[k] = self.totals.get(k, 0.0) + v
+            self.counts[k] = self.counts.get(k, 0) + other.counts[k]
+
+    def server_timing(self, total=None):
+        '''
+            Server-Timing header的值，db等多次的阶段在desc里带上次数
+        '''
+        L = []
+        for k, v in self.totals.items():
+            n = self.counts[k]
+            L.append('{};dur={:.2f}{}'.format(
+                k, v * 1e3, ';desc="{} calls"'.format(n) if n > 1 else ''))
+        if total is not None:
+            L.append('total;dur={:.2f}'.format(total * 1e3))
+        return ', '.join(L)
+
+    def __str__(self):
+        return ' '.join('{}={:.2f}ms/{}'.format(
+            k, v * 1e3, self.counts[k]) for k, v in self.totals.items())
+
+
+def timings():
+    '''
+        当前请求的Timings，没有在计时时返回None
+    '''
+    return _timings.get()
+
+
+def start_timings(timings=None):
+    '''
+        为当前请求开始计时，返回给reset_timings用的token
+    '''
+    return _timings.set(timings if timings is not None else Timings())
+
+
+def reset_timings(token):
+    _timings.reset(token)
+
+
+def phase(name):
+    t = _timings.get()
+    return _NO_PHASE if t is None else _Phase(t, name)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(
+        code.co_filename), code.co_firstlineno)
+
+
+class Profile(Timings):
+    '''
+        被抽中的请求: 计时加栈采样，samples是collapsed栈 -> 样本数
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.samples = Counter()
+
+    def sample(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        stack.append(self.stack[-1] if self.stack else 'request')
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(s, n)
+                       for s, n in self.samples.most_common())
+
+
+class Sampler(object):
+    '''
+        有被剖析的请求在执行时开着ITIMER_PROF，SIGPROF到来时
+        把样本记到当前task对应的Profile上
+    '''
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self._active = {}
+
+    def _handler(self, signum, frame):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            return
+        profile = self._active.get(task)
+        if profile is not None:
+            profile.sample(frame)
+
+    def start(self, task, profile):
+        if not self._active:
+            signal.signal(signal.SIGPROF, self._handler)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self._active[task] = profile
+
+    def stop(self, task):
+        self._active.pop(task, None)
+        if not self._active:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+_RE_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def write_profile(output_dir, request, profile, elapsed):
+    name = '{:.6f}-{}-{}-{}ms.collapsed'.format(
+        time.time(), request.method,
+        _RE_UNSAFE.sub('_', request.path).strip('_')[:80] or 'root',
+        int(elapsed * 1e3))
+    path = os.path.join(output_dir, name)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(profile.collapsed())
+    return path
+
+
+def profile_middleware(sample_every=1000, header='X-Profile',
+                       interval=0.001, output_dir='profiles', get_user=None):
+    '''
+        返回中间件factory，放在auth_factory之前(外面)。
+        get_user(request)返回当前用户，header只对管理员生效；
+        get_user为None时只按sample_every抽样
+    '''
+    if not os.path.isabs(output_dir):
+        output_dir = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), output_dir)
+    sampler = Sampler(interval)
+    counter = 0
+
+    async def profile_factory(app, handler):
+        async def profile(request):
+            nonlocal counter
+            counter += 1
+            sampled = sample_every > 0 and counter % sample_every == 0
+            asked = get_user is not None and header in request.headers
+            if not sampled and not asked:
+                return await handler(request)
+            p = Profile()
+            outer = _timings.get()
+            task = asyncio.current_task()
+            token = _timings.set(p)
+            sampler.start(task, p)
+            start = time.perf_counter()
+            profiled = sampled
+            try:
+                if not profiled:
+                    # 取用户也在剖析里，auth_factory不再重复查
+                    user = await get_user(request)
+                    profiled = user is not None and user.admin
+                if profiled:
+                    return await handler(request)
+            finally:
+                elapsed = time.perf_counter() - start
+                sampler.stop(task)
+                _timings.reset(token)
+                if outer is not None:
+                    outer.merge(p)
+                if profiled:
+                    try:
+                        path = write_profile(output_dir, request, p, elapsed)
+                    except OSError as e:
+                        path = 'not written: {}'.format(e)
+                    logging.info('profile {} {} {:.2f}ms {} -> {}'.format(
+                        request.method, request.path, elapsed * 1e3, p, path))
+            # 不是管理员: 取用户的计时已经并入外层，正常处理
+            return await handler(request)
+        return profile
+    return profile_factory
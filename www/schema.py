@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    schema tool: 根据ModelMetaclass生成的__mappings__生成DDL，
+    并与线上数据库表结构做diff，以在线（不锁表）的方式分批迁移。
+
+    usage:
+        python3 schema.py generate [-o schema.sql]
+        python3 schema.py diff
+        python3 schema.py migrate [--batch-size 1000] [--sleep 0.05]
+                                  [--dry-run] [--allow-locking]
+
+    diff和migrate读information_schema，只支持db.backend = 'mysql'。
+    SQLite只在启动时按models建表，不迁移(见sqlitedb.py)。
+'''
+
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import orm
+import models
+from orm import Model, StringField, BooleanField, IntegerField, FloatField, \
+    TextField
+from config import configs
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+# information_schema中返回的类型与model中声明的类型不一致时的别名
+_TYPE_ALIASES = {
+    'boolean': 'tinyint(1)',
+    'bool': 'tinyint(1)',
+    'real': 'double',
+}
+
+
+def normalize_type(column_type):
+    t = column_type.strip().lower()
+    return _TYPE_ALIASES.get(t, t)
+
+
+def all_models(module=models):
+    '''
+        按定义顺序找出module中的所有Model子类
+    '''
+    L = []
+    for cls in vars(module).values():
+        if (isinstance(cls, type) and issubclass(cls, Model) and
+                cls is not Model and cls not in L):
+            L.append(cls)
+    return L
+
+
+def column_names(model):
+    return [model.__primary_key__] + model.__fields__
+
+
+def column_type(model, name):
+    return model.__mappings__[name].column_type
+
+
+# 默认值为None的列回填时用的零值，回填后列会改成not null
+_ZERO_VALUES = {
+    StringField: '',
+    TextField: '',
+    BooleanField: False,
+    IntegerField: 0,
+    FloatField: 0.0,
+}
+
+
+def backfill_default(model, name):
+    '''
+        新列回填用的默认值(常量或callable)，None换成字段类型的零值
+    '''
+    field = model.__mappings__[name]
+    if field.default is not None:
+        return field.default
+    for cls in type(field).__mro__:
+        if cls in _ZERO_VALUES:
+            return _ZERO_VALUES[cls]
+    raise ValueError('{}.{} has no default to backfill the not null column'
+                     .format(model.__table__, name))
+
+
+def column_ddl(model, name, nullable=False):
+    return '`{}` {}{}'.format(
+        name, column_type(model, name), ' null' if nullable else ' not null')
+
+
+def index_ddl(index):
+    name, columns, unique = index
+    return '{}key `{}` ({})'.format(
+        'unique ' if unique else '', name,
+        ', '.join('`{}`'.format(c) for c in columns))
+
+
+def create_table_sql(model):
+    '''
+        生成单张表的create table语句
+    '''
+    lines = [column_ddl(model, name) for name in column_names(model)]
+    lines.extend(index_ddl(index) for index in model.__indexes__)
+    lines.append('primary key (`{}`)'.format(model.__primary_key__))
+    return 'create table `{}` (\n    {}\n) engine=innodb default charset=utf8;'\
+        .format(model.__table__, ',\n    '.join(lines))
+
+
+def generate(db=None):
+    '''
+        生成完整的schema.sql
+    '''
+    db = db or configs.db
+    L = [
+        '-- schema.sql',
+        '-- generated by: python3 schema.py generate',
+        '-- execute in bash: mysql -u root -p < schema.sql',
+        '',
+        'drop database if exists {};'.format(db.db),
+        'create database {};'.format(db.db),
+        'use {};'.format(db.db),
+        "grant select, insert, update, delete on {}.* to '{}'@'localhost' "
+        "identified by '{}';".format(db.db, db.user, db.password),
+    ]
+    for model in all_models():
+        L.append('\n')
+        L.append(create_table_sql(model))
+    return '\n'.join(L) + '\n'
+
+
+async def load_live_schema(db_name):
+    '''
+        读取线上库的表结构: {table: {'columns': {name: (type, nullable)},
+                                     'indexes': {name: [columns]}}}
+    '''
+    tables = {}
+    rs = await orm.select(
+        'select table_name as t, column_name as c, column_type as ct, '
+        'is_nullable as n from information_schema.columns '
+        'where table_schema=? order by table_name, ordinal_position',
+        [db_name])
+    for r in rs:
+        table = tables.setdefault(r['t'], dict(columns={}, indexes={}))
+        table['columns'][r['c']] = (normalize_type(r['ct']), r['n'] == 'YES')
+    rs = await orm.select(
+        'select table_name as t, index_name as i, column_name as c '
+        'from information_schema.statistics where table_schema=? '
+        'order by table_name, index_name, seq_in_index', [db_name])
+    for r in rs:
+        if r['t'] in tables:
+            tables[r['t']]['indexes'].setdefault(r['i'], []).append(r['c'])
+    return tables
+
+
+class Step(object):
+    '''
+        一个迁移步骤。kind: create / add_column / modify_column / add_index
+    '''
+
+    def __init__(self, kind, model, name=None):
+        self.kind = kind
+        self.model = model
+        self.name = name
+
+    def __str__(self):
+        return '{} {}{}'.format(self.kind, self.model.__table__,
+                                '.' + self.name if self.name else '')
+
+
+def diff(live):
+    '''
+        对比model与线上表结构，返回迁移步骤列表。
+        多余的列和索引只打日志，不会自动删除。
+    '''
+    steps = []
+    for model in all_models():
+        table = live.get(model.__table__)
+        if table is None:
+            steps.append(Step('create', model))
+            continue
+        for name in column_names(model):
+            if name not in table['columns']:
+                steps.append(Step('add_column', model, name))
+                continue
+            live_type, nullable = table['columns'][name]
+            if live_type != normalize_type(column_type(model, name)) \
+                    or nullable:
+                steps.append(Step('modify_column', model, name))
+        for index in model.__indexes__:
+            if index[0] not in table['indexes']:
+                steps.append(Step('add_index', model, index[0]))
+        for name in table['columns']:
+            if name not in model.__mappings__:
+                logging.warning('column {}.{} not in model, ignored'
+                                .format(model.__table__, name))
+        for name in table['indexes']:
+            if name != 'PRIMARY' and \
+                    name not in [i[0] for i in model.__indexes__]:
+                logging.warning('index {}.{} not in model, ignored'
+                                .format(model.__table__, name))
+    return steps
+
+
+class Migrator(object):
+    '''
+        执行迁移步骤。
+        所有alter table都带上algorithm=inplace, lock=none，
+        MySQL无法在线完成时会直接报错而不是锁表，除非指定allow_locking。
+        新增列先以null加入，再按主键分批回填，最后改为not null。
+    '''
+
+    def __init__(self, batch_size=1000, sleep=0.05, dry_run=False,
+                 allow_locking=False):
+        self.batch_size = batch_size
+        self.sleep = sleep
+        self.dry_run = dry_run
+        self.allow_locking = allow_locking
+
+    def online(self, sql):
+        if self.allow_locking:
+            return sql
+        return sql + ', algorithm=inplace, lock=none'
+
+    async def execute(self, sql, args=()):
+        logging.info('{}{}'.format('[dry-run] ' if self.dry_run else '', sql))
+        if not self.dry_run:
+            await orm.execute(sql, args)
+
+    async def run(self, steps):
+        for i, step in enumerate(steps):
+            logging.info('step {}/{}: {}'.format(i + 1, len(steps), step))
+            await getattr(self, step.kind)(step.model, step.name)
+
+    async def create(self, model, name):
+        await self.execute(create_table_sql(model))
+
+    async def add_column(self, model, name):
+        # 没有可回填的值时在改表之前就报错
+        default = backfill_default(model, name)
+        await self.execute(self.online('alter table `{}` add column {}'.format(
+            model.__table__, column_ddl(model, name, nullable=True))))
+        await self.backfill(model, name, default)
+        await self.modify_column(model, name)
+
+    async def modify_column(self, model, name):
+        await self.execute(self.online('alter table `{}` modify column {}'
+                                       .format(model.__table__,
+                                               column_ddl(model, name))))
+
+    async def add_index(self, model, name):
+        for index in model.__indexes__:
+            if index[0] == name:
+                await self.execute(self.online('alter table `{}` add {}'
+                                               .format(model.__table__,
+                                                       index_ddl(index))))
+
+    async def backfill(self, model, name, default):
+        '''
+            按主键顺序分批回填新列的默认值，每批一条update，
+            每批之间sleep以限制对线上的压力
+        '''
+        table, pk = model.__table__, model.__primary_key__
+        if self.dry_run:
+            logging.info('[dry-run] backfill {}.{}'.format(table, name))
+            return
+        total = await model.find_number('count(`{}`)'.format(pk),
+                                         '`{}` is null'.format(name))
+        done, last = 0, ''
+        start = time.time()
+        while True:
+            rs = await orm.select(
+                'select `{0}` from `{1}` where `{0}`>? and `{2}` is null '
+                'order by `{0}` limit ?'.format(pk, table, name),
+                [last, self.batch_size])
+            if not rs:
+                break
+            if callable(default):
+                # 每行的值不同，用case按主键取值
+                args = []
+                for r in rs:
+                    args += [r[pk], default()]
+                await orm.execute(
+                    'update `{0}` set `{1}`=case `{2}` {3} end '
+                    'where `{2}` in ({4})'.format(
+                        table, name, pk, ' '.join(['when ? then ?'] * len(rs)),
+                        orm.create_args_string(len(rs))),
+                    args + [r[pk] for r in rs])
+            else:
+                await orm.execute('update `{}` set `{}`=? where `{}` in ({})'
+                                  .format(table, name, pk,
+                                          orm.create_args_string(len(rs))),
+                                  [default] + [r[pk] for r in rs])
+            done += len(rs)
+            last = rs[-1][pk]
+            logging.info('backfill {}.{}: {}/{} rows ({:.0%}), {:.1f}s'.format(
+                table, name, done, total, done / total if total else 1,
+                time.time() - start))
+            if self.sleep:
+                await asyncio.sleep(self.sleep)
+
+
+async def main_async(loop, opts):
+    await orm.create_pool(loop=loop, **dict(configs.db.items(), keepalive=0))
+    try:
+        live = await load_live_schema(configs.db.db)
+        steps = diff(live)
+        if not steps:
+            logging.info('schema is up to date.')
+        elif opts.command == 'diff':
+            for step in steps:
+                print(step)
+        else:
+            await Migrator(batch_size=opts.batch_size, sleep=opts.sleep,
+                           dry_run=opts.dry_run,
+                           allow_locking=opts.allow_locking).run(steps)
+    finally:
+        await orm.close_pool()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='schema')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('generate', help='generate DDL from models')
+    p.add_argument('-o', '--output', help='write to file instead of stdout')
+    sub.add_parser('diff', help='diff models against the live database')
+    p = sub.add_parser('migrate', help='apply the diff online')
+    p.add_argument('--batch-size', type=int, default=1000,
+                   help='rows per backfill batch')
+    p.add_argument('--sleep', type=float, default=0.05,
+                   help='seconds to sleep between backfill batches')
+    p.add_argument('--dry-run', action='store_true',
+                   help='only print the statements')
+    p.add_argument('--allow-locking', action='store_true',
+                   help='allow DDL that cannot run with lock=none')
+    opts = parser.parse_args(argv)
+    if opts.command == 'generate':
+        sql = generate()
+        if opts.output:
+            with open(opts.output, 'w') as f:
+                f.write(sql)
+        else:
+            sys.stdout.write(sql)
+        return 0
+    if opts.command is None:
+        parser.print_help()
+        return 1
+    backend = configs.db.backend
+    if backend != 'mysql':
+        sys.stderr.write('schema {}: db.backend is {!r}, only mysql is '
+                         'supported\n'.format(opts.command, backend))
+        return 1
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main_async(loop, opts))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 -- schema.sql
+-- generated by: python3 schema.py generate
 -- execute in bash: mysql -u root -p < schema.sql
 
 drop database if exists pure_blog;
@@ -7,11 +8,11 @@ use pure_blog;
 grant select, insert, update, delete on pure_blog.* to 'iamswf'@'localhost' identified by 'iamswf';
 
 
-create table users (
+create table `users` (
     `id` varchar(50) not null,
     `email` varchar(50) not null,
     `passwd` varchar(50) not null,
-    `admin` bool not null,
+    `admin` boolean not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
     `created_at` real not null,
@@ -21,7 +22,7 @@ create table users (
 ) engine=innodb default charset=utf8;
 
 
-create table blogs (
+create table `blogs` (
     `id` varchar(50) not null,
     `user_id` varchar(50) not null,
     `user_name` varchar(50) not null,
@@ -30,12 +31,17 @@ create table blogs (
     `summary` varchar(200) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    `summary_html` text not null,
+    `excerpt` varchar(200) not null,
+    `word_count` bigint not null,
+    `reading_time` bigint not null,
+    `toc_html` text not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
 
-create table comments (
+create table `comments` (
     `id` varchar(50) not null,
     `blog_id` varchar(50) not null,
     `user_id` varchar(50) not null,
@@ -43,6 +49,8 @@ create table comments (
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    `html_content` mediumtext not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
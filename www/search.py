@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    文章和评论的全文搜索
+
+    倒排索引: 中文按相邻两字切分(bigram)，单独一个汉字也作为一个词，
+    其他语言按词并转小写。每个词的posting list是两个array('I')，
+    分别存文档号和词频，文档号递增。查询按BM25打分。
+
+    索引分两部分:
+        base    持久化在索引文件里，mmap进来直接按偏移读取，不做反序列化，
+                多个worker共享page cache，启动时不用扫库
+        delta   进程内新增/修改的文档，追加在内存里
+    修改或删除只是把旧文档号标记为删除，查询时跳过。
+    全量建索引时的分词和查询打分都是纯CPU的，放到executor里执行，
+    不占用事件循环。
+
+    索引文件每rebuild_interval秒从库里全量重建一次(同时清掉已删除的文档)，
+    原子替换。每个worker都有这个定时器，但只有拿到锁文件、并且文件的
+    built_at早于rebuild_interval秒前的worker才真正重建，其他worker看到
+    文件刚被重建过就跳过，所以每个周期只扫一次库。
+    各worker每refresh_interval秒检查文件是否更新过，重新mmap，
+    并重放重建开始之后本进程的修改。
+
+    重建索引文件: python3 search.py
+'''
+
+import os
+import re
+import sys
+import json
+import math
+import mmap
+import time
+import fcntl
+import heapq
+import struct
+import asyncio
+import logging
+from array import array
+from collections import Counter, deque
+import orm
+from models import Blog, Comment
+
+
+MAGIC = b'BLOGIDX1'
+# BM25参数
+K1 = 1.2
+B = 0.75
+
+_CJK = r'\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_RE_TOKEN = re.compile(r'[{0}]+|[^\W{0}]+'.format(_CJK))
+_RE_CJK = re.compile('[{}]'.format(_CJK))
+
+_HEADER = struct.Struct('<8sQ')
+
+
+def tokenize(text):
+    '''
+        中文连续的字切成bigram，其他按词
+    '''
+    tokens = []
+    for s in _RE_TOKEN.findall(text.lower()):
+        if _RE_CJK.match(s):
+            if len(s) == 1:
+                tokens.append(s)
+            else:
+                tokens.extend(s[i:i + 2] for i in range(len(s) - 1))
+        else:
+            tokens.append(s)
+    return tokens
+
+
+def blog_text(blog):
+    return '\n'.join([blog.name or '', blog.summary or '', blog.content or ''])
+
+
+def comment_text(comment):
+    return comment.content or ''
+
+
+class SearchIndex(object):
+
+    def __init__(self):
+        # 文档号 -> (kind, id)
+        self._keys = []
+        # (kind, id) -> 文档号，只含未删除的
+        self._docno = {}
+        self._lengths = array('I')
+        self._total_length = 0
+        self._deleted = set()
+        # base: term -> [offset, count]，postings在_view里
+        self._terms = {}
+        self._view = None
+        self._mm = None
+        # delta: term -> (docnos, tfs)
+        self._delta = {}
+        self.built_at = 0.0
+
+    def __len__(self):
+        return len(self._docno)
+
+    def add(self, kind, id, text):
+        self.remove(kind, id)
+        tokens = tokenize(text)
+        d = len(self._keys)
+        self._keys.append((kind, id))
+        self._docno[(kind, id)] = d
+        self._lengths.append(len(tokens))
+        self._total_length += len(tokens)
+        for term, tf in Counter(tokens).items():
+            p = self._delta.get(term)
+            if p is None:
+                p = self._delta[term] = (array('I'), array('I'))
+            p[0].append(d)
+            p[1].append(tf)
+
+    def remove(self, kind, id):
+        d = self._docno.pop((kind, id), None)
+        if d is not None:
+            self._deleted.add(d)
+            self._total_length -= self._lengths[d]
+
+    def _postings(self, term):
+        '''
+            依次返回base和delta里的(docnos, tfs)，含已删除的文档
+        '''
+        t = self._terms.get(term)
+        if t is not None:
+            offset, count = t
+            yield (self._view[offset:offset + 4 * count].cast('I'),
+                   self._view[offset + 4 * count:offset + 8 * count].cast('I'))
+        p = self._delta.get(term)
+        if p is not None:
+            yield p
+
+    def search(self, query, kind=None, limit=20):
+        '''
+            返回按BM25分数倒序的[(kind, id, score)]，多个词之间是OR，
+            命中的词越多分数越高
+        '''
+        n = len(self._docno)
+        if not n:
+            return []
+        avgdl = self._total_length / n or 1.0
+        lengths, deleted = self._lengths, self._deleted
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = list(self._postings(term))
+            # 已删除文档还留在posting里，df略偏大，重建后恢复准确
+            df = min(sum(len(docnos) for docnos, _ in postings), n)
+            if not df:
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for docnos, tfs in postings:
+                for d, tf in zip(docnos, tfs):
+                    if d in deleted:
+                        continue
+                    norm = K1 * (1 - B + B * lengths[d] / avgdl)
+                    scores[d] = scores.get(d, 0.0) + \
+                        idf * tf * (K1 + 1) / (tf + norm)
+        keys = self._keys
+        if kind is not None:
+            scores = dict((d, s) for d, s in scores.items()
+                          if keys[d][0] == kind)
+        top = heapq.nlargest(limit, scores.items(), key=lambda x: x[1])
+        return [(keys[d][0], keys[d][1], s) for d, s in top]
+
+    def write(self, path):
+        '''
+            去掉已删除的文档，重新编号后写入path，原子替换。
+            文件格式: MAGIC | header长度 | header(json) | 对齐到8字节 | 数据，
+            数据里每个词依次是docnos和tfs两个uint32数组，最后是文档长度数组。
+        '''
+        live = [d for d in range(len(self._keys)) if d not in self._deleted]
+        remap = dict((old, new) for new, old in enumerate(live))
+        terms, chunks, offset = {}, [], 0
+        for term in sorted(set(self._terms) | set(self._delta)):
+            docnos, tfs = array('I'), array('I')
+            for ds, ts in self._postings(term):
+                for d, tf in zip(ds, ts):
+                    new = remap.get(d)
+                    if new is not None:
+                        docnos.append(new)
+                        tfs.append(tf)
+            if not docnos:
+                continue
+            terms[term] = [offset, len(docnos)]
+            chunks.append(docnos.tobytes())
+            chunks.append(tfs.tobytes())
+            offset += 8 * len(docnos)
+        lengths = array('I', (self._lengths[d] for d in live))
+        header = json.dumps(dict(
+            byteorder=sys.byteorder, built_at=self.built_at,
+            docs=[self._keys[d] for d in live], lengths=offset,
+            terms=terms), ensure_ascii=False).encode('utf-8')
+        pad = -(_HEADER.size + len(header)) % 8
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, len(header)))
+            f.write(header)
+            f.write(b'\0' * pad)
+            for chunk in chunks:
+                f.write(chunk)
+            f.write(lengths.tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def open(cls, path):
+        '''
+            mmap索引文件，posting list不复制，查询时直接从映射里读
+        '''
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size = _HEADER.unpack_from(mm)
+        if magic != MAGIC:
+            raise ValueError('not a search index: {}'.format(path))
+        header = json.loads(mm[_HEADER.size:_HEADER.size + size]
+                            .decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('search index byteorder mismatch')
+        start = _HEADER.size + size
+        start += -start % 8
+        index = cls()
+        index._mm = mm
+        index._view = memoryview(mm)[start:]
+        index._terms = header['terms']
+        index._keys = [tuple(k) for k in header['docs']]
+        index._docno = dict((k, d) for d, k in enumerate(index._keys))
+        offset = header['lengths']
+        index._lengths.frombytes(
+            index._view[offset:offset + 4 * len(index._keys)])
+        index._total_length = sum(index._lengths)
+        index.built_at = header['built_at']
+        return index
+
+
+def build_index(docs, built_at):
+    '''
+        docs为[(kind, id, text)]，分词建索引，在executor里运行
+    '''
+    index = SearchIndex()
+    index.built_at = built_at
+    for kind, id, text in docs:
+        index.add(kind, id, text)
+    return index
+
+
+async def build(batch_size=500):
+    '''
+        从库里按主键分批读出全部文档，再到executor里建索引
+    '''
+    built_at = time.time()
+    docs = []
+    for model, kind, columns, text in [
+            (Blog, 'blog', ['name', 'summary', 'content'], blog_text),
+            (Comment, 'comment', ['content'], comment_text)]:
+        last = ''
+        while True:
+            rs = await model.findAll('`id`>?', [last], columns=columns,
+                                     orderBy='`id`', limit=batch_size)
+            docs.extend((kind, r.id, text(r)) for r in rs)
+            if len(rs) < batch_size:
+                break
+            last = rs[-1].id
+    index = await asyncio.get_event_loop().run_in_executor(
+        None, build_index, docs, built_at)
+    logging.info('search index built: {} docs'.format(len(index)))
+    return index
+
+
+class Searcher(object):
+    '''
+        持有当前的索引，跟踪本进程的修改，负责重建和重新加载
+    '''
+
+    def __init__(self, path, max_log=10000):
+        self.path = path
+        self.index = SearchIndex()
+        self._mtime = None
+        # 本进程的修改: (time, kind, id, text)，text为None表示删除
+        self._log = deque(maxlen=max_log)
+
+    async def search(self, query, kind=None, limit=20):
+        '''
+            在executor里打分，期间的修改只是追加delta和标记删除
+        '''
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.index.search, query, kind, limit)
+
+    def _apply(self, kind, id, text):
+        if text is None:
+            self.index.remove(kind, id)
+        else:
+            self.index.add(kind, id, text)
+
+    def _record(self, kind, id, text):
+        self._log.append((time.time(), kind, id, text))
+        self._apply(kind, id, text)
+
+    def on_blog(self, blog, event):
+        self._record('blog', blog.id,
+                     None if event == 'remove' else blog_text(blog))
+
+    def on_comment(self, comment, event):
+        self._record('comment', comment.id,
+                     None if event == 'remove' else comment_text(comment))
+
+    def reload(self):
+        '''
+            文件更新过时重新mmap，重放文件构建之后的本地修改
+        '''
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return False
+        index = SearchIndex.open(self.path)
+        self._mtime = mtime
+        self.index = index
+        while self._log and self._log[0][0] < index.built_at:
+            self._log.popleft()
+        for _, kind, id, text in self._log:
+            self._apply(kind, id, text)
+        logging.info('search index loaded: {} docs'.format(len(index)))
+        return True
+
+    def _try_lock(self):
+        f = open(self.path + '.lock', 'w')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+        return f
+
+    async def rebuild(self, max_age=None):
+        '''
+            拿到锁的worker重建索引文件，拿不到说明别的worker在做，直接返回。
+            max_age不为None时，文件在max_age秒内重建过就不再重建
+        '''
+        lock = self._try_lock()
+        if lock is None:
+            return False
+        try:
+            if max_age is not None:
+                # 拿到锁之后再看文件，别的worker可能刚重建完
+                self.reload()
+                if self._mtime is not None and \
+                        self.index.built_at > time.time() - max_age:
+                    return False
+            index = await build()
+            await asyncio.get_event_loop().run_in_executor(
+                None, index.write, self.path)
+        finally:
+            lock.close()
+        self.reload()
+        return True
+
+
+searcher = Searcher('search.idx')
+
+
+async def search(query, kind=None, limit=20):
+    return await searcher.search(query, kind, limit)
+
+
+def setup(app, path='search.idx', refresh_interval=10, rebuild_interval=600,
+          max_results=50):
+    '''
+        startup时加载索引文件，文件不存在或损坏就重建；注册Blog和Comment的
+        listener。path是相对www目录的路径。max_results由handlers每次请求时
+        从config读取。
+    '''
+    global searcher
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    searcher = Searcher(path)
+    tasks = []
+
+    async def periodic(interval, fn):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                r = fn()
+                if asyncio.iscoroutine(r):
+                    await r
+            except Exception as e:
+                logging.warning('search index {} failed: {}'
+                                .format(fn.__name__, e))
+
+    async def on_startup(app):
+        orm.add_listener(Blog, searcher.on_blog)
+        orm.add_listener(Comment, searcher.on_comment)
+        try:
+            searcher.reload()
+        except Exception as e:
+            logging.warning('load search index failed: {}'.format(e))
+        if searcher._mtime is None:
+            # 别的worker正在重建时这里返回False，等下次refresh加载
+            await searcher.rebuild()
+        if refresh_interval:
+            tasks.append(asyncio.ensure_future(
+                periodic(refresh_interval, searcher.reload)))
+        if rebuild_interval:
+            # 文件比一个周期稍新就跳过，留出定时器之间的误差
+            max_age = rebuild_interval * 0.9
+
+            async def rebuild():
+                await searcher.rebuild(max_age)
+            tasks.append(asyncio.ensure_future(
+                periodic(rebuild_interval, rebuild)))
+
+    async def on_shutdown(app):
+        orm.remove_listener(Blog, searcher.on_blog)
+        orm.remove_listener(Comment, searcher.on_comment)
+        for task in tasks:
+            task.cancel()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+
+
+async def main_async(loop):
+    import config
+    path = config.configs.search.path
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    await orm.create_pool(loop=loop,
+                          **dict(config.configs.db.items(), keepalive=0))
+    try:
+        index = await build()
+        index.write(path)
+    finally:
+        await orm.close_pool()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main_async(loop))
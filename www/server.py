@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    启动HTTP服务: 用AppRunner/TCPSite代替loop.create_server(app.make_handler())，
+    keepalive、backlog、请求行/header大小上限和access log都从config.server读取。
+    uvloop=True且已安装uvloop时使用uvloop的事件循环。
+
+    SIGTERM/SIGINT让每个worker停止事件循环并执行runner.cleanup()，
+    on_shutdown/on_cleanup(评论队列写库、关闭连接池等)都会执行；
+    workers > 1时父进程把信号转发给子进程。
+    shutdown_timeout设置在AppRunner上，需要aiohttp >= 3.9。
+'''
+
+import os
+import signal
+import asyncio
+import logging
+from aiohttp import web
+import config
+
+
+def new_event_loop(use_uvloop=True):
+    '''
+        返回(loop, 实现名)，没装uvloop时退回asyncio默认的事件循环
+    '''
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            logging.info('uvloop not installed, use asyncio event loop')
+        else:
+            return uvloop.new_event_loop(), 'uvloop'
+    return asyncio.new_event_loop(), 'asyncio'
+
+
+def runner_options(server):
+    '''
+        传给AppRunner(最终给每个连接的RequestHandler)的参数
+    '''
+    options = dict(shutdown_timeout=server.shutdown_timeout,
+                   keepalive_timeout=server.keepalive_timeout,
+                   max_line_size=server.max_line_size,
+                   max_field_size=server.max_field_size)
+    if server.access_log:
+        options['access_log_format'] = server.access_log_format
+    else:
+        options['access_log'] = None
+    return options
+
+
+async def start(app, server):
+    '''
+        运行app的startup并开始监听，返回runner，用runner.cleanup()关闭
+    '''
+    runner = web.AppRunner(app, **runner_options(server))
+    await runner.setup()
+    site = web.TCPSite(runner, server.host, server.port,
+                       backlog=server.backlog,
+                       reuse_port=server.workers > 1)
+    await site.start()
+    return runner
+
+
+def install_stop_handler(loop, children=()):
+    '''
+        SIGTERM/SIGINT时停止事件循环，并转发给children。
+        只处理第一次信号，cleanup期间再收到的信号忽略，
+        否则loop.stop()会打断run_until_complete(runner.cleanup())
+    '''
+    stopping = False
+
+    def stop(sig):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        logging.info('received {}, shutting down (pid {})...'
+                     .format(signal.Signals(sig).name, os.getpid()))
+        for pid in children:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+        loop.stop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop, sig)
+
+
+def run(app_factory, children=()):
+    '''
+        单个worker: 新建事件循环，用app_factory()创建app并启动，
+        直到收到SIGTERM/SIGINT，然后执行runner.cleanup()。
+        children是父进程fork出的其他worker，信号转发给它们
+    '''
+    server = config.configs.server
+    loop, name = new_event_loop(server.uvloop)
+    asyncio.set_event_loop(loop)
+    runner = None
+    try:
+        app = loop.run_until_complete(app_factory())
+        runner = loop.run_until_complete(start(app, server))
+        install_stop_handler(loop, children)
+        config.install_sighup_handler(loop, children)
+        logging.info('server started at http://{}:{} (pid {}, {})...'
+                     .format(server.host, server.port, os.getpid(), name))
+        loop.run_forever()
+    finally:
+        if runner is not None:
+            loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
+def main(app_factory):
+    '''
+        workers > 1时fork出多个进程，通过SO_REUSEPORT共享端口
+    '''
+    children = []
+    for _ in range(config.configs.server.workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            run(app_factory)
+            os._exit(0)
+        children.append(pid)
+    run(app_factory, children)
+    for pid in children:
+        os.waitpid(pid, 0)
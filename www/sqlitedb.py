@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    SQLite后端(db.backend = 'sqlite')，用于单机部署
+
+    用标准库sqlite3，查询放到线程池里执行，不阻塞事件循环:
+        写  一个专用的写连接，单线程executor，所有insert/update/delete排队执行
+        读  sqlite_readers个只读连接，每个线程一个，读之间以及读和写之间
+            靠WAL并发，读不会被写挡住
+    连接都是autocommit，写完成后读连接立刻能看到。
+    server.workers > 1时每个进程各有一个写连接，写锁冲突靠busy_timeout等待。
+
+    orm生成的是MySQL方言，执行前翻译一次并按SQL文本缓存:
+        `name`        -> "name"
+        limit ?, ?    -> limit ? offset ?(最后两个参数对调)
+    其余(?占位符、count(*) _num_、like、in)两边写法相同。
+
+    sqlite_path不存在时新建，create_tables为真时按models建表和索引。
+    只建表不迁移: 表已经存在时不会加上models里新增的列(schema.py只支持
+    MySQL)，启动时用pragma table_info检查，缺列时打warning，需要手工
+    alter table。
+'''
+
+import os
+import re
+import sqlite3
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from orm import Backend, Model
+
+
+_RE_LIMIT = re.compile(r'\blimit \?, ?\?$', re.I)
+
+
+def translate(sql):
+    '''
+        MySQL方言 -> SQLite，返回(sql, 是否对调最后两个参数)
+    '''
+    sql = sql.strip().replace('`', '"')
+    sql, n = _RE_LIMIT.subn('limit ? offset ?', sql)
+    return sql, n > 0
+
+
+def create_table_sql(model):
+    '''
+        单张表的create table和create index语句。
+        SQLite的索引名在库内全局唯一，加上表名前缀
+    '''
+    columns = ['"{}" {} not null{}'.format(
+        name, model.__mappings__[name].column_type,
+        ' primary key' if name == model.__primary_key__ else '')
+        for name in [model.__primary_key__] + model.__fields__]
+    L = ['create table if not exists "{}" (\n    {}\n)'.format(
+        model.__table__, ',\n    '.join(columns))]
+    for name, keys, unique in model.__indexes__:
+        L.append('create {}index if not exists "{}_{}" on "{}" ({})'.format(
+            'unique ' if unique else '', model.__table__, name,
+            model.__table__, ', '.join('"{}"'.format(k) for k in keys)))
+    return L
+
+
+def missing_columns(conn, model):
+    '''
+        已有的表里缺少的model列
+    '''
+    live = set(r[1] for r in conn.execute(
+        'pragma table_info("{}")'.format(model.__table__)))
+    return [name for name in [model.__primary_key__] + model.__fields__
+            if name not in live]
+
+
+def all_models():
+    import models
+    return [cls for cls in vars(models).values()
+            if isinstance(cls, type) and issubclass(cls, Model) and
+            cls is not Model]
+
+
+class SQLiteBackend(Backend):
+
+    def __init__(self):
+        self.path = None
+        self._writer = None
+        self._readers = None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        # 原SQL -> (翻译后的SQL, 是否对调limit参数)
+        self._translated = {}
+
+    async def connect(self, loop=None, sqlite_path='pure_blog.db',
+                      sqlite_readers=4, create_tables=True, **kw):
+        if not os.path.isabs(sqlite_path):
+            sqlite_path = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), sqlite_path)
+        self.path = sqlite_path
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='sqlite-w')
+        self._readers = ThreadPoolExecutor(sqlite_readers,
+                                           thread_name_prefix='sqlite-r')
+        await self._run(self._writer, self._setup, create_tables)
+        logging.info('sqlite database ready: {} (1 writer, {} readers)'
+                     .format(self.path, sqlite_readers))
+
+    def _open(self, readonly):
+        conn = sqlite3.connect(self.path, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('pragma busy_timeout = 5000')
+        if readonly:
+            conn.execute('pragma query_only = 1')
+        else:
+            conn.execute('pragma journal_mode = wal')
+            # WAL下NORMAL只在checkpoint时fsync，掉电最多丢最后几个事务
+            conn.execute('pragma synchronous = normal')
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def _conn(self, readonly):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._open(readonly)
+        return conn
+
+    def _setup(self, create_tables):
+        conn = self._conn(False)
+        if create_tables:
+            for model in all_models():
+                for sql in create_table_sql(model):
+                    conn.execute(sql)
+                missing = missing_columns(conn, model)
+                if missing:
+                    logging.warning(
+                        'sqlite table {} is missing columns {}, tables are '
+                        'not migrated, alter table by hand'.format(
+                            model.__table__, missing))
+
+    async def _run(self, executor, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(
+            executor, fn, *args)
+
+    def _translate(self, sql, args):
+        t = self._translated.get(sql)
+        if t is None:
+            t = self._translated[sql] = translate(sql)
+        sql, swap = t
+        args = list(args or ())
+        if swap:
+            args[-2], args[-1] = args[-1], args[-2]
+        return sql, args
+
+    def _select(self, sql, args, size):
+        cur = self._conn(True).execute(sql, args)
+        try:
+            rs = cur.fetchmany(size) if size else cur.fetchall()
+            names = [d[0] for d in cur.description]
+        finally:
+            cur.close()
+        return [dict(zip(names, r)) for r in rs]
+
+    def _execute(self, sql, args):
+        cur = self._conn(False).execute(sql, args)
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def select(self, sql, args, size=None):
+        sql, args = self._translate(sql, args)
+        return await self._run(self._readers, self._select, sql, args, size)
+
+    async def execute(self, sql, args):
+        sql, args = self._translate(sql, args)
+        return await self._run(self._writer, self._execute, sql, args)
+
+    def is_duplicate_key(self, e):
+        return isinstance(e, sqlite3.IntegrityError) and \
+            'UNIQUE constraint failed' in str(e)
+
+    async def close(self):
+        '''
+            等排队的查询执行完再关闭连接
+        '''
+        for executor in (self._readers, self._writer):
+            if executor is not None:
+                await self._run(None, executor.shutdown)
+        self._readers = self._writer = None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
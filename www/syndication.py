@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    RSS/Atom订阅和sitemap
+
+    文档在文章变化时生成一次: 编码成utf-8、gzip压缩好存在内存里，
+    请求时直接返回，不查库也不渲染。ETag是内容的hash，
+    内容没变时重新生成会沿用旧的ETag和Last-Modified，客户端带
+    If-None-Match/If-Modified-Since来时返回304。
+
+    sitemap每个文件最多SITEMAP_URLS条，超过时/sitemap.xml是sitemap索引，
+    分页在/sitemap-{n}.xml。大于chunk_size的响应分块写出。
+
+    本进程里Blog的修改通过orm的listener触发重新生成(合并debounce秒内的
+    多次修改)，别的worker的修改靠每refresh_interval秒一次的后台重新生成。
+'''
+
+import gzip
+import time
+import asyncio
+import hashlib
+import logging
+from email.utils import formatdate, parsedate_to_datetime
+from xml.sax.saxutils import escape
+from aiohttp import web
+import orm
+from models import Blog
+
+
+# sitemap协议规定单个文件最多50000条
+SITEMAP_URLS = 50000
+
+FEED_COLUMNS = ['user_name', 'name', 'summary_html', 'excerpt', 'created_at']
+
+
+class Document(object):
+    '''
+        生成好的响应体: 原文和gzip压缩后的两份bytes
+    '''
+
+    def __init__(self, body, content_type, last_modified=None):
+        self.body = body
+        self.gzipped = gzip.compress(body, 6)
+        self.content_type = content_type
+        self.etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+        self.gzip_etag = self.etag[:-1] + '-gzip"'
+        self.last_modified = int(last_modified or time.time())
+
+    def not_modified(self, request):
+        '''
+            有If-None-Match时只看它，否则看If-Modified-Since
+        '''
+        inm = request.headers.get('If-None-Match')
+        if inm is not None:
+            tags = [t.strip() for t in inm.split(',')]
+            if '*' in tags:
+                return True
+            # 弱比较: 忽略W/前缀，压缩与否都算同一份内容
+            tags = [t[2:] if t.startswith('W/') else t for t in tags]
+            return self.etag in tags or self.gzip_etag in tags
+        ims = request.headers.get('If-Modified-Since')
+        if ims is None:
+            return False
+        try:
+            return self.last_modified <= parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+
+def _accepts_gzip(request):
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() != 'gzip':
+            continue
+        params = params.replace(' ', '')
+        if not params.startswith('q='):
+            return True
+        try:
+            return float(params[2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def _rfc822(t):
+    return formatdate(t, usegmt=True)
+
+
+def _rfc3339(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+
+def _blog_url(base_url, blog):
+    return '{}/blog/{}'.format(base_url, blog.id)
+
+
+def rss(blogs, base_url, title, description):
+    L = ['<?xml version="1.0" encoding="utf-8"?>\n'
+         '<rss version="2.0"><channel>',
+         '<title>{}</title><link>{}/</link><description>{}</description>'
+         .format(escape(title), escape(base_url), escape(description))]
+    if blogs:
+        L.append('<lastBuildDate>{}</lastBuildDate>'
+                 .format(_rfc822(blogs[0].created_at)))
+    for b in blogs:
+        url = escape(_blog_url(base_url, b))
+        L.append('<item><title>{}</title><link>{}</link>'
+                 '<guid isPermaLink="true">{}</guid>'
+                 '<pubDate>{}</pubDate><description>{}</description></item>'
+                 .format(escape(b.name or ''), url, url,
+                         _rfc822(b.created_at),
+                         escape(b.summary_html or b.excerpt or '')))
+    L.append('</channel></rss>\n')
+    return ''.join(L)
+
+
+def atom(blogs, base_url, title, description):
+    updated = blogs[0].created_at if blogs else 0
+    L = ['<?xml version="1.0" encoding="utf-8"?>\n'
+         '<feed xmlns="http://www.w3.org/2005/Atom">',
+         '<title>{}</title><subtitle>{}</subtitle>'
+         '<link href="{}/"/><link rel="self" href="{}/atom.xml"/>'
+         '<id>{}/</id><updated>{}</updated>'
+         .format(escape(title), escape(description), escape(base_url),
+                 escape(base_url), escape(base_url), _rfc3339(updated))]
+    for b in blogs:
+        url = escape(_blog_url(base_url, b))
+        L.append('<entry><title>{}</title><link href="{}"/><id>{}</id>'
+                 '<author><name>{}</name></author>'
+                 '<published>{}</published><updated>{}</updated>'
+                 '<summary type="html">{}</summary></entry>'
+                 .format(escape(b.name or ''), url, url,
+                         escape(b.user_name or ''), _rfc3339(b.created_at),
+                         _rfc3339(b.created_at),
+                         escape(b.summary_html or b.excerpt or '')))
+    L.append('</feed>\n')
+    return ''.join(L)
+
+
+def sitemap(blogs, base_url):
+    L = ['<?xml version="1.0" encoding="utf-8"?>\n'
+         '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for b in blogs:
+        L.append('<url><loc>{}</loc><lastmod>{}</lastmod></url>'.format(
+            escape(_blog_url(base_url, b)), _rfc3339(b.created_at)))
+    L.append('</urlset>\n')
+    return ''.join(L)
+
+
+def sitemap_index(n, base_url, lastmod):
+    L = ['<?xml version="1.0" encoding="utf-8"?>\n'
+         '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for i in range(1, n + 1):
+        L.append('<sitemap><loc>{}/sitemap-{}.xml</loc>'
+                 '<lastmod>{}</lastmod></sitemap>'.format(
+                     escape(base_url), i, _rfc3339(lastmod)))
+    L.append('</sitemapindex>\n')
+    return ''.join(L)
+
+
+async def _all_blogs(batch_size=1000):
+    '''
+        sitemap用: 只读id和created_at，按(created_at, id)倒序分批
+    '''
+    blogs, where, args = [], None, None
+    while True:
+        rs = await Blog.findAll(where, args, columns=['created_at'],
+                                orderBy='`created_at` desc, `id` desc',
+                                limit=batch_size)
+        blogs.extend(rs)
+        if len(rs) < batch_size:
+            return blogs
+        last = rs[-1]
+        where = '`created_at`<? or (`created_at`=? and `id`<?)'
+        args = [last.created_at, last.created_at, last.id]
+
+
+class Syndication(object):
+
+    def __init__(self, base_url='', title='', description='', feed_items=20,
+                 chunk_size=65536):
+        self.base_url = base_url.rstrip('/')
+        self.title = title
+        self.description = description
+        self.feed_items = feed_items
+        self.chunk_size = chunk_size
+        # 路径 -> Document
+        self._docs = {}
+        # 等待中的TimerHandle或正在生成的Task
+        self._pending = None
+        # 生成期间又有修改时记下delay，生成完再安排一次
+        self._dirty = None
+
+    def get(self, name):
+        return self._docs.get(name)
+
+    def _build(self, latest, blogs):
+        '''
+            生成全部文档的文本，在executor里运行
+        '''
+        texts = {
+            'rss.xml': (rss(latest, self.base_url, self.title,
+                            self.description), 'application/rss+xml'),
+            'atom.xml': (atom(latest, self.base_url, self.title,
+                              self.description), 'application/atom+xml'),
+        }
+        pages = [blogs[i:i + SITEMAP_URLS]
+                 for i in range(0, len(blogs), SITEMAP_URLS)] or [[]]
+        if len(pages) == 1:
+            texts['sitemap.xml'] = (sitemap(pages[0], self.base_url),
+                                    'application/xml')
+        else:
+            texts['sitemap.xml'] = (sitemap_index(
+                len(pages), self.base_url, blogs[0].created_at),
+                'application/xml')
+            for i, page in enumerate(pages, 1):
+                texts['sitemap-{}.xml'.format(i)] = (
+                    sitemap(page, self.base_url), 'application/xml')
+        docs = {}
+        for name, (text, content_type) in texts.items():
+            body = text.encode('utf-8')
+            old = self._docs.get(name)
+            if old is not None and old.body == body:
+                docs[name] = old
+            else:
+                docs[name] = Document(body, content_type)
+        return docs
+
+    async def refresh(self):
+        latest = await Blog.findAll(columns=FEED_COLUMNS,
+                                    orderBy='`created_at` desc',
+                                    limit=self.feed_items)
+        blogs = await _all_blogs()
+        self._docs = await asyncio.get_event_loop().run_in_executor(
+            None, self._build, latest, blogs)
+        logging.info('syndication documents generated: {} blogs'
+                     .format(len(blogs)))
+
+    def schedule(self, delay):
+        '''
+            delay秒后重新生成，期间的多次修改只生成一次。
+            正在生成时的修改可能没有被读到，生成完后再来一次
+        '''
+        if isinstance(self._pending, asyncio.Future):
+            self._dirty = delay
+            return
+        if self._pending is not None:
+            return
+        loop = asyncio.get_event_loop()
+
+        def run():
+            self._pending = asyncio.ensure_future(self.refresh())
+            self._pending.add_done_callback(self._done)
+
+        self._pending = loop.call_later(delay, run)
+
+    def _done(self, task):
+        self._pending = None
+        delay, self._dirty = self._dirty, None
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logging.warning('generate syndication documents failed: {}'
+                            .format(task.exception()))
+        if delay is not None:
+            self.schedule(delay)
+
+    async def serve(self, request, name):
+        doc = self._docs.get(name)
+        if doc is None:
+            raise web.HTTPNotFound()
+        gzipped = _accepts_gzip(request)
+        headers = {
+            'ETag': doc.gzip_etag if gzipped else doc.etag,
+            'Last-Modified': _rfc822(doc.last_modified),
+            'Cache-Control': 'public, max-age=0, must-revalidate',
+            'Vary': 'Accept-Encoding'
+        }
+        if doc.not_modified(request):
+            return web.Response(status=304, headers=headers)
+        body = doc.gzipped if gzipped else doc.body
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+        if len(body) <= self.chunk_size:
+            resp = web.Response(body=body, headers=headers)
+            resp.content_type = doc.content_type
+            return resp
+        resp = web.StreamResponse(headers=headers)
+        resp.content_type = doc.content_type
+        resp.content_length = len(body)
+        await resp.prepare(request)
+        view = memoryview(body)
+        for i in range(0, len(body), self.chunk_size):
+            await resp.write(view[i:i + self.chunk_size])
+        await resp.write_eof()
+        return resp
+
+
+syndication = Syndication()
+
+
+async def serve(request, name):
+    return await syndication.serve(request, name)
+
+
+def setup(app, refresh_interval=300, debounce=1.0, **kw):
+    '''
+        startup时生成一次并注册listener；refresh_interval秒重新生成一次，
+        0表示不刷新
+    '''
+    global syndication
+    syndication = Syndication(**kw)
+    task = None
+
+    def on_change(blog, event):
+        syndication.schedule(debounce)
+
+    async def periodic():
+        # 和修改触发的生成走同一个schedule，不会同时生成两份、
+        # 后完成的旧结果覆盖新的
+        while True:
+            await asyncio.sleep(refresh_interval)
+            syndication.schedule(0)
+
+    async def on_startup(app):
+        nonlocal task
+        await syndication.refresh()
+        orm.add_listener(Blog, on_change)
+        if refresh_interval:
+            task = asyncio.ensure_future(periodic())
+
+    async def on_shutdown(app):
+        orm.remove_listener(Blog, on_change)
+        if task is not None:
+            task.cancel()
+        if syndication._pending is not None:
+            syndication._pending.cancel()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    评论write-behind写入: 合并批量写、队列满时的server:busy、
+    整批失败后逐条重试、第一页合并tail、stop时不丢评论
+
+    在www目录下运行: python3 -m pytest tests
+'''
+
+import os
+import sys
+import asyncio
+import logging
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+import comments
+from apis import APIBusyError
+from comments import CommentWriter
+from models import Comment
+
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def new_comment(blog_id='b1', **kw):
+    return Comment(blog_id=blog_id, user_id='u1', user_name='Tester',
+                   user_image='about:blank', content='hello', **kw)
+
+
+async def stored(blog_id='b1'):
+    return await Comment.find_number('count(*)', '`blog_id`=?', [blog_id])
+
+
+class CommentWriterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        await orm.create_pool(backend='memory')
+
+    async def asyncTearDown(self):
+        await orm.close_pool()
+
+    async def test_batching(self):
+        w = CommentWriter(flush_interval=0.01)
+        w.start()
+        await asyncio.gather(*(w.put(new_comment()) for _ in range(5)))
+        self.assertEqual(w.unflushed('b1'), 5)
+        await w.stop()
+        self.assertEqual((w.batches, w.flushed, w.dropped), (1, 5, 0))
+        self.assertEqual(w.unflushed('b1'), 0)
+        self.assertEqual(await stored(), 5)
+
+    async def test_max_batch(self):
+        w = CommentWriter(flush_interval=0.01, max_batch=2)
+        w.start()
+        await asyncio.gather(*(w.put(new_comment()) for _ in range(5)))
+        await w.stop()
+        self.assertEqual((w.batches, w.flushed), (3, 5))
+
+    async def test_busy_after_put_timeout(self):
+        w = CommentWriter(put_timeout=0.01)
+        # 没有写入任务消费，放满一条之后put只能等到超时
+        w._queue = asyncio.Queue(maxsize=1)
+        first = await w.put(new_comment())
+        late = new_comment()
+        with self.assertRaises(APIBusyError):
+            await w.put(late)
+        self.assertEqual(w.rejected, 1)
+        self.assertEqual(w.unflushed('b1'), 1)
+        self.assertEqual([c.id for c in w.merge_tail('b1', [])], [first.id])
+
+    async def test_retry_row_by_row(self):
+        w = CommentWriter(flush_interval=0.01, retries=0)
+        # 上次已经写进去的评论再写会主键冲突，算成功
+        written = new_comment()
+        await written.save()
+        good, bad = new_comment(), new_comment()
+        save_all = Comment.save_all
+
+        async def failing_save_all(objs):
+            if any(c.id == bad.id for c in objs):
+                raise RuntimeError('bad row')
+            return await save_all(objs)
+
+        with mock.patch.object(Comment, 'save_all', failing_save_all):
+            w.start()
+            for c in (written, good, bad):
+                await w.put(c)
+            await w.stop()
+        self.assertEqual((w.batches, w.flushed, w.dropped), (0, 2, 1))
+        self.assertEqual(w.unflushed('b1'), 0)
+        self.assertIsNotNone(await Comment.find(good.id))
+        self.assertIsNone(await Comment.find(bad.id))
+        # 丢弃的评论也从tail里去掉
+        self.assertNotIn(bad.id, [c.id for c in w.merge_tail('b1', [])])
+
+    async def test_duplicate_batch_is_not_retried(self):
+        w = CommentWriter(flush_interval=0.01, retries=3)
+        written = new_comment()
+        await written.save()
+        w.start()
+        for c in (written, new_comment()):
+            await w.put(c)
+        with mock.patch('asyncio.sleep', wraps=asyncio.sleep) as sleep:
+            await w.stop()
+        # 主键冲突不按退避重试整批，直接逐条写
+        self.assertNotIn(mock.call(0.1), sleep.call_args_list)
+        self.assertEqual((w.flushed, w.dropped), (2, 0))
+        self.assertEqual(await stored(), 2)
+
+    async def test_stop_saves_late_puts(self):
+        w = CommentWriter(flush_interval=0.05)
+        w.start()
+        await w.put(new_comment())
+        stopping = asyncio.ensure_future(w.stop())
+        await asyncio.sleep(0)
+        # shutdown之后才到的请求直接写库，不会排在结束标记后面
+        late = await w.put(new_comment())
+        await stopping
+        self.assertIsNotNone(await Comment.find(late.id))
+        self.assertEqual(await stored(), 2)
+
+    async def test_stop_drains_behind_marker(self):
+        w = CommentWriter(flush_interval=0.01)
+        w.start()
+        queue = w._queue
+        await w.put(new_comment())
+        stopping = asyncio.ensure_future(w.stop())
+        await asyncio.sleep(0)
+        # 摘下队列之前拿到队列的put可能排在结束标记后面
+        behind = new_comment()
+        queue.put_nowait(behind)
+        await stopping
+        self.assertIsNotNone(await Comment.find(behind.id))
+        self.assertEqual(await stored(), 2)
+
+
+class PageTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        await orm.create_pool(backend='memory')
+        self.writer = comments.writer
+        comments.writer = CommentWriter()
+        # 不启动写入任务，入队的评论一直留在tail里
+        comments.writer._queue = asyncio.Queue()
+
+    async def asyncTearDown(self):
+        comments.writer = self.writer
+        await orm.close_pool()
+
+    async def test_first_page_merges_tail(self):
+        for i in range(3):
+            c = new_comment(created_at=float(i + 1))
+            c.html_content = '<p>old</p>'
+            await c.save()
+        fresh = await comments.writer.put(new_comment(created_at=10.0))
+        rs, cursor = await comments.page('b1', limit=2)
+        self.assertEqual([c.created_at for c in rs], [10.0, 3.0])
+        self.assertEqual(rs[0].id, fresh.id)
+        self.assertEqual(await comments.count('b1'), 4)
+        # 后面的页不合并tail
+        rs, cursor = await comments.page('b1', cursor, limit=2)
+        self.assertEqual([c.created_at for c in rs], [2.0, 1.0])
+        self.assertIsNone(cursor)
+
+    async def test_tail_not_duplicated(self):
+        c = await comments.writer.put(new_comment(created_at=5.0))
+        await c.save()
+        rs, _ = await comments.page('b1')
+        self.assertEqual([r.id for r in rs], [c.id])
+
+
+if __name__ == '__main__':
+    unittest.main()
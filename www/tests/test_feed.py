@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    首页feed: 按created_at倒序、加载期间的修改不被旧快照覆盖、
+    删除后后台补齐
+
+    在www目录下运行: python3 -m pytest tests
+'''
+
+import os
+import sys
+import asyncio
+import logging
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+from feed import Feed
+from models import Blog
+
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def blog_row(i, **kw):
+    row = dict(id='b{:02d}'.format(i), user_id='u1', user_name='user',
+               user_image='about:blank', name='blog {}'.format(i),
+               summary='', summary_html='', excerpt='', word_count=0,
+               reading_time=1, created_at=float(i), content='content')
+    row.update(kw)
+    return row
+
+
+def ids(feed, n=100):
+    return [b.id for b in feed.latest(n)]
+
+
+class FeedTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = await orm.create_pool(backend='memory')
+        self.db.load('blogs', [blog_row(i) for i in range(10)])
+        self.blogs = dict((r.id, r) for r in await Blog.findAll())
+
+    async def asyncTearDown(self):
+        await orm.close_pool()
+
+    async def test_load_and_latest(self):
+        feed = Feed(5)
+        await feed.load()
+        self.assertEqual(ids(feed), ['b09', 'b08', 'b07', 'b06', 'b05'])
+        self.assertEqual(ids(feed, 2), ['b09', 'b08'])
+        self.assertEqual(feed.latest(0), [])
+        # 投影不含content
+        self.assertIsNone(feed.latest(1)[0].get('content'))
+
+    async def test_upsert_and_remove(self):
+        feed = Feed(20)
+        await feed.load()
+        b = self.blogs['b03']
+        b.created_at = 100.0
+        feed.on_change(b, 'update')
+        feed.on_change(Blog(**blog_row(10)), 'save')
+        feed.on_change(self.blogs['b09'], 'remove')
+        self.assertEqual(ids(feed, 3), ['b03', 'b10', 'b08'])
+        self.assertEqual(len(feed), 10)
+
+    async def test_changes_during_load(self):
+        orm.set_latency(0.02)
+        feed = Feed(20)
+        loading = asyncio.ensure_future(feed.load())
+        await asyncio.sleep(0)
+        b = self.blogs['b00']
+        b.name = 'edited'
+        feed.on_change(b, 'update')
+        feed.on_change(Blog(**blog_row(10)), 'save')
+        feed.on_change(self.blogs['b09'], 'remove')
+        await loading
+        self.assertEqual(ids(feed, 2), ['b10', 'b08'])
+        self.assertEqual(feed.latest(100)[-1].name, 'edited')
+        self.assertEqual(feed._recording, [])
+
+    async def test_remove_refills(self):
+        feed = Feed(5)
+        await feed.load()
+        for id in ('b09', 'b08'):
+            await self.db.execute('delete from `blogs` where `id`=?', [id])
+            feed.on_change(self.blogs[id], 'remove')
+        # 第二次删除时第一次补齐还在进行，结束后再补一次
+        self.assertIsNotNone(feed._reloading)
+        while feed._reloading is not None:
+            await asyncio.sleep(0.001)
+        self.assertEqual(ids(feed), ['b07', 'b06', 'b05', 'b04', 'b03'])
+
+    async def test_failed_refill_is_logged(self):
+        feed = Feed(5)
+        await feed.load()
+        await orm.close_pool()
+        with self.assertLogs(level='WARNING') as cm:
+            feed.on_change(self.blogs['b09'], 'remove')
+            while feed._reloading is not None:
+                await asyncio.sleep(0.001)
+        self.assertIn('reload feed failed', '\n'.join(cm.output))
+        self.assertEqual(len(feed), 4)
+        await orm.create_pool(backend='memory')
+
+
+if __name__ == '__main__':
+    unittest.main()
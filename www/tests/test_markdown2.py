@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    markdown_incremental必须和markdown输出一致(handlers.get_blog依赖这一点)
+
+    在www目录下运行: python3 -m pytest tests
+'''
+
+import os
+import re
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown2
+
+
+# 列表项里的HTML块等情况下markdown本身会把占位符原样输出，
+# 两条路径分配的编号不同，比较前抹掉编号
+_RE_PLACEHOLDER = re.compile(r'md5-[0-9a-f]{32}')
+
+EXTRAS = [None, ['toc'], ['fenced-code-blocks'], ['footnotes'],
+          ['header-ids'], ['toc', 'fenced-code-blocks', 'footnotes']]
+
+# 出过问题的形状
+CASES = [
+    '<div>\nhi\n</div>\n\npara',
+    '```\nA\n\nB\n```\n\n```\nA\n\nB\n```',
+    '```\nA\n\nB\n```\n\n\n```python\nx = 1\n\n\ny = 2\n```\n\ntail',
+    '\n\n<!-- comment -->\n\npara',
+    'para\n<!-- comment -->\n\n<!-- comment -->\n',
+    '   ',
+    '',
+    '# Title\n\n## Sub\n\n## Sub\n\ntext[^1]\n\n[^1]: note',
+]
+
+SHAPES = [
+    lambda r: 'para {} with *em*, `code` and [a link](http://x/)'.format(
+        r.randint(0, 9)),
+    lambda r: 'line one\nline two {}'.format(r.randint(0, 9)),
+    lambda r: '# Header {}'.format(r.randint(0, 3)),
+    lambda r: 'Setext {}\n======'.format(r.randint(0, 3)),
+    lambda r: '- a\n- b\n\n- c',
+    lambda r: '1. one\n2. two\n\n    nested para',
+    lambda r: '> quote\n>\n> more',
+    lambda r: '    code line\n\n    more code',
+    lambda r: '```\nA\n\nB\n```',
+    lambda r: '```python\nx = 1\n\n\ny = 2\n```',
+    lambda r: '<div>\nhi\n</div>',
+    lambda r: '<div>\n\ninner\n\n</div>',
+    lambda r: '<!-- comment -->',
+    lambda r: '---',
+    lambda r: '[link][r{}] text'.format(r.randint(0, 2)),
+    lambda r: '[r{0}]: http://example.com/{0}'.format(r.randint(0, 2)),
+    lambda r: 'foot[^f{}] note'.format(r.randint(0, 2)),
+    lambda r: '[^f{}]: the note\n\n    second para'.format(r.randint(0, 2)),
+    lambda r: '中文段落，**加粗**。',
+    lambda r: '   ',
+]
+
+
+def random_document(r):
+    text = r.choice(['', '', '\n', '\n\n'])
+    for _ in range(r.randint(1, 8)):
+        text += r.choice(SHAPES)(r) + r.choice(['\n\n', '\n\n\n', '\n'])
+    return text if r.random() < 0.5 else text.rstrip('\n')
+
+
+def corpus(n=2000, seed=0):
+    r = random.Random(seed)
+    for text in CASES:
+        for extras in EXTRAS:
+            yield text, extras
+    for _ in range(n):
+        yield random_document(r), r.choice(EXTRAS)
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def check(self, text, extras, cache):
+        full = markdown2.markdown(text, extras=extras)
+        inc = markdown2.markdown_incremental(text, cache, extras=extras)
+        self.assertEqual(_RE_PLACEHOLDER.sub('H', inc),
+                         _RE_PLACEHOLDER.sub('H', full),
+                         '{!r} extras={}'.format(text, extras))
+        self.assertEqual(getattr(inc, 'toc_html', None),
+                         getattr(full, 'toc_html', None))
+
+    def test_fresh_cache(self):
+        for text, extras in corpus():
+            self.check(text, extras, markdown2.BlockCache())
+
+    def test_shared_cache(self):
+        # 和线上一样多篇文档共用一个cache，命中的块也要一致
+        cache = markdown2.BlockCache()
+        for text, extras in corpus(seed=1):
+            self.check(text, extras, cache)
+
+    def test_no_empty_paragraph(self):
+        html = markdown2.markdown_incremental(
+            '<div>\nhi\n</div>\n\npara', markdown2.BlockCache())
+        self.assertFalse(html.startswith('<p></p>'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    内存数据库后端: 模块docstring里列出的SQL形式、where的and/or/括号、
+    in/like、limit ?和limit ?, ?、写入后索引和数据一致、不支持的写法
+
+    在www目录下运行: python3 -m pytest tests
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import memdb
+from memdb import MemoryBackend, IntegrityError, UnsupportedSQL
+
+
+ROWS = [
+    dict(id='k1', a=1, b=10, name='Python'),
+    dict(id='k2', a=1, b=20, name='asyncio'),
+    dict(id='k3', a=2, b=10, name='pypy'),
+    dict(id='k4', a=2, b=30, name=None),
+    dict(id='k5', a=3, b=20, name='py'),
+]
+
+# (where, args, 命中的id)
+WHERES = [
+    ('`id`=?', ['k3'], ['k3']),
+    ('`id`=?', ['nope'], []),
+    ('id=?', ['k3'], ['k3']),
+    ('`a`=?', [1], ['k1', 'k2']),
+    ('`a`=?', [None], []),
+    ('`a`!=?', [1], ['k3', 'k4', 'k5']),
+    ('`a`<>?', [1], ['k3', 'k4', 'k5']),
+    ('`b`<?', [20], ['k1', 'k3']),
+    ('`b`<=?', [20], ['k1', 'k2', 'k3', 'k5']),
+    ('`b`>?', [20], ['k4']),
+    ('`b`>=?', [20], ['k2', 'k4', 'k5']),
+    ('`a`=? and `b`=?', [1, 20], ['k2']),
+    ('`id`=? and `a`=?', ['k1', 2], []),
+    ('`a`=? or `b`=?', [3, 10], ['k1', 'k3', 'k5']),
+    # and比or优先
+    ('`a`=? or `a`=? and `b`=?', [1, 2, 30], ['k1', 'k2', 'k4']),
+    ('(`a`=? or `a`=?) and `b`=?', [1, 2, 10], ['k1', 'k3']),
+    ('`b`=? and (`a`=? or (`a`=? and `id`=?))', [20, 3, 1, 'k2'],
+     ['k2', 'k5']),
+    ('((`a`=?))', [3], ['k5']),
+    ('`a` in (?)', [3], ['k5']),
+    ('`a` in (?, ?)', [1, 3], ['k1', 'k2', 'k5']),
+    ('`id` in (?,?,?) and `b`=?', ['k1', 'k2', 'k9', 10], ['k1']),
+    ('`name` like ?', ['py%'], ['k1', 'k3', 'k5']),
+    ('`name` like ?', ['%Y%'], ['k1', 'k2', 'k3', 'k5']),
+    ('`name` like ?', ['py_y'], ['k3']),
+    ('`name` like ?', ['%.%'], []),
+    ('`name` like ? and `a` in (?, ?)', ['py%', 2, 3], ['k3', 'k5']),
+]
+
+# (sql, args, 结果)
+SELECTS = [
+    ('select `id` from `t`', [], [dict(id=k) for k in
+                                  ['k1', 'k2', 'k3', 'k4', 'k5']]),
+    ('select * from `t` where `id`=?', ['k4'], [ROWS[3]]),
+    ('select `id`, `name` from `t` where `a`=?', [2],
+     [dict(id='k3', name='pypy'), dict(id='k4', name=None)]),
+    ('select count(*) _num_ from `t`', [], [dict(_num_=5)]),
+    ('select count(`id`) _num_ from `t` where `a`=?', [1], [dict(_num_=2)]),
+    ('select count(id) _num_ from `t` where `a`>?', [1], [dict(_num_=3)]),
+    ('select `id` from `t` order by `b` desc, `id`', [],
+     [dict(id=k) for k in ['k4', 'k2', 'k5', 'k1', 'k3']]),
+    ('select `id` from `t` order by `name`', [],
+     [dict(id=k) for k in ['k4', 'k1', 'k2', 'k5', 'k3']]),
+    ('select `id` from `t` where `b`=? order by `id` desc limit ?', [20, 1],
+     [dict(id='k5')]),
+    ('select `id` from `t` order by `id` limit ?', [2],
+     [dict(id='k1'), dict(id='k2')]),
+    ('select `id` from `t` order by `id` limit ?, ?', [1, 2],
+     [dict(id='k2'), dict(id='k3')]),
+    ('select `id` from `t` order by `id` limit ?,?', [4, 10],
+     [dict(id='k5')]),
+    ('select `id` from `t` where `a`=? order by `id` limit ?, ?', [2, 1, 5],
+     [dict(id='k4')]),
+    ('select `id` from `missing` where `a`=? limit ?, ?', [1, 0, 5], []),
+    ('select count(*) _num_ from `missing`', [], [dict(_num_=0)]),
+]
+
+UNSUPPORTED = [
+    ('drop table `t`', []),
+    ('select `id` from t', []),
+    ('select `id` from `t` where `a`=1', []),
+    ('select `id` from `t` where `a` ~ ?', [1]),
+    ('select `id` from `t` where `a` between ? and ?', [1, 2]),
+    ('select `id` from `t` where `a`=? and', [1]),
+    ('select `id` from `t` where (`a`=?', [1]),
+    ('select `id` from `t` where `a`=? `b`=?', [1, 2]),
+    ('select `id` from `t` where `a` in ?', [1]),
+    ('select `a` + 1 from `t`', []),
+    ('update `t` set `a`=? where `b` @ ?', [1, 2]),
+    ('delete from `t` where `a` is null', []),
+    ('replace into `t` (`id`) values (?)', ['k1']),
+]
+
+
+class MemoryBackendTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = MemoryBackend()
+        await self.db.execute(
+            'insert into `t` (`id`, `a`, `b`, `name`) values {}'.format(
+                ', '.join(['(?, ?, ?, ?)'] * len(ROWS))),
+            [r[k] for r in ROWS for k in ('id', 'a', 'b', 'name')])
+
+    async def ids(self, where, args):
+        rs = await self.db.select('select `id` from `t` where ' + where, args)
+        return [r['id'] for r in rs]
+
+    def assertIndexesConsistent(self):
+        t = self.db.tables['t']
+        for col, index in t.indexes.items():
+            expected = {}
+            for key, row in t.rows.items():
+                expected.setdefault(row.get(col), {})[key] = row
+            self.assertEqual(
+                dict((v, set(b)) for v, b in index.items()),
+                dict((v, set(b)) for v, b in expected.items()), col)
+            for bucket in index.values():
+                for key, row in bucket.items():
+                    self.assertIs(row, t.rows[key])
+
+    async def test_where(self):
+        for where, args, expected in WHERES:
+            self.assertEqual(sorted(await self.ids(where, args)), expected,
+                             where)
+        # 第二遍走前面建好的索引，结果一样
+        for where, args, expected in WHERES:
+            self.assertEqual(sorted(await self.ids(where, args)), expected,
+                             where)
+        self.assertEqual(set(self.db.tables['t'].indexes), {'a', 'b'})
+        self.assertIndexesConsistent()
+
+    async def test_select(self):
+        for sql, args, expected in SELECTS:
+            self.assertEqual(await self.db.select(sql, args), expected, sql)
+
+    async def test_select_size(self):
+        rs = await self.db.select('select `id` from `t`', [], 2)
+        self.assertEqual(len(rs), 2)
+
+    async def test_select_returns_copies(self):
+        rs = await self.db.select('select * from `t` where `a`=?', [3])
+        rs[0]['a'] = 100
+        self.assertEqual(await self.ids('`a`=?', [3]), ['k5'])
+
+    async def test_insert(self):
+        n = await self.db.execute(
+            'insert into `t` (`id`, `a`) values (?, ?), (?, ?)',
+            ['k6', 1, 'k7', 1])
+        self.assertEqual(n, 2)
+        self.assertEqual(await self.ids('`a`=?', [1]),
+                         ['k1', 'k2', 'k6', 'k7'])
+        # 第一列是主键，新表在第一次insert时创建
+        await self.db.execute('insert into `u` (`uid`, `x`) values (?, ?)',
+                              ['u1', 'y'])
+        self.assertEqual(await self.db.select(
+            'select * from `u` where `uid`=?', ['u1']), [dict(uid='u1', x='y')])
+
+    async def test_duplicate_key(self):
+        for args in (['k1', 9], ['k8', 9, 'k8', 9], ['k8', 9, 'k1', 9]):
+            sql = 'insert into `t` (`id`, `a`) values {}'.format(
+                ', '.join(['(?, ?)'] * (len(args) // 2)))
+            with self.assertRaises(IntegrityError) as cm:
+                await self.db.execute(sql, args)
+            self.assertTrue(self.db.is_duplicate_key(cm.exception))
+        # 失败的insert一行都不写
+        self.assertEqual(await self.ids('`a`=?', [9]), [])
+        self.assertEqual(len(self.db.tables['t'].rows), 5)
+        self.assertFalse(self.db.is_duplicate_key(ValueError()))
+
+    async def test_update(self):
+        await self.ids('`a`=?', [1])
+        await self.ids('`name`=?', ['py'])
+        n = await self.db.execute(
+            'update `t` set `a`=?, `name`=? where `id`=?', [3, 'py', 'k1'])
+        self.assertEqual(n, 1)
+        self.assertEqual(await self.ids('`a`=?', [1]), ['k2'])
+        self.assertEqual(sorted(await self.ids('`a`=?', [3])), ['k1', 'k5'])
+        self.assertEqual(sorted(await self.ids('`name`=?', ['py'])),
+                         ['k1', 'k5'])
+        self.assertIndexesConsistent()
+        n = await self.db.execute('update `t` set `b`=? where `a`=? or `b`=?',
+                                  [0, 2, 20])
+        self.assertEqual(n, 4)
+        self.assertEqual(await self.ids('`b`=?', [0]), ['k2', 'k3', 'k4', 'k5'])
+        n = await self.db.execute('update `t` set `a`=?', [7])
+        self.assertEqual(n, 5)
+        self.assertEqual(len(await self.ids('`a`=?', [7])), 5)
+        self.assertIndexesConsistent()
+        self.assertEqual(await self.db.execute(
+            'update `missing` set `a`=? where `id`=?', [1, 'k1']), 0)
+
+    async def test_delete(self):
+        await self.ids('`a`=?', [2])
+        n = await self.db.execute('delete from `t` where `a`=? and `b`>?',
+                                  [2, 10])
+        self.assertEqual(n, 1)
+        self.assertEqual(await self.ids('`a`=?', [2]), ['k3'])
+        self.assertEqual(await self.ids('`id`=?', ['k4']), [])
+        self.assertIndexesConsistent()
+        # 删掉之后可以用同一个主键再insert
+        await self.db.execute('insert into `t` (`id`, `a`) values (?, ?)',
+                              ['k4', 5])
+        self.assertEqual(await self.ids('`a`=?', [5]), ['k4'])
+        self.assertEqual(await self.db.execute('delete from `t`', []), 5)
+        self.assertEqual(await self.ids('`a`=?', [2]), [])
+        self.assertIndexesConsistent()
+        self.assertEqual(await self.db.execute(
+            'delete from `missing` where `id`=?', ['k1']), 0)
+
+    async def test_load_replaces_rows(self):
+        await self.ids('`a`=?', [1])
+        self.db.load('t', [dict(id='k1', a=4, b=10, name='Python')])
+        self.assertEqual(await self.ids('`a`=?', [1]), ['k2'])
+        self.assertEqual(await self.ids('`a`=?', [4]), ['k1'])
+        self.assertEqual((await self.db.select('select `id` from `t`', []))[0],
+                         dict(id='k1'))
+        self.assertIndexesConsistent()
+
+    async def test_unsupported(self):
+        self.assertTrue(issubclass(UnsupportedSQL, ValueError))
+        for sql, args in UNSUPPORTED:
+            with self.assertRaises(UnsupportedSQL, msg=sql):
+                if sql.startswith('select'):
+                    await self.db.select(sql, args)
+                else:
+                    await self.db.execute(sql, args)
+
+    async def test_seed(self):
+        import json
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as f:
+            json.dump({'t': ROWS[:2]}, f)
+        try:
+            db = MemoryBackend()
+            await db.connect(seed=f.name)
+            self.assertEqual(await db.select(
+                'select count(*) _num_ from `t`', []), [dict(_num_=2)])
+        finally:
+            os.remove(f.name)
+
+
+class WhereTest(unittest.TestCase):
+
+    def test_nargs_and_equals(self):
+        for clause, nargs, equals in [
+                ('`a`=?', 1, [('a', 0)]),
+                ('`a`>? and `b`=? and c=?', 3, [('b', 1), ('c', 2)]),
+                ('(`a`=? and `b`=?) and `c` in (?, ?)', 4,
+                 [('a', 0), ('b', 1)]),
+                ('`a`=? or `b`=?', 2, []),
+                ('`a`=? and (`b`=? or `c`=?)', 3, [('a', 0)]),
+                ('`a` like ?', 1, []),
+        ]:
+            w = memdb._Where(clause)
+            self.assertEqual((w.nargs, w.equals), (nargs, equals), clause)
+
+
+if __name__ == '__main__':
+    unittest.main()
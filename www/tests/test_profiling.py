@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    剖析中间件: 抽样和管理员header触发、剖析包含auth阶段、
+    非管理员不写文件、计时并入外层Timings
+
+    在www目录下运行: python3 -m pytest tests
+'''
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import profiling
+from profiling import phase, profile_middleware
+
+
+def burn(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+def make_request(headers=None, user=None):
+    return SimpleNamespace(method='GET', path='/blog/1', headers=headers or {},
+                           user=user)
+
+
+async def get_user(request):
+    '''
+        和middlewares.current_user一样在auth阶段里取用户，结果记在request上
+    '''
+    if not hasattr(request, '__user__'):
+        with phase('auth'):
+            burn(0.03)
+        request.__user__ = request.user
+    return request.__user__
+
+
+async def auth_factory(app, handler):
+    async def auth(request):
+        await get_user(request)
+        return await handler(request)
+    return auth
+
+
+async def endpoint(request):
+    with phase('handler'):
+        with phase('db'):
+            burn(0.02)
+        with phase('render'):
+            burn(0.02)
+    return 'ok'
+
+
+class ProfileMiddlewareTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.calls = 0
+
+    async def asyncTearDown(self):
+        self.tmp.cleanup()
+
+    async def handler(self, sample_every=0):
+        async def counting(request):
+            self.calls += 1
+            return await endpoint(request)
+        factory = profile_middleware(sample_every, 'X-Profile', 0.001,
+                                     self.tmp.name, get_user=get_user)
+        return await factory(None, await auth_factory(None, counting))
+
+    def profiles(self):
+        return [os.path.join(self.tmp.name, f)
+                for f in os.listdir(self.tmp.name)]
+
+    async def test_sampled_request_covers_auth(self):
+        handler = await self.handler(sample_every=1)
+        request = make_request()
+        with self.assertLogs(level='INFO') as cm:
+            self.assertEqual(await handler(request), 'ok')
+        log = '\n'.join(cm.output)
+        for name in ('auth', 'handler', 'db', 'render'):
+            self.assertIn(' {}='.format(name), log)
+        files = self.profiles()
+        self.assertEqual(len(files), 1)
+        with open(files[0], encoding='utf-8') as f:
+            roots = set(line.split(';', 1)[0] for line in f)
+        self.assertIn('auth', roots)
+        self.assertTrue(roots & {'handler', 'db', 'render'})
+
+    async def test_admin_header(self):
+        handler = await self.handler()
+        request = make_request({'X-Profile': '1'},
+                               SimpleNamespace(admin=True))
+        outer = profiling.Timings()
+        token = profiling.start_timings(outer)
+        try:
+            self.assertEqual(await handler(request), 'ok')
+        finally:
+            profiling.reset_timings(token)
+        self.assertEqual(len(self.profiles()), 1)
+        # 取用户只做了一次，auth阶段并入外层
+        self.assertEqual(outer.counts['auth'], 1)
+        self.assertEqual(set(outer.totals),
+                         {'auth', 'handler', 'db', 'render'})
+
+    async def test_header_ignored_for_others(self):
+        handler = await self.handler()
+        for user in (None, SimpleNamespace(admin=False)):
+            request = make_request({'X-Profile': '1'}, user)
+            outer = profiling.Timings()
+            token = profiling.start_timings(outer)
+            try:
+                self.assertEqual(await handler(request), 'ok')
+            finally:
+                profiling.reset_timings(token)
+            self.assertEqual(outer.counts['auth'], 1)
+            self.assertEqual(outer.counts['handler'], 1)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.profiles(), [])
+
+    async def test_not_sampled(self):
+        handler = await self.handler(sample_every=3)
+        for _ in range(5):
+            await handler(make_request())
+        self.assertEqual(self.calls, 5)
+        self.assertEqual(len(self.profiles()), 1)
+
+    async def test_header_without_get_user(self):
+        factory = profile_middleware(0, 'X-Profile', 0.001, self.tmp.name)
+        handler = await factory(None, await auth_factory(None, endpoint))
+        request = make_request({'X-Profile': '1'},
+                               SimpleNamespace(admin=True))
+        self.assertEqual(await handler(request), 'ok')
+        self.assertEqual(self.profiles(), [])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    全文搜索: 中文bigram分词、BM25排序、索引文件写入和mmap读取、
+    reload时重放本地修改、建索引不占用事件循环
+
+    在www目录下运行: python3 -m pytest tests
+'''
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+import search
+from search import SearchIndex, Searcher, tokenize
+
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def ids(hits):
+    return [id for _, id, _ in hits]
+
+
+class TokenizeTest(unittest.TestCase):
+
+    def test_tokenize(self):
+        for text, tokens in [
+                ('', []),
+                ('Hello, World', ['hello', 'world']),
+                ('中', ['中']),
+                ('中文', ['中文']),
+                ('全文搜索', ['全文', '文搜', '搜索']),
+                ('用Python写博客', ['用', 'python', '写博', '博客']),
+                ('你好，世界!', ['你好', '世界']),
+                ('v2 版本', ['v2', '版本']),
+                ('café_au lait', ['café_au', 'lait']),
+        ]:
+            self.assertEqual(tokenize(text), tokens, text)
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def make_index(self):
+        index = SearchIndex()
+        index.add('blog', 'b1', 'python asyncio 教程')
+        index.add('blog', 'b2', 'python python python')
+        index.add('blog', 'b3', 'python web 框架 asyncio aiohttp mysql orm '
+                                'template jinja2 markdown rss atom')
+        index.add('comment', 'c1', '写得好，asyncio很有用')
+        index.add('comment', 'c2', 'nothing relevant')
+        return index
+
+    def test_bm25_order(self):
+        index = self.make_index()
+        # 词频高的在前，同样词频短文档在前
+        self.assertEqual(ids(index.search('python')), ['b2', 'b1', 'b3'])
+        # 命中的词越多分数越高
+        self.assertEqual(ids(index.search('python asyncio'))[0], 'b1')
+        hits = index.search('asyncio')
+        self.assertEqual(sorted(ids(hits)), ['b1', 'b3', 'c1'])
+        scores = [s for _, _, s in hits]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_kind_and_limit(self):
+        index = self.make_index()
+        self.assertEqual(index.search('asyncio', kind='comment'),
+                         [('comment', 'c1', mock.ANY)])
+        self.assertEqual(len(index.search('python', limit=2)), 2)
+        self.assertEqual(index.search('不存在'), [])
+        self.assertEqual(SearchIndex().search('python'), [])
+
+    def test_update_and_remove(self):
+        index = self.make_index()
+        index.add('blog', 'b2', 'rust')
+        index.remove('blog', 'b1')
+        self.assertEqual(ids(index.search('python')), ['b3'])
+        self.assertEqual(ids(index.search('rust')), ['b2'])
+        self.assertEqual(len(index), 4)
+
+    def test_write_open_round_trip(self):
+        index = self.make_index()
+        index.built_at = 1234.5
+        index.remove('comment', 'c2')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'search.idx')
+            index.write(path)
+            loaded = SearchIndex.open(path)
+            self.assertEqual(loaded.built_at, 1234.5)
+            self.assertEqual(len(loaded), 4)
+            self.assertNotIn(('comment', 'c2'), loaded._docno)
+            for q in ('python', 'asyncio', '有用', 'python asyncio 框架'):
+                self.assertEqual(ids(loaded.search(q)), ids(index.search(q)))
+                for (_, _, a), (_, _, b) in zip(loaded.search(q),
+                                                index.search(q)):
+                    self.assertAlmostEqual(a, b)
+            # 打开之后的修改追加到delta
+            loaded.add('blog', 'b4', 'python python python python')
+            loaded.remove('blog', 'b2')
+            self.assertEqual(ids(loaded.search('python')), ['b4', 'b1', 'b3'])
+            # 写回文件时合并base和delta
+            loaded.write(path)
+            self.assertEqual(ids(SearchIndex.open(path).search('python')),
+                             ['b4', 'b1', 'b3'])
+
+    def test_open_rejects_other_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'search.idx')
+            with open(path, 'wb') as f:
+                f.write(b'x' * 64)
+            with self.assertRaises(ValueError):
+                SearchIndex.open(path)
+
+
+class Doc(object):
+
+    def __init__(self, id, name='', summary='', content=''):
+        self.id = id
+        self.name = name
+        self.summary = summary
+        self.content = content
+
+
+class SearcherTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'search.idx')
+
+    async def asyncTearDown(self):
+        self.tmp.cleanup()
+
+    def write_index(self, built_at, docs):
+        index = SearchIndex()
+        index.built_at = built_at
+        for id, text in docs:
+            index.add('blog', id, text)
+        index.write(self.path)
+        # 让mtime一定变化
+        st = os.stat(self.path)
+        os.utime(self.path, (st.st_atime, st.st_mtime + 1))
+
+    async def test_reload_replays_log(self):
+        s = Searcher(self.path)
+        self.assertFalse(s.reload())
+        s.on_blog(Doc('early', 'python'), 'save')
+        self.write_index(time.time(), [('base', 'python'),
+                                       ('gone', 'python')])
+        s.on_blog(Doc('late', 'python'), 'save')
+        s.on_blog(Doc('gone'), 'remove')
+        self.assertTrue(s.reload())
+        self.assertFalse(s.reload())
+        # 文件构建之前的修改已经在文件里(或由重建读到)，不再重放
+        self.assertEqual(sorted(ids(await s.search('python'))),
+                         ['base', 'late'])
+        self.assertEqual([e[2] for e in s._log], ['late', 'gone'])
+        # 下一次重新加载仍然重放构建之后的修改
+        self.write_index(time.time() - 60, [('base', 'python')])
+        self.assertTrue(s.reload())
+        self.assertEqual(sorted(ids(await s.search('python'))),
+                         ['base', 'late'])
+
+    async def test_build_off_loop(self):
+        db = await orm.create_pool(backend='memory')
+        try:
+            db.load('blogs', [dict(id='b{}'.format(i), name='标题',
+                                   summary='', content='全文搜索 python')
+                              for i in range(7)])
+            db.load('comments', [dict(id='c1', content='python')])
+            threads = set()
+            build_index = search.build_index
+
+            def spy(docs, built_at):
+                threads.add(threading.get_ident())
+                return build_index(docs, built_at)
+
+            with mock.patch.object(search, 'build_index', spy):
+                index = await search.build(batch_size=3)
+            self.assertNotIn(threading.get_ident(), threads)
+            self.assertEqual(len(index), 8)
+            self.assertEqual(len(index.search('搜索')), 7)
+            self.assertEqual(ids(index.search('python', kind='comment')),
+                             ['c1'])
+        finally:
+            await orm.close_pool()
+
+
+if __name__ == '__main__':
+    unittest.main()
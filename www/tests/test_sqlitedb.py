@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    SQLite后端: MySQL方言的翻译，以及orm的find/findAll/save_all/update/remove
+    在临时库文件上的往返
+
+    在www目录下运行: python3 -m pytest tests
+'''
+
+import os
+import sys
+import sqlite3
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+import sqlitedb
+from sqlitedb import translate
+from models import User, Comment
+
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+class TranslateTest(unittest.TestCase):
+
+    def test_translate(self):
+        for sql, expected in [
+                ('select `id`, `name` from `users` where `email`=?',
+                 ('select "id", "name" from "users" where "email"=?', False)),
+                ('select `id` from `blogs` order by `created_at` desc '
+                 'limit ?, ?',
+                 ('select "id" from "blogs" order by "created_at" desc '
+                  'limit ? offset ?', True)),
+                ('select `id` from `blogs` limit ?,?',
+                 ('select "id" from "blogs" limit ? offset ?', True)),
+                ('select `id` from `blogs` LIMIT ?, ?',
+                 ('select "id" from "blogs" limit ? offset ?', True)),
+                ('select `id` from `blogs` limit ?',
+                 ('select "id" from "blogs" limit ?', False)),
+                ('select count(*) _num_ from `comments` where `blog_id`=?',
+                 ('select count(*) _num_ from "comments" where "blog_id"=?',
+                  False)),
+                ('  update `users` set `name`=? where `id`=?  ',
+                 ('update "users" set "name"=? where "id"=?', False)),
+        ]:
+            self.assertEqual(translate(sql), expected, sql)
+
+    def test_limit_args_swapped(self):
+        backend = sqlitedb.SQLiteBackend()
+        self.assertEqual(
+            backend._translate('select `id` from `t` where `a`=? limit ?, ?',
+                               ['x', 10, 5]),
+            ('select "id" from "t" where "a"=? limit ? offset ?',
+             ['x', 5, 10]))
+        self.assertEqual(
+            backend._translate('select `id` from `t` where `a`=? limit ?',
+                               ('x', 5)),
+            ('select "id" from "t" where "a"=? limit ?', ['x', 5]))
+        self.assertEqual(backend._translate('select `id` from `t`', None),
+                         ('select "id" from "t"', []))
+
+
+def new_user(i, **kw):
+    return User(id='u{:02d}'.format(i), email='u{}@example.com'.format(i),
+                passwd='x', admin=False, name='user {}'.format(i),
+                image='about:blank', created_at=float(i), **kw)
+
+
+class RoundTripTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.db')
+        await orm.create_pool(backend='sqlite', sqlite_path=self.path,
+                              sqlite_readers=2)
+        self.cache = orm.entity_cache.enabled
+        orm.entity_cache.enabled = False
+
+    async def asyncTearDown(self):
+        orm.entity_cache.enabled = self.cache
+        await orm.close_pool()
+        self.tmp.cleanup()
+
+    async def test_round_trip(self):
+        await new_user(0).save()
+        self.assertEqual(await User.save_all([new_user(i)
+                                              for i in range(1, 8)]), 7)
+        u = await User.find('u03')
+        self.assertEqual((u.email, u.admin, u.created_at),
+                         ('u3@example.com', 0, 3.0))
+        self.assertIsNone(await User.find('nope'))
+
+        rs = await User.findAll(orderBy='`created_at` desc', limit=3)
+        self.assertEqual([r.id for r in rs], ['u07', 'u06', 'u05'])
+        # limit ?, ?翻译成limit ? offset ?，参数对调
+        rs = await User.findAll('`created_at`>?', [1.0],
+                                orderBy='`created_at`', limit=(2, 3))
+        self.assertEqual([r.id for r in rs], ['u04', 'u05', 'u06'])
+        rs = await User.findAll('`id` in (?, ?)', ['u01', 'u02'],
+                                columns=['name'], orderBy='`id`')
+        self.assertEqual([(r.id, r.name) for r in rs],
+                         [('u01', 'user 1'), ('u02', 'user 2')])
+        self.assertEqual(await User.find_number('count(*)'), 8)
+        self.assertEqual(await User.find_number(
+            'count(*)', '`email` like ?', ['u1%']), 1)
+
+        u.name = 'renamed'
+        u.admin = True
+        await u.update()
+        u = await User.find('u03')
+        self.assertEqual((u.name, u.admin), ('renamed', 1))
+
+        await u.remove()
+        self.assertIsNone(await User.find('u03'))
+        self.assertEqual(await User.find_number('count(*)'), 7)
+
+    async def test_duplicate_key(self):
+        await new_user(1).save()
+        with self.assertRaises(sqlite3.IntegrityError) as cm:
+            await User.save_all([new_user(2), new_user(1)])
+        self.assertTrue(orm.is_duplicate_key(cm.exception))
+        # 整条insert失败，u02也没有写入
+        self.assertEqual(await User.find_number('count(*)'), 1)
+
+    async def test_tables_and_indexes(self):
+        c = Comment(blog_id='b1', user_id='u1', user_name='n',
+                    user_image='i', content='hello', html_content='<p>hello</p>')
+        await c.save()
+        rs = await Comment.findAll('`blog_id`=?', ['b1'],
+                                   orderBy='`created_at` desc, `id` desc')
+        self.assertEqual([r.content for r in rs], ['hello'])
+        conn = sqlite3.connect(self.path)
+        try:
+            names = set(r[0] for r in conn.execute(
+                "select name from sqlite_master where type='index'"))
+        finally:
+            conn.close()
+        self.assertIn('comments_idx_blog_id_created_at', names)
+
+
+class MissingColumnsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_warns_about_missing_columns(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'old.db')
+            conn = sqlite3.connect(path)
+            conn.execute('create table "comments" ("id" varchar(50) not null '
+                         'primary key, "blog_id" varchar(50) not null)')
+            conn.close()
+            with self.assertLogs(level='WARNING') as cm:
+                await orm.create_pool(backend='sqlite', sqlite_path=path)
+            try:
+                output = '\n'.join(cm.output)
+                self.assertIn('comments', output)
+                self.assertIn("'html_content'", output)
+                self.assertNotIn('users', output)
+            finally:
+                await orm.close_pool()
+
+
+if __name__ == '__main__':
+    unittest.main()
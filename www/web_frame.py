@@ -3,15 +3,19 @@
 
 
 import inspect
-import asyncio
 import logging
 import functools
 import os
+import json
 from urllib import parse
 from aiohttp import web
 from apis import APIError
 
 
+# 路由清单格式或analyze_args的结果变化时加1，让旧清单失效
+MANIFEST_VERSION = 1
+
+
 def get(path):
     """
         get decorator factory
@@ -98,19 +102,40 @@ def has_request_arg(fn):
     return False
 
 
+def analyze_args(fn):
+    """
+        一次inspect.signature得到RequestHandler需要的全部参数信息，
+        结果只含基本类型，可以写进路由清单
+    """
+    spec = dict(has_request_arg=False, has_var_kw_args=False,
+                named_kw_args=[], required_named_kw_args=[])
+    for name, parameter in inspect.signature(fn).parameters.items():
+        if name == 'request':
+            spec['has_request_arg'] = True
+        if parameter.kind == inspect.Parameter.KEYWORD_ONLY:
+            spec['named_kw_args'].append(name)
+            if parameter.default == inspect.Parameter.empty:
+                spec['required_named_kw_args'].append(name)
+        elif parameter.kind == inspect.Parameter.VAR_KEYWORD:
+            spec['has_var_kw_args'] = True
+    return spec
+
+
 class RequestHandler():
     """
         请求处理函数类
     """
 
-    def __init__(self, app, fn):
+    def __init__(self, app, fn, spec=None):
         self._app = app
         self._func = fn
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_args = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_named_kw_args = get_required_named_kw_args(fn)
+        if spec is None:
+            spec = analyze_args(fn)
+        self._has_request_arg = spec['has_request_arg']
+        self._has_var_kw_args = spec['has_var_kw_args']
+        self._named_kw_args = tuple(spec['named_kw_args'])
+        self._has_named_kw_args = bool(self._named_kw_args)
+        self._required_named_kw_args = tuple(spec['required_named_kw_args'])
 
     async def __call__(self, request):
         kw = None
@@ -133,12 +158,11 @@ class RequestHandler():
                     return web.HTTPBadRequest(
                         'Unsupported Content-Type: {}'
                         .format(request.content_type))
-            if request.method == 'GEt':
+            if request.method == 'GET':
                 qs = request.query_string
                 if qs:
                     kw = {}
                     for k, v in parse.parse_qs(qs, True).items():
-                        print(v)
                         kw[k] = v[0]  # TODO: 为什么将第一个元素取出来
         if not self._has_var_kw_args and self._has_named_kw_args:
             # remove unnamed kwargs
@@ -163,30 +187,31 @@ class RequestHandler():
                     return web.HTTPBadRequest(
                         'Missing argument: {}'.format(name))
         try:
-            res = await self._func(**kw)
+            res = self._func(**kw)
+            # 普通函数直接返回结果，async def返回协程
+            if inspect.isawaitable(res):
+                res = await res
             return res
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
 
-def add_route(app, fn):
+def add_route(app, fn, spec=None):
     """
-        注册单个URL处理函数
+        注册单个URL处理函数，spec为analyze_args的结果，没有时现场分析
     """
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__path__', None)
     if method is None or path is None:
         raise ValueError('@get or @post is not defined in {}.'.format(str(fn)))
-    if not asyncio.iscoroutine(fn) and not inspect.isgenerator(fn):
-        fn = asyncio.coroutine(fn)
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    app.router.add_route(method, path, RequestHandler(app, fn, spec))
 
 
-def add_routes(app, module_name):
+def scan_routes(mod):
     """
-        注册一个模块内的所有URL处理函数
+        扫描模块内所有URL处理函数，返回路由清单
     """
-    mod = __import__(module_name)
+    routes = []
     for attr in dir(mod):
         if attr.startswith('_'):
             continue
@@ -195,7 +220,67 @@ def add_routes(app, module_name):
             method = getattr(fn, '__method__', None)
             path = getattr(fn, '__path__', None)
             if method and path:
-                add_route(app, fn)
+                routes.append(dict(name=attr, method=method, path=path,
+                                   args=analyze_args(fn)))
+    return routes
+
+
+def _manifest_path(mod):
+    return os.path.join(os.path.dirname(os.path.abspath(mod.__file__)),
+                        '__pycache__', 'routes.{}.json'.format(mod.__name__))
+
+
+def _source_stamp(mod):
+    st = os.stat(mod.__file__)
+    return [MANIFEST_VERSION, st.st_mtime_ns, st.st_size]
+
+
+def load_manifest(mod):
+    """
+        读取缓存的路由清单，模块源文件变过或清单不可用时返回None
+    """
+    try:
+        with open(_manifest_path(mod), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('source') != _source_stamp(mod):
+        return None
+    routes = manifest.get('routes', [])
+    for r in routes:
+        fn = getattr(mod, r['name'], None)
+        if getattr(fn, '__path__', None) != r['path'] or \
+                getattr(fn, '__method__', None) != r['method']:
+            return None
+    return routes
+
+
+def save_manifest(mod, routes):
+    path = _manifest_path(mod)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(dict(source=_source_stamp(mod), routes=routes), f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning('save route manifest failed: {}'.format(e))
+
+
+def add_routes(app, module_name, use_manifest=True):
+    """
+        注册一个模块内的所有URL处理函数。
+        路由清单缓存在模块旁的__pycache__里，源文件没变时各worker直接按清单
+        注册，不再扫描模块、不再inspect.signature
+    """
+    mod = __import__(module_name)
+    routes = load_manifest(mod) if use_manifest else None
+    if routes is None:
+        routes = scan_routes(mod)
+        if use_manifest:
+            save_manifest(mod, routes)
+    for r in routes:
+        add_route(app, getattr(mod, r['name']), r['args'])
 
 
 def add_static(app):